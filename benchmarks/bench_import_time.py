@@ -0,0 +1,63 @@
+import sys
+import argparse
+import subprocess
+
+HEAVY_MODULES = ['napari', 'qtpy', 'PyQt5', 'dash', 'dash_bootstrap_components', 'plotly', 'pandas', 'scipy',
+                 'h5py', 'mrcfile', 'starfile']
+
+
+def parse_importtime(output):
+    """Parse the output of python -X importtime into the cumulative import time of every module.
+    :param output: the stderr of the python process
+    :type output: str
+    :return: dictionary mapping the module names to their cumulative import time in microseconds, and the
+             total import time of the top level modules
+    :rtype: tuple
+    """
+    times = {}
+    total = 0
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        module = name.strip()
+        times[module] = int(cumulative)
+        if not name[1:].startswith(' '):
+            total += int(cumulative)
+    return times, total
+
+
+def measure(code):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr)
+    return parse_importtime(result.stderr)
+
+
+def main(max_ms, top):
+    times, total = measure('import sys; sys.argv = ["cryosiam-vis", "--version"]\n'
+                           'import cryosiam_vis.cli as cli\n'
+                           'try:\n    cli.main()\nexcept SystemExit:\n    pass')
+    print(f'cryosiam-vis --version: {total / 1000:8.1f} ms of imports, {len(times)} modules')
+    for module, cumulative in sorted(times.items(), key=lambda item: -item[1])[:top]:
+        print(f'{cumulative / 1000:10.1f} ms  {module}')
+    heavy = [m for m in HEAVY_MODULES if m in times]
+    failed = False
+    if heavy:
+        print(f'FAIL: heavy modules imported at startup: {", ".join(heavy)}')
+        failed = True
+    if total / 1000 > max_ms:
+        print(f'FAIL: startup imports take more than {max_ms} ms')
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark the import time of the cryosiam-vis command line interface',
+                                     add_help=True)
+    parser.add_argument('--max_ms', type=float, required=False, default=500,
+                        help='Maximum allowed import time in ms')
+    parser.add_argument('--top', type=int, required=False, default=10,
+                        help='Number of the slowest modules to print')
+    args = parser.parse_args()
+    sys.exit(main(args.max_ms, args.top))
@@ -0,0 +1,33 @@
+import time
+import argparse
+import numpy as np
+
+from cryosiam_vis.particle_rendering import RENDER_MODES, particle_figure, figure_payload_size
+
+
+def synthetic_particle(patch_size=64, radius=15, seed=0):
+    rng = np.random.default_rng(seed)
+    z, y, x = np.mgrid[:patch_size, :patch_size, :patch_size] - patch_size // 2
+    mask = (z ** 2 + y ** 2 + x ** 2 < radius ** 2).astype(np.uint8)
+    patch = rng.random(mask.shape, dtype=np.float32) * mask
+    return patch, mask
+
+
+def main(repeats):
+    patch, mask = synthetic_particle()
+    for render_mode in RENDER_MODES:
+        particle_figure(patch, mask, render_mode)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fig = particle_figure(patch, mask, render_mode)
+            payload = figure_payload_size(fig)
+        elapsed = (time.perf_counter() - start) / repeats
+        print(f'{render_mode:>14}: {elapsed * 1000:8.1f} ms, payload {payload / 1024:8.1f} KiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark the particle render modes', add_help=True)
+    parser.add_argument('--repeats', type=int, required=False, default=5,
+                        help='Number of repetitions per render mode')
+    args = parser.parse_args()
+    main(args.repeats)
@@ -0,0 +1,349 @@
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib
+import importlib.util
+import numpy as np
+from functools import partial
+
+from synthetic_data import generate_dataset
+from bench_particle_rendering import synthetic_particle
+
+SESSION_ID = '0123456789abcdef0123456789abcdef'
+NAPARI_VIEWERS = ['visualize_denoised_tomogram', 'visualize_semantic_segmentation',
+                  'visualize_instance_segmentation', 'visualize_filtered_instance_segmentation',
+                  'visualize_coordinates_from_star_file']
+
+
+def timed(results, name, fn, repeats=1, setup=None):
+    """Run a function repeat times and store the median and the minimum wall time in the results.
+    :param results: dictionary with the results
+    :type results: dict
+    :param name: name of the benchmark
+    :type name: str
+    :param fn: the function to be timed
+    :type fn: callable
+    :param repeats: number of repetitions
+    :type repeats: int
+    :param setup: function called before every repetition, not timed
+    :type setup: callable
+    :return: the value returned by the last call of fn
+    """
+    times = []
+    value = None
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        value = fn()
+        times.append(time.perf_counter() - start)
+    results[name] = {'seconds': float(np.median(times)), 'min_seconds': float(min(times)), 'repeats': repeats}
+    print(f'{name:>55}: {results[name]["seconds"] * 1000:10.1f} ms', flush=True)
+    return value
+
+
+def clear_caches(root):
+    for folder, subfolders, _ in os.walk(root):
+        for subfolder in subfolders:
+            if subfolder == '.cryosiam_vis_cache':
+                shutil.rmtree(os.path.join(folder, subfolder))
+
+
+def nbytes(data):
+    """Get the size of the data of a layer (all levels of a multiscale layer), without reading datasets."""
+    if isinstance(data, (list, tuple)):
+        return sum(nbytes(level) for level in data)
+    return int(np.prod(data.shape)) * np.dtype(data.dtype).itemsize
+
+
+class DashClient:
+    """Trigger the callbacks of a Dash app through the Flask test client, as the browser would."""
+
+    def __init__(self, app):
+        self.app = app
+        self.client = app.server.test_client()
+        self.client.get('/')
+
+    @staticmethod
+    def outputs(key):
+        multi = key.startswith('..')
+        outputs = []
+        for part in (key[2:-2].split('...') if multi else [key]):
+            i = part.rindex('.', 0, part.index('@') if '@' in part else len(part))
+            outputs.append({'id': part[:i], 'property': part[i + 1:]})
+        return outputs, multi
+
+    def fire(self, input_id, prop, value):
+        """Run all callbacks with the given input.
+        :return: list of the decoded responses and the total response size in bytes
+        :rtype: tuple
+        """
+        responses, size = [], 0
+        for key, callback in list(self.app.callback_map.items()):
+            inputs = callback['inputs']
+            if not any(x['id'] == input_id and x['property'] == prop for x in inputs):
+                continue
+            outputs, multi = self.outputs(key)
+            body = {'output': key, 'outputs': outputs if multi else outputs[0],
+                    'inputs': [dict(x, value=value if (x['id'], x['property']) == (input_id, prop) else None)
+                               for x in inputs],
+                    'changedPropIds': [f'{input_id}.{prop}'],
+                    'state': [dict(x, value=SESSION_ID if x['id'] == 'session-id' else None)
+                              for x in callback.get('state', [])]}
+            r = self.client.post('/_dash-update-component', json=body)
+            if r.status_code not in (200, 204):
+                raise RuntimeError(f'{key} failed with status {r.status_code}: {r.data[:500]}')
+            size += len(r.data)
+            responses.append(r.get_json(silent=True))
+        return responses, size
+
+    def wait_loaded(self, timeout=600):
+        start = time.perf_counter()
+        n = 0
+        while time.perf_counter() - start < timeout:
+            n += 1
+            responses, _ = self.fire('loading-interval', 'n_intervals', n)
+            if any(r and r['response'].get('loading-interval', {}).get('disabled') for r in responses):
+                return
+            time.sleep(0.01)
+        raise TimeoutError('The volumes were not loaded in time')
+
+
+def dash_step(results, client, name, input_id, prop, value, repeats=1):
+    output = {}
+
+    def run():
+        output['responses'], output['size'] = client.fire(input_id, prop, value)
+
+    timed(results, name, run, repeats)
+    results[name]['payload_bytes'] = output['size']
+    return output['responses']
+
+
+def bench_loading(results, config, filenames, repeats):
+    import yaml
+    from cryosiam_vis.io_utils import load_tomogram, open_h5_memmap
+    from cryosiam_vis.instance_index import load_instance_index
+    from cryosiam_vis.umap_data import load_embeddings_umap, load_cluster_umap
+
+    with open(config, 'r') as f:
+        config = yaml.safe_load(f)
+    root = os.path.dirname(config['data_folder'])
+    name = filenames[0].split(config['file_extension'])[0]
+    tomo_file = os.path.join(config['data_folder'], filenames[0])
+    instances_file = os.path.join(config['prediction_folder'], name + '_instance_preds.h5')
+    umap_file = os.path.join(config['prediction_folder'], name + '_embeds_umap_data.csv')
+    clusters_file = os.path.join(config['prediction_folder'], 'kmeans_clusters_umap_data.csv')
+
+    timed(results, 'load/tomogram', lambda: load_tomogram(tomo_file), repeats)
+    timed(results, 'load/instances_memmap', lambda: open_h5_memmap(instances_file, 'instances')[()], repeats)
+    for cache in ('cold', 'warm'):
+        setup = (lambda: clear_caches(root)) if cache == 'cold' else None
+        timed(results, f'load/instance_index_{cache}', lambda: load_instance_index(instances_file), repeats, setup)
+        timed(results, f'load/embeddings_umap_{cache}', lambda: load_embeddings_umap(umap_file), repeats, setup)
+        timed(results, f'load/clusters_umap_{cache}', lambda: load_cluster_umap(clusters_file), repeats, setup)
+
+
+def bench_scatter(results, config, filenames, repeats):
+    import yaml
+    from cryosiam_vis.scatter import scatter_figure
+    from cryosiam_vis.umap_data import load_embeddings_umap
+    from cryosiam_vis.particle_rendering import figure_payload_size
+
+    with open(config, 'r') as f:
+        config = yaml.safe_load(f)
+    name = filenames[0].split(config['file_extension'])[0]
+    umap = load_embeddings_umap(os.path.join(config['prediction_folder'], name + '_embeds_umap_data.csv'))
+    fig = timed(results, 'scatter/figure',
+                lambda: scatter_figure(umap, color='semantic_class', hover=['label', 'semantic_class']), repeats)
+    results['scatter/figure']['payload_bytes'] = figure_payload_size(fig)
+    results['scatter/figure']['points'] = len(umap)
+
+
+def bench_rendering(results, repeats):
+    from cryosiam_vis.particle_rendering import RENDER_MODES, particle_figure, figure_payload_size
+
+    patch, mask = synthetic_particle()
+    for render_mode in RENDER_MODES:
+        fig = timed(results, f'render/{render_mode}', lambda: particle_figure(patch, mask, render_mode), repeats)
+        results[f'render/{render_mode}']['payload_bytes'] = figure_payload_size(fig)
+
+
+def bench_embeddings_app(results, config, filenames, repeats):
+    from cryosiam_vis.visualize_embeddings import create_app
+
+    client = DashClient(create_app(config))
+    dash_step(results, client, 'embeddings/select_file', 'file-dropdown', 'value', filenames[0])
+    timed(results, 'embeddings/background_load', client.wait_loaded)
+    click = {'points': [{'customdata': [0, 1]}]}
+    dash_step(results, client, 'embeddings/click_umap', 'umap-plot', 'clickData', click, repeats)
+    dash_step(results, client, 'embeddings/select_instance', 'selected-instance-id', 'value', 2, repeats)
+    dash_step(results, client, 'embeddings/neighbours_gallery', 'selected-structure-info', 'children', '',
+              repeats)
+    dash_step(results, client, 'embeddings/sliding_axis', 'sliding-axis', 'value', 'x', repeats)
+    dash_step(results, client, 'embeddings/slice_index', 'slice-index', 'value', 10, repeats)
+    for render_mode in ('mesh', 'volume_lowres', 'volume'):
+        dash_step(results, client, f'embeddings/render_{render_mode}', 'render-mode', 'value', render_mode, repeats)
+
+
+def bench_clusters_app(results, config, filenames, repeats):
+    from cryosiam_vis.visualize_clusters import create_app
+
+    client = DashClient(create_app(config, 'kmeans'))
+    dash_step(results, client, 'clusters/select_file', 'file-dropdown', 'value', filenames[0])
+    timed(results, 'clusters/background_load', client.wait_loaded)
+    click = {'points': [{'customdata': [0, f'{filenames[0]}_1']}]}
+    dash_step(results, client, 'clusters/click_umap', 'umap-plot', 'clickData', click, repeats)
+    dash_step(results, client, 'clusters/click_subcluster', 'subcluster-umap-plot', 'clickData', click, repeats)
+
+
+def bench_save_particles(results, config, filenames, workers):
+    import yaml
+    from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset
+    from cryosiam_vis.instance_index import load_instance_index
+    from cryosiam_vis.save_instance_file import save_particles, select_instances
+
+    with open(config, 'r') as f:
+        config = yaml.safe_load(f)
+    name = filenames[0].split(config['file_extension'])[0]
+    tomo = load_tomogram(os.path.join(config['data_folder'], filenames[0]))
+    instances_file = os.path.join(config['prediction_folder'], name + '_instance_preds.h5')
+    instances = open_h5_dataset(instances_file, 'instances')
+    index = load_instance_index(instances_file, instances)
+    ids = select_instances(index)
+    for output_format in ('mrc', 'mrc_stack', 'h5_stack'):
+        out_dir = tempfile.mkdtemp(prefix='cryosiam_vis_bench_')
+        try:
+            timed(results, f'save_particles/{output_format}',
+                  lambda: save_particles(tomo, instances, index, ids, True, out_dir, name, output_format, workers))
+            results[f'save_particles/{output_format}']['particles'] = len(ids)
+        finally:
+            shutil.rmtree(out_dir)
+
+
+def stub_napari():
+    """Replace napari with a module whose viewer only records the added layers, so the layer data
+    preparation of the viewers runs without a display.
+    :return: list with the created viewers
+    :rtype: list
+    """
+    viewers = []
+
+    class Viewer:
+        def __init__(self, *args, **kwargs):
+            self.layers = []
+            viewers.append(self)
+
+        def _add(self, data, **kwargs):
+            layer = types.SimpleNamespace(data=data, **kwargs)
+            self.layers.append(layer)
+            return layer
+
+        add_image = add_labels = add_points = _add
+
+    sys.modules['napari'] = types.SimpleNamespace(Viewer=Viewer, run=lambda *args, **kwargs: None)
+    return viewers
+
+
+def central_slice(data):
+    """Get the central z slice of the full resolution level of a layer, as napari displays it."""
+    level = data[0] if isinstance(data, (list, tuple)) else data
+    return level[level.shape[-3] // 2] if level.ndim >= 3 else level
+
+
+def bench_napari(results, config, filenames, repeats):
+    viewers = stub_napari()
+    root = os.path.dirname(os.path.abspath(config))
+    modes = ['', '_out_of_core'] if importlib.util.find_spec('dask') is not None else ['']
+    for viewer in NAPARI_VIEWERS:
+        module = importlib.import_module(f'cryosiam_vis.{viewer}')
+        args = (config, filenames[0], 15) if viewer == 'visualize_coordinates_from_star_file' else \
+            (config, filenames[0])
+        for mode in modes:
+            main = partial(module.main, *args, out_of_core=bool(mode))
+            for cache in ('cold', 'warm'):
+                name = f'napari/{viewer}{mode}_{cache}'
+                setup = (lambda: clear_caches(root)) if cache == 'cold' else None
+                timed(results, name, main, repeats, setup)
+                results[name]['layers'] = len(viewers[-1].layers)
+                results[name]['layer_bytes'] = sum(nbytes(layer.data) for layer in viewers[-1].layers)
+            layers = viewers[-1].layers
+            timed(results, f'napari/{viewer}{mode}_slice', lambda: [np.asarray(central_slice(layer.data))
+                                                                     for layer in layers], repeats)
+
+
+def compare(results, baseline_file):
+    with open(baseline_file, 'r') as f:
+        baseline = json.load(f)['results']
+    print(f'\n{"benchmark":>55}  {"baseline":>10}  {"current":>10}  {"ratio":>6}')
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result['seconds'] / baseline[name]['seconds'] if baseline[name]['seconds'] else float('nan')
+        print(f'{name:>55}  {baseline[name]["seconds"] * 1000:8.1f}ms  {result["seconds"] * 1000:8.1f}ms  '
+              f'{ratio:6.2f}')
+
+
+def main(args):
+    root = args.data_dir or tempfile.mkdtemp(prefix='cryosiam_vis_bench_data_')
+    try:
+        config, filenames = generate_dataset(root, args.tomograms, tuple(args.shape), args.particles,
+                                             umap_points=args.umap_points)
+        results = {}
+        suites = {'loading': lambda: bench_loading(results, config, filenames, args.repeats),
+                  'scatter': lambda: bench_scatter(results, config, filenames, args.repeats),
+                  'rendering': lambda: bench_rendering(results, args.repeats),
+                  'embeddings': lambda: bench_embeddings_app(results, config, filenames, args.repeats),
+                  'clusters': lambda: bench_clusters_app(results, config, filenames, args.repeats),
+                  'save_particles': lambda: bench_save_particles(results, config, filenames, args.workers),
+                  'napari': lambda: bench_napari(results, config, filenames, args.repeats)}
+        for suite in args.suites or list(suites):
+            suites[suite]()
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+    report = {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpus': os.cpu_count(),
+              'parameters': {'tomograms': args.tomograms, 'shape': args.shape, 'particles': args.particles,
+                             'umap_points': args.umap_points, 'repeats': args.repeats, 'workers': args.workers},
+              'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(results, args.compare)
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Benchmark the hot paths of the viewers on synthetic data, without a display',
+                                     add_help=True)
+    parser.add_argument('--output', type=str, required=False, default=None,
+                        help='Path to the json file the results are written to')
+    parser.add_argument('--compare', type=str, required=False, default=None,
+                        help='Path to the json file of a previous run to compare with')
+    parser.add_argument('--data_dir', type=str, required=False, default=None,
+                        help='Folder for the synthetic dataset (a temporary folder that is removed if not given)')
+    parser.add_argument('--suites', type=str, required=False, nargs='+', default=None,
+                        choices=['loading', 'scatter', 'rendering', 'embeddings', 'clusters', 'save_particles',
+                                 'napari'],
+                        help='Benchmark suites to run (all if not given)')
+    parser.add_argument('--tomograms', type=int, required=False, default=2,
+                        help='Number of synthetic tomograms')
+    parser.add_argument('--shape', type=int, required=False, nargs=3, default=[128, 256, 256],
+                        help='Shape of the synthetic tomograms')
+    parser.add_argument('--particles', type=int, required=False, default=50,
+                        help='Number of particles per tomogram')
+    parser.add_argument('--umap_points', type=int, required=False, default=None,
+                        help='Number of rows of the embeddings UMAP csv files (the number of particles if not given)')
+    parser.add_argument('--repeats', type=int, required=False, default=3,
+                        help='Number of repetitions per benchmark')
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of worker threads for saving the particles')
+    main(parser.parse_args())
@@ -0,0 +1,112 @@
+import os
+import h5py
+import yaml
+import argparse
+import mrcfile
+import starfile
+import numpy as np
+import pandas as pd
+
+FILE_EXTENSION = '.mrc'
+
+
+def synthetic_instances(shape, particles, radius, rng):
+    """Create an instance segmentation with spherical particles at random positions (later particles
+    overwrite the overlapping voxels of earlier ones).
+    """
+    instances = np.zeros(shape, dtype=np.int32)
+    centers = np.stack([rng.integers(radius, n - radius, particles) for n in shape], axis=1)
+    z, y, x = np.ogrid[-radius:radius + 1, -radius:radius + 1, -radius:radius + 1]
+    ball = z ** 2 + y ** 2 + x ** 2 <= radius ** 2
+    for i, (cz, cy, cx) in enumerate(centers, start=1):
+        view = instances[cz - radius:cz + radius + 1, cy - radius:cy + radius + 1, cx - radius:cx + radius + 1]
+        view[ball] = i
+    return instances, centers
+
+
+def generate_dataset(root, tomograms=2, shape=(128, 256, 256), particles=50, radius=8, umap_points=None,
+                     seed=0):
+    """Generate a synthetic CryoSiam prediction dataset with MRC tomograms, *_preds.h5,
+    *_instance_preds.h5, *_embeds_umap_data.csv, clusters UMAP csv and STAR files, and a config file
+    usable by all viewers.
+    :param root: path to the output folder
+    :type root: str
+    :param tomograms: number of tomograms
+    :type tomograms: int
+    :param shape: shape of the tomograms
+    :type shape: tuple
+    :param particles: number of particles per tomogram
+    :type particles: int
+    :param radius: radius of the particles in voxels
+    :type radius: int
+    :param umap_points: number of rows of every embeddings UMAP csv (the number of particles if None)
+    :type umap_points: int
+    :param seed: random seed
+    :type seed: int
+    :return: path to the config file and the tomogram filenames
+    :rtype: tuple
+    """
+    rng = np.random.default_rng(seed)
+    data_folder = os.path.join(root, 'data')
+    prediction_folder = os.path.join(root, 'predictions')
+    for folder in (data_folder, prediction_folder, prediction_folder + '_filtered'):
+        os.makedirs(folder, exist_ok=True)
+    umap_points = particles if umap_points is None else umap_points
+    filenames, cluster_rows, star_rows = [], [], []
+    for t in range(tomograms):
+        name = f'tomo_{t:03d}'
+        filename = name + FILE_EXTENSION
+        filenames.append(filename)
+        instances, centers = synthetic_instances(shape, particles, radius, rng)
+        tomo = rng.normal(0, 1, shape).astype(np.float32)
+        tomo[instances > 0] += 2
+        with mrcfile.new(os.path.join(data_folder, filename), overwrite=True) as m:
+            m.set_data(tomo)
+        with mrcfile.new(os.path.join(prediction_folder, filename), overwrite=True) as m:
+            m.set_data((tomo * 0.5).astype(np.float32))
+        classes = rng.integers(1, 4, particles + 1)
+        classes[0] = 0
+        labels = classes[instances].astype(np.int64)
+        with h5py.File(os.path.join(prediction_folder, name + '_preds.h5'), 'w') as f:
+            f.create_dataset('labels', data=labels)
+            f.create_dataset('probs', data=(labels > 0).astype(np.float32))
+        for folder in (prediction_folder, prediction_folder + '_filtered'):
+            with h5py.File(os.path.join(folder, name + '_instance_preds.h5'), 'w') as f:
+                f.create_dataset('instances', data=instances.astype(np.int64))
+        ids = 1 + np.arange(umap_points) % particles
+        pd.DataFrame({'x': rng.normal(0, 5, umap_points), 'y': rng.normal(0, 5, umap_points), 'label': ids,
+                      'semantic_class': classes[ids], 'log_area': rng.random(umap_points)}) \
+            .to_csv(os.path.join(prediction_folder, name + '_embeds_umap_data.csv'), index=False)
+        cluster_rows.append(pd.DataFrame({'class': rng.integers(0, 5, particles),
+                                          'labels': [f'{filename}_{i}' for i in range(1, particles + 1)],
+                                          'x': rng.normal(0, 5, particles), 'y': rng.normal(0, 5, particles)}))
+        star_rows.append(pd.DataFrame({'rlnCoordinateX': centers[:, 2], 'rlnCoordinateY': centers[:, 1],
+                                       'rlnCoordinateZ': centers[:, 0], 'rlnMicrographName': name}))
+    pd.concat(cluster_rows).to_csv(os.path.join(prediction_folder, 'kmeans_clusters_umap_data.csv'), index=False)
+    starfile.write({'particles': pd.concat(star_rows, ignore_index=True)},
+                   os.path.join(prediction_folder, 'class_1_particles.star'), overwrite=True)
+    config = {'data_folder': data_folder, 'prediction_folder': prediction_folder,
+              'instances_mask_folder': prediction_folder, 'filtering_mask_folder': prediction_folder,
+              'filtering_mask_labels': [1], 'file_extension': FILE_EXTENSION,
+              'visualization': {'prediction_folder': prediction_folder}}
+    config_file = os.path.join(root, 'config.yaml')
+    with open(config_file, 'w') as f:
+        yaml.safe_dump(config, f)
+    return config_file, filenames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser('Generate a synthetic CryoSiam prediction dataset', add_help=True)
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='Path to the output folder')
+    parser.add_argument('--tomograms', type=int, required=False, default=2,
+                        help='Number of tomograms')
+    parser.add_argument('--shape', type=int, required=False, nargs=3, default=[128, 256, 256],
+                        help='Shape of the tomograms')
+    parser.add_argument('--particles', type=int, required=False, default=50,
+                        help='Number of particles per tomogram')
+    parser.add_argument('--umap_points', type=int, required=False, default=None,
+                        help='Number of rows of the embeddings UMAP csv files')
+    args = parser.parse_args()
+    print(generate_dataset(args.output_dir, args.tomograms, tuple(args.shape), args.particles,
+                           umap_points=args.umap_points)[0])
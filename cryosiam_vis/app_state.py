@@ -0,0 +1,359 @@
+import os
+import re
+import copy
+import json
+import mmap
+import uuid
+import time
+import tempfile
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dash import dcc
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+MAX_SESSIONS = 1000
+SESSION_MAX_AGE = 7 * 24 * 3600
+SESSION_CLEANUP_INTERVAL = 3600
+MEMMAP_HANDLE_BYTES = 1024 ** 2
+SESSION_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+def session_id_store():
+    """Create the store holding the id of the browser session. The app layout is a function, so a new id
+    is generated every time the page is loaded.
+    :return: the store component with id 'session-id'
+    :rtype: dcc.Store
+    """
+    return dcc.Store(id='session-id', data=uuid.uuid4().hex)
+
+
+def default_session_folder(name):
+    """Get the folder used to share the session states between the worker processes of an app.
+    :param name: name of the app
+    :type name: str
+    :return: path to the folder
+    :rtype: str
+    """
+    return os.path.join(tempfile.gettempdir(), 'cryosiam_vis_sessions', name)
+
+
+class SessionStore:
+    """Server side state of the sessions of a Dash app, keyed by the session id. The states are small
+    dictionaries (the selected file, instance, axis, ...), heavy data is never stored per session.
+    Without a folder the states are kept in memory of the process, with a folder they are stored as
+    json files, so that all worker processes serving the app see the same state. Updates of a stored
+    state hold a file lock of the session (on systems with fcntl), so concurrent updates from several
+    processes only change their own keys, and the files of sessions not updated for max_age seconds are
+    removed.
+    """
+
+    def __init__(self, defaults, folder=None, max_sessions=MAX_SESSIONS, max_age=SESSION_MAX_AGE):
+        self.defaults = defaults
+        self.folder = folder
+        self.max_sessions = max_sessions
+        self.max_age = max_age
+        self._states = OrderedDict()
+        self._lock = threading.RLock()
+        self._last_cleanup = 0.
+        if folder is not None:
+            os.makedirs(folder, exist_ok=True)
+            self.cleanup()
+
+    def _path(self, session_id):
+        if not isinstance(session_id, str) or not SESSION_ID_PATTERN.fullmatch(session_id):
+            raise ValueError(f'Invalid session id: {session_id}')
+        return os.path.join(self.folder, f'{session_id}.json') if self.folder is not None else None
+
+    def get(self, session_id):
+        """Get the state of a session, new sessions start with the default state.
+        :param session_id: the session id
+        :type session_id: str
+        :return: copy of the session state
+        :rtype: dict
+        """
+        path = self._path(session_id)
+        state = copy.deepcopy(self.defaults)
+        with self._lock:
+            if path is None:
+                if session_id in self._states:
+                    self._states.move_to_end(session_id)
+                    state.update(copy.deepcopy(self._states[session_id]))
+            elif os.path.exists(path):
+                with open(path, 'r') as f:
+                    state.update(json.load(f))
+        return state
+
+    def update(self, session_id, **values):
+        """Update the state of a session.
+        :param session_id: the session id
+        :type session_id: str
+        :param values: the updated values
+        :type values: dict
+        :return: copy of the updated session state
+        :rtype: dict
+        """
+        path = self._path(session_id)
+        with self._lock:
+            if path is None:
+                state = self.get(session_id)
+                state.update(values)
+                self._states[session_id] = copy.deepcopy(state)
+                self._states.move_to_end(session_id)
+                while len(self._states) > self.max_sessions:
+                    self._states.popitem(last=False)
+                return state
+            with open(os.path.splitext(path)[0] + '.lock', 'a') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                # the state is read again under the file lock, so the keys updated by other processes are kept
+                state = self.get(session_id)
+                state.update(values)
+                tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, path)
+            if time.time() - self._last_cleanup > SESSION_CLEANUP_INTERVAL:
+                self.cleanup()
+        return state
+
+    def cleanup(self):
+        """Remove the stored states (and their lock files) of the sessions not updated for max_age seconds."""
+        if self.folder is None:
+            return
+        self._last_cleanup = now = time.time()
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                if now - os.path.getmtime(path) > self.max_age:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+def is_memory_mapped(array):
+    """Check whether an array is a memory map or a view of one.
+    :param array: the array
+    :type array: np.array
+    :return: whether the data of the array is memory-mapped
+    :rtype: bool
+    """
+    while isinstance(array, np.ndarray):
+        if isinstance(array, np.memmap):
+            return True
+        array = array.base
+    return isinstance(array, mmap.mmap)
+
+
+def handle_size(value):
+    """Estimate the heap memory a value of a HandlePool takes in bytes. Memory-mapped arrays count with a
+    small fixed size (their pages are held by the operating system page cache, which drops them under
+    memory pressure), HDF5 datasets with the size of their chunk cache and tables with the size of their
+    columns.
+    :param value: the value
+    :type value: object
+    :return: the estimated size in bytes
+    :rtype: int
+    """
+    if isinstance(value, np.ndarray):
+        return MEMMAP_HANDLE_BYTES if is_memory_mapped(value) else value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(handle_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(handle_size(v) for v in value.values())
+    if hasattr(value, 'memory_usage'):
+        return int(value.memory_usage(index=True).sum())
+    if hasattr(value, 'id') and hasattr(value.id, 'get_access_plist'):
+        return int(value.id.get_access_plist().get_chunk_cache()[1])
+    if isinstance(getattr(value, 'data', None), np.ndarray):
+        return 2 * handle_size(value.data)
+    return 64
+
+
+class HandlePool:
+    """Read-only data shared by all sessions of a worker process: memory-mapped tomograms, opened label
+    volumes, loaded tables and indexes. Every value is opened once, concurrent requests for the same key
+    wait for the first one to finish opening it. With a budget, the least recently used values are dropped
+    when the estimated size of the open values exceeds it (they are closed once the requests still using
+    them finish, and reopened when needed again). The values of the file of a new value (the second item of
+    the keys, for ex. the filename of ('volumes', filename)) are never dropped to admit it, so the values of
+    the file being viewed do not evict each other.
+    """
+
+    def __init__(self, max_bytes=None, size_of=handle_size):
+        """
+        :param max_bytes: the memory budget in bytes, unlimited if None
+        :type max_bytes: int
+        :param size_of: function estimating the size of a value in bytes
+        :type size_of: callable
+        """
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self._size_of = size_of
+        self._handles = OrderedDict()
+        self._opening = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._handles
+
+    def _lookup(self, key):
+        self._handles.move_to_end(key)
+        return self._handles[key][0]
+
+    def get(self, key, open_handle):
+        """Get the value for the key, opening it with open_handle() if it is not open yet.
+        :param key: the key, for ex. ('tomogram', path)
+        :type key: tuple
+        :param open_handle: function without arguments that opens the value
+        :type open_handle: callable
+        :return: the value
+        :rtype: object
+        """
+        with self._lock:
+            if key in self._handles:
+                return self._lookup(key)
+            key_lock = self._opening.setdefault(key, threading.Lock())
+        with key_lock:
+            with self._lock:
+                if key in self._handles:
+                    return self._lookup(key)
+            value = open_handle()
+            size = self._size_of(value) if self.max_bytes is not None else 0
+            with self._lock:
+                self._handles[key] = (value, size)
+                self.current_bytes += size
+                self._opening.pop(key, None)
+                if self.max_bytes is not None and self.current_bytes > self.max_bytes:
+                    self._evict(key)
+        return value
+
+    def _evict(self, new_key):
+        group = new_key[1:2]
+        for key in [k for k in self._handles if k[1:2] != group]:
+            if self.current_bytes <= self.max_bytes:
+                break
+            _, evicted_size = self._handles.pop(key)
+            self.current_bytes -= evicted_size
+
+
+class BackgroundLoader:
+    """Open values of a HandlePool in a thread pool, so that callbacks can return before heavy files are
+    opened. The opening functions report their progress, which the apps show while polling the status.
+    """
+
+    def __init__(self, handles, workers=2):
+        self.handles = handles
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cryosiam_vis_loader')
+        self._futures = {}
+        self._progress = {}
+        self._lock = threading.Lock()
+
+    def submit(self, key, open_handle, retry=False):
+        """Start opening the value for the key in the background, unless it is open or being opened. A failed
+        opening is kept (and reported by status) until it is retried explicitly.
+        :param key: the key, for ex. ('volumes', filename)
+        :type key: tuple
+        :param open_handle: function that opens the value, called with a report(fraction, message) function
+        :type open_handle: callable
+        :param retry: whether to open the value again if the previous opening failed
+        :type retry: bool
+        :return: the future of the value
+        :rtype: concurrent.futures.Future
+        """
+        with self._lock:
+            future = self._futures.get(key)
+            if future is not None and (not future.done() or
+                                       (future.exception() is None and key in self.handles) or
+                                       (future.exception() is not None and not retry)):
+                return future
+            self._progress[key] = (0., 'Waiting')
+            future = self._executor.submit(self.handles.get, key,
+                                           lambda: open_handle(lambda fraction, message:
+                                                               self.report(key, fraction, message)))
+            self._futures[key] = future
+        return future
+
+    def report(self, key, fraction, message):
+        with self._lock:
+            self._progress[key] = (fraction, message)
+
+    def status(self, key):
+        """Get the loading status of the value for the key.
+        :param key: the key
+        :type key: tuple
+        :return: dictionary with 'done', 'fraction', 'message', 'error' (None if there was no error) and
+                 'started' (False if the value is not open and its opening was not started in this process)
+        :rtype: dict
+        """
+        if key in self.handles:
+            return {'done': True, 'fraction': 1., 'message': 'Loaded', 'error': None, 'started': True}
+        with self._lock:
+            future = self._futures.get(key)
+            fraction, message = self._progress.get(key, (0., 'Waiting'))
+        if future is None:
+            return {'done': True, 'fraction': 0., 'message': message, 'error': None, 'started': False}
+        if future is not None and future.done():
+            if future.exception() is not None:
+                return {'done': True, 'fraction': fraction, 'message': message, 'error': str(future.exception()),
+                        'started': True}
+            return {'done': True, 'fraction': 1., 'message': 'Loaded', 'error': None, 'started': True}
+        return {'done': False, 'fraction': fraction, 'message': message, 'error': None, 'started': True}
+
+
+class SessionTaskQueue:
+    """Run background tasks of the sessions in a thread pool. A task is a list of steps, and a new task of
+    a session supersedes its earlier tasks: they stop before their next step. Used to prefetch the
+    particles around the one selected in a session.
+    """
+
+    def __init__(self, workers=1):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='cryosiam_vis_tasks')
+        self._tokens = {}
+        self._lock = threading.Lock()
+
+    def submit(self, session_id, steps):
+        """Run the steps of a task in the background, superseding the earlier tasks of the session.
+        :param session_id: the session id
+        :type session_id: str
+        :param steps: functions without arguments, called in order
+        :type steps: list
+        :return: the future of the task
+        :rtype: concurrent.futures.Future
+        """
+        token = object()
+        with self._lock:
+            self._tokens[session_id] = token
+            while len(self._tokens) > MAX_SESSIONS:
+                self._tokens.pop(next(iter(self._tokens)))
+
+        def run():
+            for step in steps:
+                if self._tokens.get(session_id) is not token:
+                    return
+                step()
+
+        return self._executor.submit(run)
+
+
+def next_files(files, selected_file, count):
+    """Get the files following the selected file in a list, used for prefetching.
+    :param files: the list of files
+    :type files: list
+    :param selected_file: the selected file
+    :type selected_file: str
+    :param count: number of files
+    :type count: int
+    :return: list with at most count files
+    :rtype: list
+    """
+    if selected_file not in files or count <= 0:
+        return []
+    start = files.index(selected_file) + 1
+    return files[start:start + count]
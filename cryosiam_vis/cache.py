@@ -0,0 +1,119 @@
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import Future
+
+DEFAULT_CACHE_SIZE_MB = 512
+
+
+def estimate_size(value):
+    """Estimate the memory used by a cached value in bytes. Numpy arrays count with their buffer size,
+    serialized figures (as returned by figure_payload) with the size of their arrays and strings.
+    :param value: the cached value
+    :type value: object
+    :return: the estimated size in bytes
+    :rtype: int
+    """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, (tuple, list)):
+        return sum(estimate_size(v) for v in value)
+    if isinstance(value, dict):
+        return sum(estimate_size(k) + estimate_size(v) for k, v in value.items())
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    if isinstance(value, (bool, int, float)):
+        return 8
+    return 64
+
+
+class LRUCache:
+    """Thread-safe least recently used cache with a budget in bytes. When the budget is exceeded, the least
+    recently used entries are evicted. Used to share extracted particles and serialized figures between
+    the Dash callbacks. Values being computed by get_or_compute are tracked, so concurrent requests for the
+    same key (for ex. a callback and the prefetcher) wait for the first computation instead of repeating it.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_SIZE_MB * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        self._lock = threading.RLock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def put(self, key, value, size=None):
+        size = estimate_size(value) if size is None else size
+        with self._lock:
+            if key in self._entries:
+                self.current_bytes -= self._entries.pop(key)[1]
+            if size > self.max_bytes:
+                return value
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            while self.current_bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.current_bytes -= evicted_size
+        return value
+
+    def get_or_compute(self, key, compute):
+        """Get the value for the key, computing and caching it with compute() on a miss.
+        :param key: the cache key
+        :type key: tuple
+        :param compute: function without arguments that computes the value
+        :type compute: callable
+        :return: the cached or computed value
+        :rtype: object
+        """
+        with self._lock:
+            value = self.get(key, self)
+            if value is not self:
+                return value
+            pending = self._pending.get(key)
+            if pending is None:
+                future = self._pending[key] = Future()
+        if pending is not None:
+            return pending.result()
+        try:
+            value = self.put(key, compute())
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(value)
+        finally:
+            with self._lock:
+                self._pending.pop(key, None)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+
+def cache_from_config(config):
+    """Create the particle cache with the budget from the 'particle_cache_size_mb' key of the config.
+    :param config: the loaded configuration
+    :type config: dict
+    :return: the cache
+    :rtype: LRUCache
+    """
+    return LRUCache(int(config.get('particle_cache_size_mb', DEFAULT_CACHE_SIZE_MB) * 1024 ** 2))
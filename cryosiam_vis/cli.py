@@ -1,16 +1,76 @@
+import os
 import argparse
 
-from cryosiam_vis.visualize_semantic_segmentation import main as visualize_semantic_segmentation
-from cryosiam_vis.visualize_denoised_tomogram import main as visualize_denoising
-from cryosiam_vis.visualize_instance_segmentation import main as visualize_instance_segmentation
-from cryosiam_vis.visualize_filtered_instance_segmentation import main as visualize_filtered_instance_segmentation
-from cryosiam_vis.visualize_coordinates_from_star_file import main as visualize_coordinates_from_star_file
-from cryosiam_vis.visualize_embeddings import main as visualize_embeddings
-from cryosiam_vis.visualize_clusters import main as visualize_embeddings_clusters
-
 __version__ = "1.0"
 
 
+def visualize_denoising(args):
+    from cryosiam_vis.visualize_denoised_tomogram import main
+    main(args.config_file, args.filename, args.out_of_core)
+
+
+def visualize_semantic_segmentation(args):
+    from cryosiam_vis.visualize_semantic_segmentation import main
+    main(args.config_file, args.filename, args.out_of_core)
+
+
+def visualize_instance_segmentation(args):
+    from cryosiam_vis.visualize_instance_segmentation import main
+    main(args.config_file, args.filename, args.out_of_core)
+
+
+def visualize_filtered_instance_segmentation(args):
+    from cryosiam_vis.visualize_filtered_instance_segmentation import main
+    main(args.config_file, args.filename, args.out_of_core)
+
+
+def visualize_coordinates_from_star_file(args):
+    from cryosiam_vis.visualize_coordinates_from_star_file import main
+    main(args.config_file, args.filename, args.point_size, args.out_of_core)
+
+
+def visualize_embeddings(args):
+    from cryosiam_vis.visualize_embeddings import main
+    main(args.config_file, args.host, args.port, args.workers, args.threads)
+
+
+def visualize_embeddings_clusters(args):
+    from cryosiam_vis.visualize_clusters import main
+    main(args.config_file, args.clustering, args.host, args.port, args.workers, args.threads)
+
+
+def rechunk_predictions(args):
+    from cryosiam_vis.io_utils import rechunk_h5_file
+    rechunk_h5_file(args.input_file, args.output_file, args.chunk_size)
+
+
+def particle_gallery(args):
+    from cryosiam_vis.particle_gallery import main
+    main(args)
+
+
+def thumbnail_atlas(args):
+    from cryosiam_vis.thumbnail_atlas import main
+    main(args)
+
+
+def add_out_of_core_argument(parser):
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='Read the volumes chunk by chunk while browsing instead of loading them into memory '
+                             '(requires dask)')
+
+
+def add_serving_arguments(parser, port):
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1',
+                        help='Host the app listens on')
+    parser.add_argument('--port', type=int, required=False, default=port,
+                        help='Port the app listens on')
+    parser.add_argument('--workers', type=int, required=False, default=None,
+                        help='Number of worker processes, serves the app with gunicorn instead of the development server')
+    parser.add_argument('--threads', type=int, required=False, default=None,
+                        help='Number of threads per worker process, serves the app with gunicorn instead of the development server')
+
+
 def main():
     parser = argparse.ArgumentParser(prog="cryosiam-vis", description="CryoSiam Vis Command Line Interface")
     parser.add_argument("--version", action="version", version=f"CryoSiam-Vis {__version__}")
@@ -23,7 +83,8 @@ def main():
                             help='Path to the .yaml configuration file that was used while running CryoSiam denoise_predict command')
     sp_denoise.add_argument('--filename', type=str, required=True,
                             help='The filename of the tomogram to be visualized')
-    sp_denoise.set_defaults(func=lambda args: visualize_denoising(args.config_file, args.filename))
+    add_out_of_core_argument(sp_denoise)
+    sp_denoise.set_defaults(func=visualize_denoising)
 
     # visualize_semantic subcommand
     sp_semantic = subparsers.add_parser("visualize_semantic",
@@ -32,7 +93,8 @@ def main():
                              help='Path to the .yaml configuration file that was used while running CryoSiam semantic_predict command')
     sp_semantic.add_argument('--filename', type=str, required=True,
                              help='The filename of the tomogram to be visualized')
-    sp_semantic.set_defaults(func=lambda args: visualize_semantic_segmentation(args.config_file, args.filename))
+    add_out_of_core_argument(sp_semantic)
+    sp_semantic.set_defaults(func=visualize_semantic_segmentation)
 
     # visualize_instance subcommand
     sp_instance = subparsers.add_parser("visualize_instance",
@@ -41,7 +103,8 @@ def main():
                              help='Path to the .yaml configuration file that was used while running CryoSiam instance_predict command')
     sp_instance.add_argument('--filename', type=str, required=True,
                              help='The filename of the tomogram to be visualized')
-    sp_instance.set_defaults(func=lambda args: visualize_instance_segmentation(args.config_file, args.filename))
+    add_out_of_core_argument(sp_instance)
+    sp_instance.set_defaults(func=visualize_instance_segmentation)
 
     #visualize_filtered_instances subcommand
     sp_instance = subparsers.add_parser("visualize_filtered_instance",
@@ -50,7 +113,8 @@ def main():
                              help='Path to the .yaml configuration file that was used while running CryoSiam instance_filter command')
     sp_instance.add_argument('--filename', type=str, required=True,
                              help='The filename of the tomogram to be visualized')
-    sp_instance.set_defaults(func=lambda args: visualize_filtered_instance_segmentation(args.config_file, args.filename))
+    add_out_of_core_argument(sp_instance)
+    sp_instance.set_defaults(func=visualize_filtered_instance_segmentation)
 
     # visualize_coordinates
     sp_coordinates = subparsers.add_parser("visualize_coordinates",
@@ -61,15 +125,16 @@ def main():
                         help='Tomogram filename (including the file extension')
     sp_coordinates.add_argument('--point_size', type=str, required=False, default=15,
                         help='Size of the points to be plotted in napari')
-    sp_coordinates.set_defaults(
-        func=lambda args: visualize_coordinates_from_star_file(args.config_file, args.filename, args.point_size))
+    add_out_of_core_argument(sp_coordinates)
+    sp_coordinates.set_defaults(func=visualize_coordinates_from_star_file)
 
     # visualize_embeddings
     sp_embeddings = subparsers.add_parser("visualize_embeddings",
                                           help="Run visualization of the predicted embeddings")
     sp_embeddings.add_argument('--config_file', type=str, required=True,
                              help='Path to the .yaml configuration file that was used while running CryoSiam simsiam_visualize_embeddings command')
-    sp_embeddings.set_defaults(func=lambda args: visualize_embeddings(args.config_file))
+    add_serving_arguments(sp_embeddings, port=8050)
+    sp_embeddings.set_defaults(func=visualize_embeddings)
 
     # visualize_embeddings_clusters
     sp_embeddings = subparsers.add_parser("visualize_embeddings_clusters",
@@ -78,8 +143,55 @@ def main():
                                help='Path to the .yaml configuration file that was used while running CryoSiam cluster embeddings command')
     sp_embeddings.add_argument('--clustering', type=str, required=True,
                                help='clustering type, one of ["kmeans", "spectral"]')
+    add_serving_arguments(sp_embeddings, port=8052)
+    sp_embeddings.set_defaults(func=visualize_embeddings_clusters)
+
+    # rechunk_predictions
+    sp_rechunk = subparsers.add_parser("rechunk_predictions",
+                                       help="Write a chunked and compressed copy of a prediction .h5 file")
+    sp_rechunk.add_argument('--input_file', type=str, required=True,
+                            help='Path to the prediction .h5 file, for ex. a *_instance_preds.h5 file')
+    sp_rechunk.add_argument('--output_file', type=str, required=True,
+                            help='Path to the output .h5 file')
+    sp_rechunk.add_argument('--chunk_size', type=int, required=False, default=64,
+                            help='Edge length of the cubic chunks')
+    sp_rechunk.set_defaults(func=rechunk_predictions)
+
+    # particle_gallery
+    sp_gallery = subparsers.add_parser("particle_gallery",
+                                       help="Render a static HTML gallery of the particles without a display")
+    sp_gallery.add_argument('--config', type=str, required=True,
+                            help='Path to the .yaml configuration file that was used while running CryoSiam')
+    sp_gallery.add_argument('--output_dir', type=str, required=True,
+                            help='Path to the output folder of the gallery')
+    sp_gallery.add_argument('--tomo', type=str, required=False, nargs='+', default=None,
+                            help='Tomogram filenames (including the file extension) whose instances are rendered')
+    sp_gallery.add_argument('--clustering', type=str, required=False, default=None,
+                            help='clustering type, one of ["kmeans", "spectral"], renders the clustered particles '
+                                 'grouped by cluster')
+    sp_gallery.add_argument('--semantic_folder', type=str, required=False, default=None,
+                            help='Folder with the *_preds.h5 semantic segmentations, used to group the instances by '
+                                 'semantic class')
+    sp_gallery.add_argument('--mask', action='store_true',
+                            help='Mask out the voxels outside the instances')
+    sp_gallery.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                            help='Number of worker processes')
+    sp_gallery.add_argument('--batch_size', type=int, required=False, default=64,
+                            help='Number of particles rendered per task')
+    sp_gallery.set_defaults(func=particle_gallery)
 
-    sp_embeddings.set_defaults(func=lambda args: visualize_embeddings_clusters(args.config_file, args.clustering))
+    # thumbnail_atlas
+    sp_atlas = subparsers.add_parser("thumbnail_atlas",
+                                     help="Build the thumbnail atlases shown on hover in the UMAP plots")
+    sp_atlas.add_argument('--config', type=str, required=True,
+                          help='Path to the .yaml configuration file that was used while running CryoSiam')
+    sp_atlas.add_argument('--tomo', type=str, required=True, nargs='+',
+                          help='Tomogram filenames (including the file extension)')
+    sp_atlas.add_argument('--mask', action='store_true',
+                          help='Mask out the voxels outside the instances')
+    sp_atlas.add_argument('--workers', type=int, required=False, default=4,
+                          help='Number of worker threads')
+    sp_atlas.set_defaults(func=thumbnail_atlas)
 
     args = parser.parse_args()
     # Run selected command
@@ -0,0 +1,178 @@
+import os
+import math
+import numpy as np
+from scipy import ndimage as ndi
+
+from cryosiam_vis.io_utils import open_h5_dataset, read_roi, cache_path, source_signature
+from cryosiam_vis.instrumentation import staged
+
+
+@staged('stage/build_instance_index')
+def build_instance_index(instances, slab_size=None):
+    """Compute the bounding box and the voxel count of every instance in a label volume.
+    The index is built with ndi.find_objects, so that particle extraction afterwards only needs to
+    touch the bounding box of the particle instead of the whole tomogram. HDF5 datasets and memory-mapped
+    arrays are processed in slabs along the first axis, so the whole volume is never held in memory.
+    :param instances: instance segmentation volume (0 is background)
+    :type instances: np.array or h5py.Dataset
+    :param slab_size: number of slices processed at once, by default the whole numpy array or
+                      64 slices (rounded up to the chunk size) for HDF5 datasets and memory-mapped arrays
+    :type slab_size: int
+    :return: dictionary with 'bboxes', an array of shape (max_id + 1, 3, 2) holding the start/stop
+             of every axis (-1 for ids that are not present), and 'counts', the voxel count per id
+    :rtype: dict
+    """
+    if slab_size is None:
+        if isinstance(instances, np.ndarray) and not isinstance(instances, np.memmap):
+            slab_size = instances.shape[0]
+        else:
+            chunks = getattr(instances, 'chunks', None)
+            chunk = chunks[0] if chunks else 1
+            slab_size = -(-64 // chunk) * chunk
+    bboxes = np.full((1, len(instances.shape), 2), -1, dtype=np.int64)
+    counts = np.zeros(1, dtype=np.int64)
+    for start in range(0, instances.shape[0], slab_size):
+        slab = np.asarray(instances[start:start + slab_size])
+        if not np.issubdtype(slab.dtype, np.integer):
+            slab = slab.astype(np.int64)
+        objects = ndi.find_objects(slab)
+        if len(objects) + 1 > len(bboxes):
+            bboxes = np.concatenate([bboxes, np.full((len(objects) + 1 - len(bboxes),) + bboxes.shape[1:], -1,
+                                                     dtype=np.int64)])
+            counts = np.concatenate([counts, np.zeros(len(bboxes) - len(counts), dtype=np.int64)])
+        for i, slices in enumerate(objects, start=1):
+            if slices is None:
+                continue
+            box = np.array([(s.start, s.stop) for s in slices], dtype=np.int64)
+            box[0] += start
+            if bboxes[i, 0, 0] < 0:
+                bboxes[i] = box
+            else:
+                bboxes[i, :, 0] = np.minimum(bboxes[i, :, 0], box[:, 0])
+                bboxes[i, :, 1] = np.maximum(bboxes[i, :, 1], box[:, 1])
+        slab_counts = np.bincount(slab.ravel().astype(np.intp, copy=False))
+        counts[:len(slab_counts)] += slab_counts[:len(counts)]
+    return {'bboxes': bboxes, 'counts': counts}
+
+
+def label_histogram(labels, slab_size=64):
+    """Count the voxels of every label value with a single pass over the volume (processed in slabs
+    along the first axis, so HDF5 datasets are never fully loaded). Slabs of non-negative integer labels
+    are counted with np.bincount, slabs with negative or non-integer labels with np.unique.
+    :param labels: label volume
+    :type labels: np.array or h5py.Dataset
+    :param slab_size: number of slices processed at once
+    :type slab_size: int
+    :return: the sorted label values present in the volume and their voxel counts
+    :rtype: tuple
+    """
+    counts = np.zeros(1, dtype=np.int64)
+    other_values, other_counts = [], []
+    for start in range(0, labels.shape[0], slab_size):
+        slab = np.asarray(labels[start:start + slab_size]).ravel()
+        if slab.size == 0:
+            continue
+        if np.issubdtype(slab.dtype, np.unsignedinteger) or \
+                (np.issubdtype(slab.dtype, np.integer) and slab.min() >= 0):
+            slab_counts = np.bincount(slab.astype(np.intp, copy=False))
+            if len(slab_counts) > len(counts):
+                counts = np.concatenate([counts, np.zeros(len(slab_counts) - len(counts), dtype=np.int64)])
+            counts[:len(slab_counts)] += slab_counts
+        else:
+            slab_values, slab_counts = np.unique(slab, return_counts=True)
+            other_values.append(slab_values)
+            other_counts.append(slab_counts)
+    values = np.flatnonzero(counts)
+    if not other_values:
+        return values, counts[values]
+    values, inverse = np.unique(np.concatenate([values] + other_values), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts[np.flatnonzero(counts)]] + other_counts),
+                         minlength=len(values)).astype(np.int64)
+    return values, counts
+
+
+@staged('stage/load_instance_index')
+def load_instance_index(instances_file, instances=None):
+    """Load the instance index of an *_instance_preds.h5 file from its cache file, or build it and
+    store it in the cache. The cache is invalidated when the modification time or the size of the
+    instances file change.
+    :param instances_file: path to the *_instance_preds.h5 file
+    :type instances_file: str
+    :param instances: the opened instances dataset (opened from instances_file if not given)
+    :type instances: np.array or h5py.Dataset
+    :return: the instance index
+    :rtype: dict
+    """
+    index_file = cache_path(instances_file, '.index.npz')
+    signature = source_signature(instances_file)
+    if os.path.exists(index_file):
+        with np.load(index_file) as cached:
+            if np.array_equal(cached['signature'], signature):
+                return {'bboxes': cached['bboxes'], 'counts': cached['counts']}
+    if instances is None:
+        instances = open_h5_dataset(instances_file, 'instances')
+    index = build_instance_index(instances)
+    try:
+        os.makedirs(os.path.dirname(index_file), exist_ok=True)
+        np.savez(index_file, signature=signature, **index)
+    except OSError:
+        pass
+    return index
+
+
+def get_instance_slices(index, instance_ids):
+    """Get the bounding box of one or several instances from the instance index.
+    :param index: instance index computed with build_instance_index
+    :type index: dict
+    :param instance_ids: instance id or list of instance ids
+    :type instance_ids: int or list
+    :return: tuple of slices covering all the given instances or None if none of them is present
+    :rtype: tuple
+    """
+    ids = np.atleast_1d(np.asarray(instance_ids, dtype=np.int64))
+    ids = ids[(ids > 0) & (ids < len(index['bboxes']))]
+    boxes = index['bboxes'][ids]
+    boxes = boxes[boxes[:, 0, 0] >= 0]
+    if len(boxes) == 0:
+        return None
+    return tuple(slice(int(start), int(stop)) for start, stop in
+                 zip(boxes[:, :, 0].min(axis=0), boxes[:, :, 1].max(axis=0)))
+
+
+@staged('stage/pad_patch')
+def pad_patch(patch, patch_size=(64, 64, 64)):
+    """Center the patch in a zero padded volume of the given size (larger patches are cropped).
+    :param patch: the patch to be padded
+    :type patch: np.array
+    :param patch_size: the size of the output patch
+    :type patch_size: tuple
+    :return: padded patch
+    :rtype: np.array
+    """
+    pad_size = tuple([(max(math.ceil((p - b) / 2), 0), max(math.floor((p - b) / 2), 0)) for p, b in
+                      zip(patch_size, patch.shape)])
+    return np.pad(patch, pad_size, 'constant')[:patch_size[0], :patch_size[1], :patch_size[2]]
+
+
+@staged('stage/extract_particle')
+def extract_particle(tomo, instances, index, instance_ids, patch_size=(64, 64, 64)):
+    """Extract the subtomogram and the mask of one or several instances using the instance index.
+    :param tomo: the tomogram
+    :type tomo: np.array
+    :param instances: instance segmentation of the tomogram
+    :type instances: np.array or h5py.Dataset
+    :param index: instance index computed with build_instance_index
+    :type index: dict
+    :param instance_ids: instance id or list of instance ids
+    :type instance_ids: int or list
+    :param patch_size: the size of the output patches
+    :type patch_size: tuple
+    :return: padded subtomogram and the padded uint8 mask of the instances
+    :rtype: tuple
+    """
+    slices = get_instance_slices(index, instance_ids)
+    if slices is None:
+        return np.zeros(patch_size, dtype=tomo.dtype), np.zeros(patch_size, dtype=np.uint8)
+    sub_mask = np.isin(read_roi(instances, slices), instance_ids).astype(np.uint8)
+    subtomo = np.array(tomo[slices])
+    return pad_patch(subtomo, patch_size), pad_patch(sub_mask, patch_size)
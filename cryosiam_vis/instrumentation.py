@@ -0,0 +1,332 @@
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+import tracemalloc
+from functools import wraps
+from contextlib import nullcontext
+from collections import deque
+from logging.handlers import RotatingFileHandler
+
+METRICS_ENV = 'CRYOSIAM_VIS_METRICS'
+METRICS_LOG_ENV = 'CRYOSIAM_VIS_METRICS_LOG'
+METRICS_WINDOW = 1000
+METRICS_LOG_MAX_BYTES = 10 * 1024 ** 2
+METRICS_LOG_BACKUPS = 3
+
+_recorder = None
+
+
+class _Frame:
+    __slots__ = ('name', 'start', 'base', 'peak', 'payload_bytes')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = 0.0
+        self.base = 0
+        self.peak = 0
+        self.payload_bytes = None
+
+
+class MetricsRecorder:
+    """Records the wall time, the peak allocated memory (traced with tracemalloc) and the payload size of
+    the stages of an app, i.e. the Dash callbacks, the requests serving them (including the JSON
+    serialization of the response) and the internal steps marked with stage or staged.
+    Every record is appended as a json line to a rotating log file, and aggregated per stage for the
+    /metrics endpoint. The peak memory of a stage is the peak of the whole process while the stage runs,
+    so stages running concurrently in other threads are included. The tracemalloc peak is process global
+    and is reset whenever a stage starts or stops, so the peaks are approximate when the app is served with
+    several threads (a stage can miss the part of its peak reached before another stage reset it).
+    """
+
+    def __init__(self, log_file=None, trace_memory=True, window=METRICS_WINDOW,
+                 max_bytes=METRICS_LOG_MAX_BYTES, backup_count=METRICS_LOG_BACKUPS):
+        """
+        :param log_file: path to the log file, no log file is written if None
+        :type log_file: str
+        :param trace_memory: whether to trace the allocated memory (slows down allocation heavy code)
+        :type trace_memory: bool
+        :param window: number of the latest records per stage used for the percentiles
+        :type window: int
+        :param max_bytes: size of the log file at which it is rotated
+        :type max_bytes: int
+        :param backup_count: number of rotated log files kept
+        :type backup_count: int
+        """
+        self.trace_memory = trace_memory
+        self.window = window
+        self.log_file = log_file
+        self._lock = threading.Lock()
+        self._active = set()
+        self._stats = {}
+        self._logger = None
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if log_file is not None:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            self._logger = logging.getLogger(f'cryosiam_vis.metrics.{os.path.abspath(log_file)}')
+            self._logger.propagate = False
+            self._logger.setLevel(logging.INFO)
+            if not self._logger.handlers:
+                handler = RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count)
+                handler.setFormatter(logging.Formatter('%(message)s'))
+                self._logger.addHandler(handler)
+
+    def _update_peaks(self):
+        current, peak = tracemalloc.get_traced_memory()
+        for frame in self._active:
+            frame.peak = max(frame.peak, peak)
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        return current
+
+    def start(self, name):
+        frame = _Frame(name)
+        if self.trace_memory:
+            with self._lock:
+                frame.base = frame.peak = self._update_peaks()
+                self._active.add(frame)
+        frame.start = time.perf_counter()
+        return frame
+
+    def stop(self, frame):
+        seconds = time.perf_counter() - frame.start
+        peak_bytes = None
+        if self.trace_memory:
+            with self._lock:
+                self._update_peaks()
+                self._active.discard(frame)
+            peak_bytes = max(0, frame.peak - frame.base)
+        self.record(frame.name, seconds, peak_bytes, frame.payload_bytes)
+
+    def stage(self, name):
+        """Measure a block of code as a stage.
+        :param name: name of the stage
+        :type name: str
+        :return: context manager yielding the frame of the stage (its payload_bytes can be set)
+        """
+        return _StageContext(self, name)
+
+    def record(self, name, seconds, peak_bytes=None, payload_bytes=None):
+        """Store a measurement of a stage.
+        :param name: name of the stage
+        :type name: str
+        :param seconds: wall time in seconds
+        :type seconds: float
+        :param peak_bytes: peak allocated memory in bytes
+        :type peak_bytes: int
+        :param payload_bytes: size of the response in bytes
+        :type payload_bytes: int
+        """
+        with self._lock:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0,
+                                             'max_peak_bytes': 0, 'payload_count': 0, 'total_payload_bytes': 0,
+                                             'seconds': deque(maxlen=self.window)}
+            stats['count'] += 1
+            stats['total_seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['seconds'].append(seconds)
+            if peak_bytes is not None:
+                stats['max_peak_bytes'] = max(stats['max_peak_bytes'], peak_bytes)
+            if payload_bytes is not None:
+                stats['payload_count'] += 1
+                stats['total_payload_bytes'] += payload_bytes
+        if self._logger is not None:
+            self._logger.info(json.dumps({'time': time.time(), 'pid': os.getpid(), 'stage': name,
+                                          'seconds': seconds, 'peak_bytes': peak_bytes,
+                                          'payload_bytes': payload_bytes}))
+
+    def summary(self):
+        """Aggregate the records of every stage.
+        :return: dictionary mapping the stage names to their count, mean, median, 95th percentile and
+                 maximum wall time, maximum peak memory and mean payload size (for stages with a payload)
+        :rtype: dict
+        """
+        with self._lock:
+            stats = {name: dict(s, seconds=sorted(s['seconds'])) for name, s in self._stats.items()}
+        summary = {}
+        for name, s in sorted(stats.items()):
+            latest = s['seconds']
+            summary[name] = {'count': s['count'], 'mean_seconds': s['total_seconds'] / s['count'],
+                             'p50_seconds': latest[len(latest) // 2],
+                             'p95_seconds': latest[min(len(latest) - 1, int(len(latest) * 0.95))],
+                             'max_seconds': s['max_seconds'], 'max_peak_bytes': s['max_peak_bytes']}
+            if s['payload_count']:
+                summary[name]['mean_payload_bytes'] = s['total_payload_bytes'] / s['payload_count']
+        return summary
+
+    def prometheus(self):
+        """Format the summary in the Prometheus text format.
+        :return: the metrics text
+        :rtype: str
+        """
+        lines = []
+        for name, s in self.summary().items():
+            stage = name.replace('\\', '\\\\').replace('"', '\\"')
+            for key, value in s.items():
+                lines.append(f'cryosiam_vis_{key}{{stage="{stage}"}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def instrument(self, app):
+        """Instrument a Dash app. Must be called before the callbacks are registered: every callback
+        registered with app.callback is recorded as 'callback/<function name>', and every callback request
+        as 'request/<function name>' (including the JSON serialization, with the response size as payload).
+        The summary is served on /metrics (Prometheus text format) and /metrics/json.
+        :param app: the Dash app
+        :type app: Dash
+        """
+        import flask
+
+        register = app.callback
+
+        def callback(*args, **kwargs):
+            decorator = register(*args, **kwargs)
+
+            def wrap(func):
+                return decorator(self.staged(f'callback/{func.__name__}')(func))
+
+            return wrap
+
+        app.callback = callback
+        server = app.server
+
+        @server.before_request
+        def start_request():
+            if flask.request.path.endswith('/_dash-update-component'):
+                body = flask.request.get_json(silent=True) or {}
+                callback_spec = app.callback_map.get(body.get('output'), {})
+                name = getattr(callback_spec.get('callback'), '__name__', body.get('output'))
+                flask.g.metrics_frame = self.start(f'request/{name}')
+
+        @server.after_request
+        def stop_request(response):
+            frame = flask.g.pop('metrics_frame', None)
+            if frame is not None:
+                frame.payload_bytes = response.calculate_content_length()
+                self.stop(frame)
+            return response
+
+        server.add_url_rule('/metrics', 'cryosiam_vis_metrics',
+                            lambda: flask.Response(self.prometheus(), mimetype='text/plain'))
+        server.add_url_rule('/metrics/json', 'cryosiam_vis_metrics_json', lambda: flask.jsonify(self.summary()))
+
+    def staged(self, name):
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+
+class _StageContext:
+    __slots__ = ('recorder', 'name', 'frame')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+        self.frame = None
+
+    def __enter__(self):
+        self.frame = self.recorder.start(self.name)
+        return self.frame
+
+    def __exit__(self, *exc):
+        self.recorder.stop(self.frame)
+        return False
+
+
+def metrics_enabled(config):
+    """Check whether the instrumentation is enabled with the CRYOSIAM_VIS_METRICS environment variable or
+    with the 'metrics' key of the config.
+    :param config: the loaded configuration
+    :type config: dict
+    :return: whether the instrumentation is enabled
+    :rtype: bool
+    """
+    value = os.environ.get(METRICS_ENV)
+    if value is not None:
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return bool(config.get('metrics', False))
+
+
+def default_metrics_log(name):
+    """Get the default path of the metrics log file of an app.
+    :param name: name of the app
+    :type name: str
+    :return: path to the log file
+    :rtype: str
+    """
+    return os.path.join(tempfile.gettempdir(), 'cryosiam_vis_metrics', f'{name}.log')
+
+
+def worker_log_file(log_file):
+    """Get the log file of the current process, with the process id added before the extension, for ex.
+    embeddings.1234.log. Every worker process writes its own log file, as rotating a log file shared by
+    several processes loses records.
+    :param log_file: path to the log file
+    :type log_file: str
+    :return: path to the log file of the process
+    :rtype: str
+    """
+    root, ext = os.path.splitext(log_file)
+    return f'{root}.{os.getpid()}{ext or ".log"}'
+
+
+def metrics_from_config(config, name):
+    """Create the metrics recorder of an app if the instrumentation is enabled, and make it the recorder of
+    the stage and staged helpers. The log file is taken from the CRYOSIAM_VIS_METRICS_LOG environment
+    variable or the 'metrics_log_file' key of the config (with the process id added, see worker_log_file),
+    and memory tracing can be switched off with the 'metrics_trace_memory' key.
+    :param config: the loaded configuration
+    :type config: dict
+    :param name: name of the app, used for the default log file
+    :type name: str
+    :return: the recorder, or None if the instrumentation is disabled
+    :rtype: MetricsRecorder
+    """
+    global _recorder
+    if not metrics_enabled(config):
+        return None
+    if _recorder is None:
+        log_file = os.environ.get(METRICS_LOG_ENV) or config.get('metrics_log_file') or default_metrics_log(name)
+        _recorder = MetricsRecorder(worker_log_file(log_file), bool(config.get('metrics_trace_memory', True)))
+    return _recorder
+
+
+def stage(name):
+    """Measure a block of code as a stage of the active recorder (does nothing when the instrumentation
+    is disabled).
+    :param name: name of the stage
+    :type name: str
+    :return: context manager
+    """
+    return nullcontext() if _recorder is None else _recorder.stage(name)
+
+
+def staged(name):
+    """Decorator measuring every call of a function as a stage of the active recorder (the function is
+    called directly when the instrumentation is disabled).
+    :param name: name of the stage
+    :type name: str
+    :return: the decorator
+    :rtype: callable
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return func(*args, **kwargs)
+            with _recorder.stage(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,158 @@
+import os
+import h5py
+import mrcfile
+import numpy as np
+
+from cryosiam_vis.instrumentation import staged
+
+H5_CHUNK_CACHE_SIZE = 64 * 1024 ** 2
+CACHE_FOLDER_NAME = '.cryosiam_vis_cache'
+
+
+@staged('stage/load_tomogram')
+def load_tomogram(file_path):
+    """Open a tomogram in MRC or REC file format as a read-only memory-mapped numpy array.
+    Only the parts of the volume that are accessed are read from disk, and the file handle is
+    closed immediately (the memory map stays valid for as long as the array is referenced).
+    :param file_path: path to the file
+    :type file_path: str
+    :return: the tomogram as memory-mapped numpy array
+    :rtype: np.memmap
+    """
+    with mrcfile.mmap(file_path, mode='r', permissive=True) as m:
+        return m.data
+
+
+def open_h5_dataset(file_path, dataset_name, chunk_cache_size=H5_CHUNK_CACHE_SIZE):
+    """Open a dataset from an HDF5 file without reading it. The file stays open for as long as the
+    dataset is referenced, and slicing the dataset only reads the requested hyperslab.
+    :param file_path: path to the HDF5 file
+    :type file_path: str
+    :param dataset_name: name of the dataset, for ex. 'instances'
+    :type dataset_name: str
+    :param chunk_cache_size: size of the HDF5 raw data chunk cache in bytes
+    :type chunk_cache_size: int
+    :return: the dataset
+    :rtype: h5py.Dataset
+    """
+    f = h5py.File(file_path, 'r', rdcc_nbytes=chunk_cache_size, rdcc_nslots=10007)
+    return f[dataset_name]
+
+
+def open_h5_memmap(file_path, dataset_name, chunk_cache_size=H5_CHUNK_CACHE_SIZE):
+    """Open a dataset from an HDF5 file read-only. Contiguous uncompressed datasets are returned as
+    memory-mapped numpy arrays, so that several processes reading the same file share its pages in
+    the operating system cache. Chunked or compressed datasets are returned as h5py datasets.
+    :param file_path: path to the HDF5 file
+    :type file_path: str
+    :param dataset_name: name of the dataset, for ex. 'instances'
+    :type dataset_name: str
+    :param chunk_cache_size: size of the HDF5 raw data chunk cache in bytes (for chunked datasets)
+    :type chunk_cache_size: int
+    :return: the dataset
+    :rtype: np.memmap or h5py.Dataset
+    """
+    dataset = open_h5_dataset(file_path, dataset_name, chunk_cache_size)
+    offset = dataset.id.get_offset()
+    if dataset.chunks is not None or offset is None:
+        return dataset
+    data = np.memmap(file_path, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+    dataset.file.close()
+    return data
+
+
+def advise_willneed(file_path):
+    """Ask the operating system to read a file into the page cache in the background, so that later
+    reads through memory maps do not wait for the disk. Does nothing on systems without posix_fadvise.
+    :param file_path: path to the file
+    :type file_path: str
+    """
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    fd = os.open(file_path, os.O_RDONLY)
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+@staged('stage/read_roi')
+def read_roi(volume, slices):
+    """Read a region of interest from a numpy array or an HDF5 dataset. For chunked datasets the read
+    is expanded to the chunk boundaries, so that all touched chunks end up in the chunk cache and are
+    decompressed only once for neighbouring regions.
+    :param volume: the volume to read from
+    :type volume: np.array or h5py.Dataset
+    :param slices: the region of interest
+    :type slices: tuple
+    :return: the region of interest
+    :rtype: np.array
+    """
+    chunks = getattr(volume, 'chunks', None)
+    if chunks is None:
+        return np.asarray(volume[slices])
+    aligned, crop = [], []
+    for s, c, n in zip(slices, chunks, volume.shape):
+        start = (s.start // c) * c
+        stop = min(-(-s.stop // c) * c, n)
+        aligned.append(slice(start, stop))
+        crop.append(slice(s.start - start, s.stop - start))
+    return volume[tuple(aligned)][tuple(crop)]
+
+
+def cache_path(source_path, suffix):
+    """Get the path of a cache file for the given source file. Cache files are stored in a hidden
+    folder next to the source file.
+    :param source_path: path to the source file
+    :type source_path: str
+    :param suffix: suffix of the cache file, for ex. '.index.npz'
+    :type suffix: str
+    :return: path to the cache file
+    :rtype: str
+    """
+    folder, name = os.path.split(os.path.abspath(source_path))
+    return os.path.join(folder, CACHE_FOLDER_NAME, name + suffix)
+
+
+def source_signature(source_path):
+    """Get the modification time and the size of a file, used to invalidate cache files.
+    :param source_path: path to the source file
+    :type source_path: str
+    :return: array with the modification time (ns) and the size of the file
+    :rtype: np.array
+    """
+    stat = os.stat(source_path)
+    return np.array([stat.st_mtime_ns, stat.st_size], dtype=np.int64)
+
+
+def rechunk_h5_file(input_file, output_file, chunk_size=64, compression='gzip', compression_level=4):
+    """Write a chunked and compressed copy of an HDF5 prediction file (for ex. older contiguous
+    *_instance_preds.h5 files), so that regions of interest can be read efficiently.
+    The volumes are copied slab by slab, so the whole volume is never held in memory.
+    :param input_file: path to the input HDF5 file
+    :type input_file: str
+    :param output_file: path to the output HDF5 file
+    :type output_file: str
+    :param chunk_size: edge length of the cubic chunks
+    :type chunk_size: int
+    :param compression: HDF5 compression filter
+    :type compression: str
+    :param compression_level: compression level for gzip
+    :type compression_level: int
+    """
+    with h5py.File(input_file, 'r') as f_in, h5py.File(output_file, 'w') as f_out:
+        for name, dataset in f_in.items():
+            if not isinstance(dataset, h5py.Dataset):
+                f_in.copy(dataset, f_out, name=name)
+                continue
+            if dataset.ndim < 3:
+                f_out.create_dataset(name, data=dataset[()])
+            else:
+                chunks = tuple(min(chunk_size, n) for n in dataset.shape)
+                out = f_out.create_dataset(name, shape=dataset.shape, dtype=dataset.dtype, chunks=chunks,
+                                           compression=compression,
+                                           compression_opts=compression_level if compression == 'gzip' else None)
+                for start in range(0, dataset.shape[0], chunks[0]):
+                    out[start:start + chunks[0]] = dataset[start:start + chunks[0]]
+            f_out[name].attrs.update(dataset.attrs)
+        f_out.attrs.update(f_in.attrs)
@@ -0,0 +1,138 @@
+import h5py
+import numpy as np
+
+LABEL_SLAB_BYTES = 16 * 1024 ** 2
+
+
+def smallest_unsigned_dtype(max_value):
+    """Get the smallest unsigned integer dtype that can hold the given value.
+    :param max_value: the largest label value
+    :type max_value: int
+    :return: the dtype
+    :rtype: np.dtype
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32, np.uint64):
+        if max_value <= np.iinfo(dtype).max:
+            return np.dtype(dtype)
+    raise ValueError(f'Label value {max_value} does not fit in an unsigned integer')
+
+
+def slab_size(shape, itemsize, slab_bytes=LABEL_SLAB_BYTES):
+    """Get the number of slices along the first axis that fit into the given number of bytes.
+    :param shape: shape of the volume
+    :type shape: tuple
+    :param itemsize: size of a voxel in bytes
+    :type itemsize: int
+    :param slab_bytes: size of a slab in bytes
+    :type slab_bytes: int
+    :return: the number of slices (at least 1)
+    :rtype: int
+    """
+    return max(1, slab_bytes // max(1, int(np.prod(shape[1:])) * itemsize))
+
+
+def label_range(labels, slab_bytes=LABEL_SLAB_BYTES):
+    """Get the smallest and largest value of a label volume (at most 0 and at least 0) with a single pass
+    over the volume, slab by slab along the first axis.
+    :param labels: the label volume
+    :type labels: np.array or h5py.Dataset
+    :param slab_bytes: size of the slabs read at once in bytes
+    :type slab_bytes: int
+    :return: the smallest and largest value
+    :rtype: tuple
+    """
+    step = slab_size(labels.shape, labels.dtype.itemsize, slab_bytes)
+    min_value, max_value = 0, 0
+    for start in range(0, labels.shape[0], step):
+        slab = np.asarray(labels[start:start + step])
+        if slab.size:
+            min_value = min(min_value, int(slab.min()))
+            max_value = max(max_value, int(slab.max()))
+    return min_value, max_value
+
+
+def load_labels(file_path, dataset_name, slab_bytes=LABEL_SLAB_BYTES):
+    """Read a label volume from an HDF5 file, downcast to the smallest unsigned dtype that holds its
+    largest label. The volume is read slab by slab along the first axis, so only the downcast volume and
+    one slab are held in memory. Volumes with negative or non-integer values are read as they are.
+    :param file_path: path to the HDF5 file
+    :type file_path: str
+    :param dataset_name: name of the dataset, for ex. 'labels' or 'instances'
+    :type dataset_name: str
+    :param slab_bytes: size of the slabs read at once in bytes
+    :type slab_bytes: int
+    :return: the label volume
+    :rtype: np.array
+    """
+    with h5py.File(file_path, 'r') as f:
+        dataset = f[dataset_name]
+        if not np.issubdtype(dataset.dtype, np.integer):
+            return dataset[()]
+        min_value, max_value = label_range(dataset, slab_bytes)
+        if min_value < 0:
+            return dataset[()]
+        step = slab_size(dataset.shape, dataset.dtype.itemsize, slab_bytes)
+        labels = np.empty(dataset.shape, dtype=smallest_unsigned_dtype(max_value))
+        for start in range(0, dataset.shape[0], step):
+            labels[start:start + step] = dataset[start:start + step]
+    return labels
+
+
+def label_lookup_table(max_label, values=None, value=1):
+    """Create a lookup table mapping label ids to uint8 mask values.
+    :param max_label: the largest label id
+    :type max_label: int
+    :param values: the label ids that are mapped to value, all non-zero ids if None
+    :type values: list
+    :param value: the mask value of the selected ids
+    :type value: int
+    :return: the lookup table
+    :rtype: np.array
+    """
+    lut = np.zeros(int(max_label) + 1, dtype=np.uint8)
+    if values is None:
+        lut[1:] = value
+    else:
+        values = np.asarray(values, dtype=np.int64)
+        lut[values[(values >= 0) & (values <= max_label)]] = value
+    return lut
+
+
+def lookup_labels(labels, lut):
+    """Map a block of labels through a lookup table. Blocks of non-negative integer labels index the table
+    directly, other blocks (float or negative labels) are mapped with np.isin on the ids of the table, so
+    labels that are not ids of the table are mapped to 0.
+    :param labels: the label block
+    :type labels: np.array
+    :param lut: the lookup table, as returned by label_lookup_table (covering the largest label)
+    :type lut: np.array
+    :return: the mask block
+    :rtype: np.array
+    """
+    labels = np.asarray(labels)
+    if np.issubdtype(labels.dtype, np.unsignedinteger) or \
+            (np.issubdtype(labels.dtype, np.integer) and (labels.size == 0 or labels.min() >= 0)):
+        return lut[labels]
+    mask = np.zeros(labels.shape, dtype=lut.dtype)
+    for value in np.unique(lut[lut != 0]):
+        mask[np.isin(labels, np.flatnonzero(lut == value))] = value
+    return mask
+
+
+def apply_lookup_table(labels, lut, slab_bytes=LABEL_SLAB_BYTES):
+    """Map a label volume through a lookup table in a single pass, slab by slab along the first axis.
+    Used to build uint8 mask layers without the bool or int64 temporaries of np.isin and comparisons.
+    :param labels: the label volume
+    :type labels: np.array or h5py.Dataset
+    :param lut: the lookup table, as returned by label_lookup_table (covering the largest label)
+    :type lut: np.array
+    :param slab_bytes: size of the slabs processed at once in bytes
+    :type slab_bytes: int
+    :return: the mask volume
+    :rtype: np.array
+    """
+    mask = np.empty(labels.shape, dtype=lut.dtype)
+    step = slab_size(labels.shape, np.dtype(np.intp).itemsize, slab_bytes)
+    for start in range(0, labels.shape[0], step):
+        mask[start:start + step] = lookup_labels(labels[start:start + step], lut)
+    return mask
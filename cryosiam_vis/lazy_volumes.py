@@ -0,0 +1,107 @@
+import numpy as np
+from functools import partial
+
+from cryosiam_vis.label_utils import slab_size, lookup_labels
+
+try:
+    import dask.array as da
+except ImportError:
+    da = None
+
+DASK_CHUNK_BYTES = 32 * 1024 ** 2
+
+
+def require_dask():
+    if da is None:
+        raise ImportError('dask is required for the out-of-core mode, install it with: pip install dask')
+
+
+def aligned_chunks(shape, itemsize, base=None, chunk_bytes=DASK_CHUNK_BYTES):
+    """Get the dask chunk shape of a volume. Chunks of volumes stored in HDF5 chunks are the HDF5 chunk
+    shape grown by factors of 2 (last axis first) up to the given number of bytes, so every dask chunk
+    covers whole HDF5 chunks. Contiguous volumes (for ex. MRC memory maps) are chunked in slabs of full
+    z slices. As in the pyramids, the last three axes are the spatial ones, the chunks of volumes with
+    leading axes (for ex. the classes of probability maps) are one element wide along them.
+    :param shape: shape of the volume
+    :type shape: tuple
+    :param itemsize: size of a voxel in bytes
+    :type itemsize: int
+    :param base: the HDF5 chunk shape, None for contiguous volumes
+    :type base: tuple
+    :param chunk_bytes: the maximal size of a chunk in bytes
+    :type chunk_bytes: int
+    :return: the chunk shape
+    :rtype: tuple
+    """
+    leading = (1,) * (len(shape) - 3)
+    if base is None:
+        spatial = shape[-3:]
+        return leading + (min(spatial[0], slab_size(spatial, itemsize, chunk_bytes)),) + tuple(spatial[1:])
+    chunks = list(leading + tuple(base[-3:]))
+    for axis in reversed(range(len(shape) - 3, len(shape))):
+        while chunks[axis] < shape[axis] and int(np.prod(chunks)) * 2 * itemsize <= chunk_bytes:
+            chunks[axis] *= 2
+    return tuple(min(c, n) for c, n in zip(chunks, shape))
+
+
+class _VolumeReader:
+    """Read-only array-like view of a memory-mapped volume. dask copies arrays that have a copy method when
+    wrapping them, which would read the whole memory map into memory.
+    """
+
+    def __init__(self, volume):
+        self.volume = volume
+        self.shape = volume.shape
+        self.dtype = volume.dtype
+        self.ndim = volume.ndim
+
+    def __getitem__(self, key):
+        return np.asarray(self.volume[key])
+
+
+def lazy_volume(volume, chunk_bytes=DASK_CHUNK_BYTES):
+    """Wrap a volume as a chunked dask array without reading it. Only the chunks needed for the
+    displayed slices are read, so the memory used does not depend on the size of the volume.
+    :param volume: the volume (dask arrays are returned as they are)
+    :type volume: np.memmap or h5py.Dataset or dask.array.Array
+    :param chunk_bytes: the maximal size of a chunk in bytes
+    :type chunk_bytes: int
+    :return: the lazy volume
+    :rtype: dask.array.Array
+    """
+    require_dask()
+    if isinstance(volume, da.Array):
+        return volume
+    chunks = aligned_chunks(volume.shape, volume.dtype.itemsize, getattr(volume, 'chunks', None), chunk_bytes)
+    if isinstance(volume, np.ndarray):
+        volume, lock = _VolumeReader(volume), False
+    else:
+        # HDF5 is not thread safe, reads of h5py datasets from the dask threads are serialized
+        lock = True
+    # name=False skips hashing the volume for the name of the array, which would read the whole volume
+    return da.from_array(volume, chunks=chunks, name=False, lock=lock, asarray=True, fancy=False)
+
+
+def lazy_levels(levels, chunk_bytes=DASK_CHUNK_BYTES):
+    """Wrap every level of a multiscale volume as a lazy volume.
+    :param levels: list of levels as returned by load_multiscale
+    :type levels: list
+    :param chunk_bytes: the maximal size of a chunk in bytes
+    :type chunk_bytes: int
+    :return: list of lazy levels
+    :rtype: list
+    """
+    return [lazy_volume(level, chunk_bytes) for level in levels]
+
+
+def lazy_lookup_table(labels, lut):
+    """Map a label volume through a lookup table as a lazy operation, computed chunk by chunk when the
+    chunks are displayed.
+    :param labels: the label volume
+    :type labels: np.memmap or h5py.Dataset or dask.array.Array
+    :param lut: the lookup table, as returned by label_lookup_table (covering the largest label)
+    :type lut: np.array
+    :return: the lazy mask volume
+    :rtype: dask.array.Array
+    """
+    return lazy_volume(labels).map_blocks(partial(lookup_labels, lut=lut), dtype=lut.dtype)
@@ -0,0 +1,286 @@
+import os
+import html
+import json
+import zlib
+import yaml
+import struct
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset
+from cryosiam_vis.instance_index import load_instance_index
+from cryosiam_vis.save_instance_file import generate_particle_subtomogram, select_instances, instance_semantic_class
+from cryosiam_vis.umap_data import load_cluster_umap
+
+TILE_GAP = 2
+MANIFEST_NAME = 'manifest.jsonl'
+
+_volumes = {}
+
+
+def parser_helper(description=None):
+    description = "Render a static HTML gallery of particles" if description is None else description
+    parser = argparse.ArgumentParser(description, add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', type=str, required=True,
+                        help='path to the config file used for running CryoSiam')
+    parser.add_argument('--output_dir', type=str, required=True,
+                        help='path to the output folder of the gallery')
+    parser.add_argument('--tomo', type=str, required=False, nargs='+', default=None,
+                        help='Tomogram filenames (including the file extension), all instances of the tomograms '
+                             'are rendered, or only their particles in the clustering if --clustering is given')
+    parser.add_argument('--clustering', type=str, required=False, default=None,
+                        help='clustering type, one of ["kmeans", "spectral"], renders the particles of the '
+                             '{clustering}_clusters_umap_data.csv file grouped by cluster')
+    parser.add_argument('--semantic_folder', type=str, required=False, default=None,
+                        help='Folder with the *_preds.h5 semantic segmentations, used to group the instances '
+                             'of the tomograms by semantic class')
+    parser.add_argument('--mask', action='store_true',
+                        help='Mask out the voxels outside the instances')
+    parser.add_argument('--workers', type=int, required=False, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--batch_size', type=int, required=False, default=64,
+                        help='Number of particles rendered per task')
+    return parser
+
+
+def scale_image(image, vmin, vmax):
+    """Scale an image to uint8 between the given values.
+    :param image: the image
+    :type image: np.array
+    :param vmin: the value mapped to 0
+    :type vmin: float
+    :param vmax: the value mapped to 255
+    :type vmax: float
+    :return: the uint8 image
+    :rtype: np.array
+    """
+    if vmax <= vmin:
+        return np.zeros(image.shape, dtype=np.uint8)
+    return (np.clip((image - vmin) / (vmax - vmin), 0, 1) * 255).astype(np.uint8)
+
+
+def particle_tile(patch, low=1, high=99):
+    """Render the central z, y and x slices and the projection along z of a particle side by side. The
+    slices share the intensity range between the given percentiles, the projection is scaled on its own.
+    :param patch: the subtomogram of the particle
+    :type patch: np.array
+    :param low: the percentile mapped to black
+    :type low: float
+    :param high: the percentile mapped to white
+    :type high: float
+    :return: the uint8 tile
+    :rtype: np.array
+    """
+    patch = patch.astype(np.float32)
+    center = [n // 2 for n in patch.shape]
+    slices = [patch[center[0], :, :], patch[:, center[1], :], patch[:, :, center[2]]]
+    vmin, vmax = np.percentile(np.concatenate([s.ravel() for s in slices]), [low, high])
+    panels = [scale_image(s, vmin, vmax) for s in slices]
+    projection = patch.sum(axis=0)
+    panels.append(scale_image(projection, *np.percentile(projection, [low, high])))
+    height = max(p.shape[0] for p in panels)
+    tile = np.zeros((height, sum(p.shape[1] for p in panels) + TILE_GAP * (len(panels) - 1)), dtype=np.uint8)
+    x = 0
+    for panel in panels:
+        tile[:panel.shape[0], x:x + panel.shape[1]] = panel
+        x += panel.shape[1] + TILE_GAP
+    return tile
+
+
+def write_png(file_path, image):
+    """Write a uint8 grayscale image as PNG file. The file is written under a temporary name and renamed,
+    so an interrupted run never leaves a partial tile behind.
+    :param file_path: path to the file
+    :type file_path: str
+    :param image: the uint8 image
+    :type image: np.array
+    """
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    height, width = image.shape
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), np.ascontiguousarray(image, dtype=np.uint8)])
+    data = b''.join([b'\x89PNG\r\n\x1a\n',
+                     chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)),
+                     chunk(b'IDAT', zlib.compress(raw.tobytes(), 6)),
+                     chunk(b'IEND', b'')])
+    tmp_path = f'{file_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, file_path)
+
+
+def tile_name(tomogram, instance_id, masked):
+    return f'{tomogram}_{instance_id}_masked.png' if masked else f'{tomogram}_{instance_id}.png'
+
+
+def open_volumes(tomo_file, instances_file, semantic_file=None):
+    """Open the volumes of a tomogram in a worker process. Only the volumes of the last tomogram are kept
+    open, the tasks are submitted tomogram by tomogram.
+    """
+    key = (tomo_file, instances_file, semantic_file)
+    if key not in _volumes:
+        for _, instances, semantic, _ in _volumes.values():
+            instances.file.close()
+            if semantic is not None:
+                semantic.file.close()
+        _volumes.clear()
+        instances = open_h5_dataset(instances_file, 'instances')
+        semantic = open_h5_dataset(semantic_file, 'labels') if semantic_file is not None else None
+        _volumes[key] = (load_tomogram(tomo_file), instances, semantic, load_instance_index(instances_file, instances))
+    return _volumes[key]
+
+
+def render_tiles(task):
+    """Render and write the tiles of a batch of particles of one tomogram.
+    :param task: dictionary with the 'tomo_file', 'instances_file', 'semantic_file', 'tomogram', the
+                 'instance_ids' and their 'groups' (None to group by semantic class), 'masked' and 'tiles_dir'
+    :type task: dict
+    :return: the manifest entries of the rendered tiles
+    :rtype: list
+    """
+    tomo, instances, semantic, index = open_volumes(task['tomo_file'], task['instances_file'],
+                                                    task['semantic_file'])
+    entries = []
+    for i, instance_id in enumerate(task['instance_ids']):
+        if task['groups'] is not None:
+            group = task['groups'][i]
+        elif semantic is not None:
+            group = f'class {instance_semantic_class(semantic, instances, index, instance_id)}'
+        else:
+            group = 'all'
+        tile = tile_name(task['tomogram'], instance_id, task['masked'])
+        patch = generate_particle_subtomogram(tomo, instances, int(instance_id), task['masked'], index)
+        write_png(os.path.join(task['tiles_dir'], tile), particle_tile(patch))
+        entries.append({'tile': tile, 'group': group, 'tomogram': task['tomogram'], 'instance_id': int(instance_id)})
+    return entries
+
+
+def read_manifest(out_dir):
+    """Read the manifest of the already rendered tiles of a gallery.
+    :param out_dir: path to the gallery folder
+    :type out_dir: str
+    :return: dictionary mapping the tile names to their manifest entries
+    :rtype: dict
+    """
+    entries = {}
+    manifest_file = os.path.join(out_dir, MANIFEST_NAME)
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if os.path.exists(os.path.join(out_dir, 'tiles', entry['tile'])):
+                    entries[entry['tile']] = entry
+    return entries
+
+
+def write_gallery_html(out_dir, entries, title):
+    """Write the index.html of the gallery with the tiles grouped by cluster or class.
+    :param out_dir: path to the gallery folder
+    :type out_dir: str
+    :param entries: the manifest entries of the tiles
+    :type entries: list
+    :param title: title of the gallery
+    :type title: str
+    """
+    groups = {}
+    for entry in entries:
+        groups.setdefault(entry['group'], []).append(entry)
+    parts = ['<!DOCTYPE html>', '<html><head><meta charset="utf-8">', f'<title>{html.escape(title)}</title>',
+             '<style>body{font-family:sans-serif;margin:1em}figure{display:inline-block;margin:4px}'
+             'figcaption{font-size:11px;text-align:center}img{image-rendering:pixelated}</style>',
+             '</head><body>', f'<h1>{html.escape(title)}</h1>', '<p>Central z, y and x slices and projection '
+             'along z of every particle.</p>', '<ul>']
+    names = sorted(groups, key=str)
+    parts += [f'<li><a href="#group-{i}">{html.escape(str(name))}</a> ({len(groups[name])})</li>'
+              for i, name in enumerate(names)]
+    parts.append('</ul>')
+    for i, name in enumerate(names):
+        parts.append(f'<h2 id="group-{i}">{html.escape(str(name))}</h2>')
+        for entry in sorted(groups[name], key=lambda e: (e['tomogram'], e['instance_id'])):
+            caption = html.escape(f'{entry["tomogram"]} #{entry["instance_id"]}')
+            parts.append(f'<figure><img src="tiles/{html.escape(entry["tile"])}" loading="lazy" alt="{caption}">'
+                         f'<figcaption>{caption}</figcaption></figure>')
+    parts.append('</body></html>')
+    with open(os.path.join(out_dir, 'index.html'), 'w') as f:
+        f.write('\n'.join(parts))
+
+
+def particles_to_render(config, tomograms=None, clustering=None):
+    """Get the particles of the gallery, either all instances of the given tomograms or the particles of a
+    clustering.
+    :return: dictionary mapping every tomogram filename to its instance ids and their groups (None to
+             group by semantic class)
+    :rtype: dict
+    """
+    if clustering is not None:
+        umap = load_cluster_umap(os.path.join(config['prediction_folder'], f'{clustering}_clusters_umap_data.csv'))
+        particles = {}
+        for tomogram, rows in umap.groupby('tomogram', sort=True, observed=True):
+            if tomograms and tomogram not in tomograms:
+                continue
+            particles[str(tomogram)] = (rows['instance_id'].to_numpy(),
+                                        [f'cluster {c}' for c in rows['class'].astype(str)])
+        return particles
+    particles = {}
+    for tomogram in tomograms:
+        instances_file = os.path.join(config['instances_mask_folder'],
+                                      tomogram.split(config['file_extension'])[0] + '_instance_preds.h5')
+        particles[tomogram] = (select_instances(load_instance_index(instances_file)), None)
+    return particles
+
+
+def main(args):
+    with open(args.config, "r") as ymlfile:
+        config = yaml.safe_load(ymlfile)
+    if not args.tomo and not args.clustering:
+        raise ValueError('Select the particles to be rendered with --tomo or --clustering')
+    tiles_dir = os.path.join(args.output_dir, 'tiles')
+    os.makedirs(tiles_dir, exist_ok=True)
+    done = read_manifest(args.output_dir)
+
+    entries, tasks = [], []
+    for tomogram, (instance_ids, groups) in particles_to_render(config, args.tomo, args.clustering).items():
+        tomo_root_name = tomogram.split(config['file_extension'])[0]
+        semantic_file = None
+        if groups is None and args.semantic_folder is not None:
+            semantic_file = os.path.join(args.semantic_folder, tomo_root_name + '_preds.h5')
+        todo = []
+        for i, instance_id in enumerate(instance_ids):
+            entry = done.get(tile_name(tomo_root_name, instance_id, args.mask))
+            if entry is None:
+                todo.append(i)
+            else:
+                entries.append(entry if groups is None else dict(entry, group=groups[i]))
+        for start in range(0, len(todo), args.batch_size):
+            batch = todo[start:start + args.batch_size]
+            tasks.append({'tomo_file': os.path.join(config['data_folder'], tomogram),
+                          'instances_file': os.path.join(config['instances_mask_folder'],
+                                                         tomo_root_name + '_instance_preds.h5'),
+                          'semantic_file': semantic_file, 'tomogram': tomo_root_name,
+                          'instance_ids': [int(instance_ids[i]) for i in batch],
+                          'groups': None if groups is None else [groups[i] for i in batch],
+                          'masked': args.mask, 'tiles_dir': tiles_dir})
+    print(f'{len(entries)} tiles already rendered, rendering {sum(len(t["instance_ids"]) for t in tasks)} tiles')
+
+    with open(os.path.join(args.output_dir, MANIFEST_NAME), 'a') as manifest, \
+            ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        for future in as_completed([executor.submit(render_tiles, task) for task in tasks]):
+            for entry in future.result():
+                manifest.write(json.dumps(entry) + '\n')
+                entries.append(entry)
+            manifest.flush()
+    title = f'{args.clustering} clusters' if args.clustering else 'Particles'
+    write_gallery_html(args.output_dir, entries, title)
+    print(f'Gallery with {len(entries)} particles written to {os.path.join(args.output_dir, "index.html")}')
+
+
+if __name__ == '__main__':
+    parser = parser_helper()
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,190 @@
+import numpy as np
+import plotly.express as px
+import plotly.graph_objects as go
+
+from cryosiam_vis.pyramid import downsample
+from cryosiam_vis.instrumentation import staged
+
+try:
+    from skimage.measure import marching_cubes
+except ImportError:
+    marching_cubes = None
+
+RENDER_MODES = ['mesh', 'volume_lowres', 'volume']
+SLICE_AXES = ['z', 'y', 'x']
+
+
+def voxel_surface(mask):
+    """Compute the surface mesh of a binary mask made of the voxel faces on the mask boundary.
+    Used as a fallback when scikit-image is not installed.
+    :param mask: binary mask
+    :type mask: np.array
+    :return: vertices (in z, y, x order) and triangle faces of the mesh
+    :rtype: tuple
+    """
+    m = np.pad(mask > 0, 1)
+    quads = []
+    for axis in range(3):
+        other = [a for a in range(3) if a != axis]
+        for direction in (-1, 1):
+            exposed = np.argwhere(m & ~np.roll(m, -direction, axis)) - 1
+            if len(exposed) == 0:
+                continue
+            corners = np.repeat(exposed[:, None, :].astype(np.float32) - 0.5, 4, axis=1)
+            corners[:, :, axis] += 1 if direction == 1 else 0
+            corners[:, [1, 2], other[0]] += 1
+            corners[:, [2, 3], other[1]] += 1
+            quads.append(corners)
+    if not quads:
+        return np.zeros((0, 3), dtype=np.float32), np.zeros((0, 3), dtype=np.int64)
+    corners = np.concatenate(quads).reshape(-1, 3)
+    verts, inverse = np.unique(corners, axis=0, return_inverse=True)
+    quads = inverse.reshape(-1, 4)
+    faces = np.concatenate([quads[:, [0, 1, 2]], quads[:, [0, 2, 3]]])
+    return verts, faces
+
+
+def mesh_figure(mask):
+    """Render the surface of the particle mask as a triangle mesh (marching cubes when scikit-image is
+    installed, otherwise the voxel faces on the boundary). This sends only the surface vertices and faces
+    to the browser instead of every voxel of the patch.
+    :param mask: the particle mask
+    :type mask: np.array
+    :return: the figure
+    :rtype: go.Figure
+    """
+    if marching_cubes is not None and 0 < mask.sum() < mask.size:
+        verts, faces, _, _ = marching_cubes(np.pad(mask.astype(np.float32), 1), level=0.5)
+        verts -= 1
+    else:
+        verts, faces = voxel_surface(mask)
+    verts = np.round(verts, 2)
+    fig = go.Figure(data=go.Mesh3d(x=verts[:, 2], y=verts[:, 1], z=verts[:, 0],
+                                   i=faces[:, 0], j=faces[:, 1], k=faces[:, 2],
+                                   color='lightgray', flatshading=False))
+    fig.update_scenes(xaxis_range=[0, mask.shape[2]], yaxis_range=[0, mask.shape[1]],
+                      zaxis_range=[0, mask.shape[0]], aspectmode='cube')
+    return fig
+
+
+def volume_figure(patch, opacity=0.1, factor=1):
+    """Render the particle patch as a volume, optionally downsampled by averaging blocks of
+    factor x factor x factor voxels (a factor of 2 sends 8 times less data to the browser).
+    :param patch: the masked particle patch
+    :type patch: np.array
+    :param opacity: opacity of the volume
+    :type opacity: float
+    :param factor: downsampling factor, a power of 2
+    :type factor: int
+    :return: the figure
+    :rtype: go.Figure
+    """
+    step = 1
+    while step < factor:
+        patch = downsample(patch, is_label=False)
+        step *= 2
+    z, y, x = np.mgrid[:patch.shape[0], :patch.shape[1], :patch.shape[2]] * step
+    fig = go.Figure(data=go.Volume(
+        x=x.flatten(), y=y.flatten(), z=z.flatten(),
+        value=patch.flatten(),
+        isomin=0.01,
+        isomax=0.99,
+        opacity=opacity,
+        colorscale='gray'
+    ))
+    return fig
+
+
+@staged('stage/particle_figure')
+def particle_figure(patch, mask, render_mode='mesh', opacity=0.1):
+    """Render a particle with the given render mode.
+    :param patch: the masked particle patch
+    :type patch: np.array
+    :param mask: the particle mask
+    :type mask: np.array
+    :param render_mode: one of RENDER_MODES
+    :type render_mode: str
+    :param opacity: opacity used by the volume render modes
+    :type opacity: float
+    :return: the figure
+    :rtype: go.Figure
+    """
+    if render_mode == 'mesh':
+        return mesh_figure(mask)
+    return volume_figure(patch, opacity, factor=2 if render_mode == 'volume_lowres' else 1)
+
+
+@staged('stage/slice_figure')
+def slice_figure(volume, axis, index):
+    """Render a single slice of a patch. The slice is sent to the browser as a PNG encoded image, with
+    the contrast of the whole patch, instead of as a matrix of values.
+    :param volume: the patch
+    :type volume: np.array
+    :param axis: the slicing axis, one of SLICE_AXES
+    :type axis: str
+    :param index: index of the slice along the axis (clipped to the patch size)
+    :type index: int
+    :return: the figure
+    :rtype: go.Figure
+    """
+    axis = SLICE_AXES.index(axis)
+    index = min(max(int(index), 0), volume.shape[axis] - 1)
+    zmin, zmax = float(volume.min()), float(volume.max())
+    fig = px.imshow(np.take(volume, index, axis=axis), binary_string=True,
+                    zmin=zmin, zmax=zmax if zmax > zmin else zmin + 1)
+    return fig
+
+
+@staged('stage/gallery_figure')
+def gallery_figure(volumes, titles, columns=4, size=120):
+    """Render the central slices of several patches as one figure with a panel per patch. Every slice is
+    scaled to its own contrast and sent as a PNG encoded image. Clicking a panel gives its index as the
+    curveNumber of the click data.
+    :param volumes: list of patches
+    :type volumes: list
+    :param titles: title of every panel
+    :type titles: list
+    :param columns: number of panels per row
+    :type columns: int
+    :param size: size of a panel in pixels
+    :type size: int
+    :return: the figure
+    :rtype: go.Figure
+    """
+    if len(volumes) == 0:
+        return go.Figure()
+    slices = np.stack([np.asarray(v[v.shape[0] // 2], dtype=np.float32) for v in volumes])
+    low = slices.min(axis=(1, 2), keepdims=True)
+    high = slices.max(axis=(1, 2), keepdims=True)
+    slices = ((slices - low) / np.where(high > low, high - low, 1) * 255).astype(np.uint8)
+    columns = min(columns, len(volumes))
+    fig = px.imshow(slices, facet_col=0, facet_col_wrap=columns, binary_string=True,
+                    facet_col_spacing=0.01, facet_row_spacing=0.08)
+    for annotation in fig.layout.annotations:
+        annotation.text = titles[int(annotation.text.split('=')[-1])]
+    fig.update_xaxes(showticklabels=False)
+    fig.update_yaxes(showticklabels=False)
+    fig.update_layout(width=columns * size, height=-(-len(volumes) // columns) * (size + 20) + 20,
+                      margin={'l': 0, 'r': 0, 't': 20, 'b': 0})
+    return fig
+
+
+def figure_payload(fig):
+    """Serialize a figure to the dictionary that the Dash callbacks return for a figure property. Cached
+    figures are stored serialized, so they are not encoded again when they are reused.
+    :param fig: the figure
+    :type fig: go.Figure
+    :return: the figure data and layout
+    :rtype: dict
+    """
+    return fig.to_plotly_json()
+
+
+def figure_payload_size(fig):
+    """Get the size in bytes of the JSON that is sent to the browser for a figure.
+    :param fig: the figure
+    :type fig: go.Figure
+    :return: the payload size in bytes
+    :rtype: int
+    """
+    return len(fig.to_json().encode('utf-8'))
@@ -0,0 +1,108 @@
+import os
+import h5py
+import numpy as np
+
+from cryosiam_vis.io_utils import cache_path, source_signature
+from cryosiam_vis.lazy_volumes import lazy_levels
+
+PYRAMID_MIN_SIZE = 512
+PYRAMID_SLAB_SIZE = 32
+
+
+def downsample(block, is_label):
+    """Downsample the last three axes of a block by a factor of 2. Images are downsampled with the mean
+    of every 2x2x2 neighbourhood and label volumes with striding (so no new label values are created).
+    Odd sizes are rounded up.
+    :param block: the block to be downsampled
+    :type block: np.array
+    :param is_label: whether the block is a label volume
+    :type is_label: bool
+    :return: the downsampled block
+    :rtype: np.array
+    """
+    if is_label:
+        return block[..., ::2, ::2, ::2]
+    pad = [(0, 0)] * (block.ndim - 3) + [(0, n % 2) for n in block.shape[-3:]]
+    block = np.pad(block, pad, 'edge')
+    shape = block.shape[:-3] + tuple(v for n in block.shape[-3:] for v in (n // 2, 2))
+    return block.reshape(shape).mean(axis=(-5, -3, -1), dtype=np.float32)
+
+
+def build_pyramid(volume, pyramid_file, signature, is_label, min_size=PYRAMID_MIN_SIZE):
+    """Write the 2x downsampled levels of a volume to an HDF5 file, until the largest of the last three
+    axes is not larger than min_size. Every level is computed slab by slab from the previous one, so
+    the volume is never fully loaded into memory.
+    :param volume: the full resolution volume
+    :type volume: np.array or h5py.Dataset
+    :param pyramid_file: path to the output HDF5 file
+    :type pyramid_file: str
+    :param signature: signature of the source file, stored to invalidate the pyramid
+    :type signature: np.array
+    :param is_label: whether the volume is a label volume
+    :type is_label: bool
+    :param min_size: size of the last level
+    :type min_size: int
+    """
+    os.makedirs(os.path.dirname(pyramid_file), exist_ok=True)
+    with h5py.File(pyramid_file, 'w') as f:
+        previous = volume
+        level = 1
+        while max(previous.shape[-3:]) > min_size:
+            shape = previous.shape[:-3] + tuple(-(-n // 2) for n in previous.shape[-3:])
+            dtype = previous.dtype if is_label else np.float32
+            current = f.create_dataset(f'level_{level}', shape=shape, dtype=dtype,
+                                       chunks=shape[:-3] + tuple(min(64, n) for n in shape[-3:]))
+            for start in range(0, previous.shape[-3], 2 * PYRAMID_SLAB_SIZE):
+                block = np.asarray(previous[..., start:start + 2 * PYRAMID_SLAB_SIZE, :, :])
+                current[..., start // 2:start // 2 + PYRAMID_SLAB_SIZE, :, :] = downsample(block, is_label)
+            previous = current
+            level += 1
+        f.attrs['signature'] = signature
+        f.attrs['levels'] = level - 1
+
+
+def load_multiscale(source_path, volume, name='', is_label=False, min_size=PYRAMID_MIN_SIZE):
+    """Get the multiscale representation of a volume, using the pyramid stored in the cache folder next
+    to the source file. The pyramid is (re)built when it is missing or when the source file changed.
+    :param source_path: path to the file the volume is read from
+    :type source_path: str
+    :param volume: the full resolution volume
+    :type volume: np.array or h5py.Dataset
+    :param name: name of the volume inside the source file (used to name the pyramid file)
+    :type name: str
+    :param is_label: whether the volume is a label volume
+    :type is_label: bool
+    :param min_size: volumes not larger than this are returned as a single level
+    :type min_size: int
+    :return: list of levels, starting with the full resolution volume
+    :rtype: list
+    """
+    if max(volume.shape[-3:]) <= min_size:
+        return [volume]
+    pyramid_file = cache_path(source_path, f'.{name}.pyramid.h5' if name else '.pyramid.h5')
+    signature = source_signature(source_path)
+    valid = False
+    if os.path.exists(pyramid_file):
+        with h5py.File(pyramid_file, 'r') as f:
+            valid = 'signature' in f.attrs and np.array_equal(f.attrs['signature'], signature)
+    if not valid:
+        try:
+            build_pyramid(volume, pyramid_file, signature, is_label, min_size)
+        except OSError:
+            return [volume]
+    f = h5py.File(pyramid_file, 'r')
+    return [volume] + [f[f'level_{level}'] for level in range(1, f.attrs['levels'] + 1)]
+
+
+def multiscale_layer_args(levels, lazy=False):
+    """Get the data arguments for adding a list of levels as a napari layer.
+    :param levels: list of levels as returned by load_multiscale
+    :type levels: list
+    :param lazy: whether to wrap the levels as chunked dask arrays (out-of-core mode)
+    :type lazy: bool
+    :return: dictionary with the 'data' and 'multiscale' layer arguments
+    :rtype: dict
+    """
+    if lazy:
+        levels = lazy_levels(levels)
+    return {'data': levels if len(levels) > 1 else levels[0], 'multiscale': len(levels) > 1}
@@ -1,11 +1,14 @@
 import os
-import math
 import h5py
 import yaml
 import mrcfile
 import argparse
 import numpy as np
-from scipy import ndimage as ndi
+from concurrent.futures import ThreadPoolExecutor
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset, read_roi
+from cryosiam_vis.instance_index import build_instance_index, load_instance_index, extract_particle, \
+    get_instance_slices
 
 
 def save_tomogram(file_path, data):
@@ -21,53 +24,186 @@ def save_tomogram(file_path, data):
         return m.data
 
 
-def generate_particle_subtomogram(tomo, instances, instance_ids, masked):
-    mask = np.isin(instances, instance_ids)
-    slices = ndi.find_objects(mask)[0]
-    sub_mask = mask[slices]
-    patch = tomo[slices].copy()
+def generate_particle_subtomogram(tomo, instances, instance_ids, masked, index=None):
+    if index is None:
+        index = build_instance_index(instances)
+    patch, sub_mask = extract_particle(tomo, instances, index, instance_ids)
     if masked:
         patch[sub_mask != 1] = 0
-    patch_size = [64, 64, 64]
-    pad_size = tuple([(max(math.ceil((p - b) / 2), 0), max(math.floor((p - b) / 2), 0)) for p, b in
-                      zip(patch_size, patch.shape)])
-    patch = np.pad(patch, pad_size, 'constant')[:patch_size[0], :patch_size[1], :patch_size[2]]
     return patch
 
 
+def select_instances(index, instance_ids=None, instance_range=None, min_size=None, max_size=None):
+    """Select the instance ids present in the instance index, optionally filtered by id and size.
+    :param index: instance index computed with build_instance_index
+    :type index: dict
+    :param instance_ids: list of instance ids to keep (all instances if None)
+    :type instance_ids: list
+    :param instance_range: inclusive (first, last) range of instance ids to keep
+    :type instance_range: tuple
+    :param min_size: minimum number of voxels of an instance
+    :type min_size: int
+    :param max_size: maximum number of voxels of an instance
+    :type max_size: int
+    :return: the selected instance ids
+    :rtype: np.array
+    """
+    ids = np.flatnonzero(index['bboxes'][:, 0, 0] >= 0)
+    ids = ids[ids > 0]
+    if instance_ids:
+        ids = ids[np.isin(ids, instance_ids)]
+    if instance_range:
+        ids = ids[(ids >= instance_range[0]) & (ids <= instance_range[1])]
+    if min_size is not None:
+        ids = ids[index['counts'][ids] >= min_size]
+    if max_size is not None:
+        ids = ids[index['counts'][ids] <= max_size]
+    return ids
+
+
+def instance_semantic_class(semantic, instances, index, instance_id):
+    """Get the semantic class of an instance, i.e. the most common non-zero semantic label under its mask.
+    :param semantic: semantic segmentation of the tomogram
+    :type semantic: np.array or h5py.Dataset
+    :param instances: instance segmentation of the tomogram
+    :type instances: np.array or h5py.Dataset
+    :param index: instance index computed with build_instance_index
+    :type index: dict
+    :param instance_id: the instance id
+    :type instance_id: int
+    :return: the semantic class (0 if the instance does not overlap any class)
+    :rtype: int
+    """
+    slices = get_instance_slices(index, instance_id)
+    labels = read_roi(semantic, slices)[read_roi(instances, slices) == instance_id]
+    counts = np.bincount(labels[labels > 0].astype(np.intp))
+    return int(np.argmax(counts)) if len(counts) else 0
+
+
+def save_particles(tomo, instances, index, instance_ids, masked, out_dir, tomo_root_name, output_format='mrc',
+                   workers=1, batch_size=256):
+    """Extract and save the subtomograms of many instances of one tomogram. The extraction (and for the
+    'mrc' format also the writing) runs in a thread pool, in batches so only batch_size patches are held
+    in memory at once.
+    :param tomo: the tomogram
+    :type tomo: np.array
+    :param instances: instance segmentation of the tomogram
+    :type instances: np.array or h5py.Dataset
+    :param index: instance index computed with build_instance_index
+    :type index: dict
+    :param instance_ids: the instance ids to be saved
+    :type instance_ids: list
+    :param masked: whether to mask out the voxels outside the instance
+    :type masked: bool
+    :param out_dir: path to the output folder
+    :type out_dir: str
+    :param tomo_root_name: the tomogram name without the file extension
+    :type tomo_root_name: str
+    :param output_format: 'mrc' for one file per instance, 'mrc_stack' or 'h5_stack' for a single
+                          stack of all the instances
+    :type output_format: str
+    :param workers: number of worker threads
+    :type workers: int
+    :param batch_size: number of patches extracted per batch
+    :type batch_size: int
+    """
+    instance_ids = [int(i) for i in instance_ids]
+    patch_shape = (len(instance_ids), 64, 64, 64)
+    if output_format == 'mrc_stack':
+        stack_file = mrcfile.new_mmap(os.path.join(out_dir, f'{tomo_root_name}_particles.mrc'), patch_shape,
+                                      mrc_mode=2, overwrite=True)
+        stack = stack_file.data
+        np.savetxt(os.path.join(out_dir, f'{tomo_root_name}_particles_ids.txt'), instance_ids, fmt='%d')
+    elif output_format == 'h5_stack':
+        stack_file = h5py.File(os.path.join(out_dir, f'{tomo_root_name}_particles.h5'), 'w')
+        stack = stack_file.create_dataset('particles', shape=patch_shape, dtype=np.float32,
+                                          chunks=(1,) + patch_shape[1:])
+        stack_file.create_dataset('instance_ids', data=np.array(instance_ids, dtype=np.int64))
+    else:
+        stack_file, stack = None, None
+
+    def process(inst_id):
+        subtomo = generate_particle_subtomogram(tomo, instances, inst_id, masked, index)
+        if stack is None:
+            save_tomogram(os.path.join(out_dir, f'{tomo_root_name}_instance_{inst_id}.mrc'), subtomo)
+            return None
+        return subtomo
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for start in range(0, len(instance_ids), batch_size):
+                batch = instance_ids[start:start + batch_size]
+                for i, subtomo in enumerate(pool.map(process, batch), start=start):
+                    if stack is not None:
+                        stack[i] = subtomo
+    finally:
+        if stack_file is not None:
+            stack_file.close()
+
+
 def parser_helper(description=None):
     description = "Plot instance segmentation with napari" if description is None else description
     parser = argparse.ArgumentParser(description, add_help=True,
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--config', type=str, required=True,
                         help='path to the config file used for running SimSiam')
-    parser.add_argument('--tomo', type=str, required=True,
-                        help='Tomogram name (including the file extension')
-    parser.add_argument('--instance', type=int, required=True,
-                        help='Instance id of the structure to be saved')
+    parser.add_argument('--tomo', type=str, required=True, nargs='+',
+                        help='Tomogram name (including the file extension), or several tomogram names')
+    parser.add_argument('--instance', type=int, required=False, nargs='+',
+                        help='Instance id of the structure to be saved, or several instance ids')
+    parser.add_argument('--instance_range', type=int, required=False, nargs=2, metavar=('FIRST', 'LAST'),
+                        help='Save all the instances with ids in the inclusive range')
+    parser.add_argument('--all', action='store_true', required=False,
+                        help='Save all the instances of the tomogram')
+    parser.add_argument('--min_size', type=int, required=False, default=None,
+                        help='Only save instances with at least this many voxels')
+    parser.add_argument('--max_size', type=int, required=False, default=None,
+                        help='Only save instances with at most this many voxels')
+    parser.add_argument('--semantic_folder', type=str, required=False, default=None,
+                        help='Path to the folder with the semantic segmentation *_preds.h5 files, '
+                             'used for filtering by --semantic_classes')
+    parser.add_argument('--semantic_classes', type=int, required=False, nargs='+', default=None,
+                        help='Only save instances whose semantic class is one of these classes')
     parser.add_argument('--output_dir', type=str, required=True,
                         help='Path to the output folder to save the instance subtomogram')
+    parser.add_argument('--output_format', type=str, required=False, default='mrc',
+                        choices=['mrc', 'mrc_stack', 'h5_stack'],
+                        help='One .mrc file per instance, or a single MRC or HDF5 particle stack per tomogram')
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of worker threads used for the extraction')
     parser.add_argument('--mask', action='store_true', required=False,
-                        help='Instance id of the structure to be saved')
+                        help='Mask out the voxels outside the instance in the saved subtomograms')
     return parser
 
 
 def main(args):
     with open(args.config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    tomo_name = args.tomo
-    inst_id = args.instance
+    if not args.instance and not args.instance_range and not args.all:
+        raise ValueError('Select the instances to be saved with --instance, --instance_range or --all')
+    if args.semantic_classes and args.semantic_folder is None:
+        raise ValueError('--semantic_classes requires --semantic_folder')
     out_dir = args.output_dir
     os.makedirs(out_dir, exist_ok=True)
 
-    tomo = mrcfile.open(os.path.join(config['data_folder'], tomo_name)).data
-    tomo_root_name = tomo_name.split(config['file_extension'])[0]
-    instances_file = os.path.join(config['instances_mask_folder'], tomo_root_name + '_instance_preds.h5')
-    with h5py.File(instances_file, 'r') as f:
-        instances = f['instances'][()]
+    for tomo_name in args.tomo:
+        tomo = load_tomogram(os.path.join(config['data_folder'], tomo_name))
+        tomo_root_name = tomo_name.split(config['file_extension'])[0]
+        instances_file = os.path.join(config['instances_mask_folder'], tomo_root_name + '_instance_preds.h5')
+        instances = open_h5_dataset(instances_file, 'instances')
+        index = load_instance_index(instances_file, instances)
+
+        inst_ids = select_instances(index, args.instance, args.instance_range, args.min_size, args.max_size)
+        if args.semantic_classes:
+            semantic = open_h5_dataset(os.path.join(args.semantic_folder, tomo_root_name + '_preds.h5'), 'labels')
+            with ThreadPoolExecutor(max_workers=args.workers) as pool:
+                classes = list(pool.map(lambda i: instance_semantic_class(semantic, instances, index, i), inst_ids))
+            inst_ids = inst_ids[np.isin(classes, args.semantic_classes)]
+        print(f'{tomo_name}: saving {len(inst_ids)} instances')
 
-    subtomo = generate_particle_subtomogram(tomo, instances, inst_id, args.mask)
-    save_tomogram(os.path.join(out_dir, f'{tomo_root_name}_instance_{inst_id}.mrc'), subtomo)
+        save_particles(tomo, instances, index, inst_ids, args.mask, out_dir, tomo_root_name, args.output_format,
+                       args.workers)
+        instances.file.close()
 
 
 if __name__ == '__main__':
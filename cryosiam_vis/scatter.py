@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+from scipy.spatial import cKDTree
+
+from cryosiam_vis.instrumentation import staged
+
+DEFAULT_MAX_POINTS = 100000
+DENSITY_BINS = 256
+
+
+def window_rows(table, x_range=None, y_range=None):
+    """Get the positions of the rows whose UMAP coordinates are inside the given window.
+    :param table: the UMAP table
+    :type table: pd.DataFrame
+    :param x_range: (min, max) of the x axis, None for the full range
+    :type x_range: tuple
+    :param y_range: (min, max) of the y axis, None for the full range
+    :type y_range: tuple
+    :return: the row positions
+    :rtype: np.array
+    """
+    inside = np.ones(len(table), dtype=bool)
+    for column, value_range in (('x', x_range), ('y', y_range)):
+        if value_range is not None:
+            values = table[column].to_numpy()
+            inside &= (values >= min(value_range)) & (values <= max(value_range))
+    return np.flatnonzero(inside)
+
+
+def density_trace(x, y, x_range, y_range, bins=DENSITY_BINS):
+    """Aggregate the points into a density raster on the server, shown as a heatmap (log scaled counts,
+    empty bins are transparent).
+    """
+    counts, x_edges, y_edges = np.histogram2d(x, y, bins=bins, range=[x_range, y_range])
+    density = np.log1p(counts.T)
+    density[counts.T == 0] = np.nan
+    return go.Heatmap(z=np.round(density, 2), x=(x_edges[:-1] + x_edges[1:]) / 2, y=(y_edges[:-1] + y_edges[1:]) / 2,
+                      colorscale='Viridis', showscale=False, hovertemplate='x=%{x:.2f}<br>y=%{y:.2f}<extra></extra>')
+
+
+def points_traces(table, rows, color, hover, opacity):
+    """Create the WebGL scatter traces of the given rows. Every point carries its row position as the first
+    customdata value, followed only by the hover columns.
+    """
+    hover = [c for c in hover if c in table.columns]
+    hovertemplate = '<br>'.join(['x=%{x}', 'y=%{y}'] + [f'{c}=%{{customdata[{i + 1}]}}' for i, c in enumerate(hover)])
+    subset = table.iloc[rows]
+
+    def trace(positions, **kwargs):
+        part = subset.iloc[positions]
+        customdata = np.column_stack([rows[positions]] + [part[c].astype(str).to_numpy() for c in hover]) \
+            if hover else rows[positions][:, None]
+        return go.Scattergl(x=part['x'].to_numpy(), y=part['y'].to_numpy(), mode='markers', customdata=customdata,
+                            hovertemplate=hovertemplate + '<extra></extra>', opacity=opacity, **kwargs)
+
+    if color is None or color not in table.columns:
+        return [trace(np.arange(len(rows)))]
+    values = subset[color]
+    if pd.api.types.is_numeric_dtype(values):
+        return [trace(np.arange(len(rows)),
+                      marker={'color': values.to_numpy(), 'colorscale': 'Plasma', 'showscale': True,
+                              'colorbar': {'title': color}})]
+    values = values.astype(str).to_numpy()
+    palette = px.colors.qualitative.Light24
+    traces = []
+    for i, category in enumerate(sorted(np.unique(values))):
+        traces.append(trace(np.flatnonzero(values == category), name=category,
+                            marker={'color': palette[i % len(palette)]}, legendgroup=category))
+    return traces
+
+
+@staged('stage/scatter_figure')
+def scatter_figure(table, color=None, hover=(), max_points=DEFAULT_MAX_POINTS, x_range=None, y_range=None,
+                   opacity=0.5, width=600, height=600):
+    """Plot the UMAP coordinates of a table. The points inside the window are drawn with WebGL (Scattergl)
+    and send only the hover columns. When there are more than max_points points inside the window, a
+    server side density raster is shown instead, until the user zooms in far enough.
+    :param table: the UMAP table with 'x' and 'y' columns
+    :type table: pd.DataFrame
+    :param color: the column used for coloring the points
+    :type color: str
+    :param hover: the columns shown on hover
+    :type hover: list
+    :param max_points: maximum number of points drawn individually
+    :type max_points: int
+    :param x_range: (min, max) of the x axis window, None for the full range
+    :type x_range: tuple
+    :param y_range: (min, max) of the y axis window, None for the full range
+    :type y_range: tuple
+    :param opacity: opacity of the points
+    :type opacity: float
+    :param width: width of the figure
+    :type width: int
+    :param height: height of the figure
+    :type height: int
+    :return: the figure
+    :rtype: go.Figure
+    """
+    rows = window_rows(table, x_range, y_range)
+    fig = go.Figure()
+    if len(rows) > max_points:
+        x_range = x_range or (float(table['x'].min()), float(table['x'].max()))
+        y_range = y_range or (float(table['y'].min()), float(table['y'].max()))
+        fig.add_trace(density_trace(table['x'].to_numpy()[rows], table['y'].to_numpy()[rows], x_range, y_range))
+    else:
+        fig.add_traces(points_traces(table, rows, color, hover, opacity))
+    fig.update_layout(width=width, height=height, uirevision='umap', legend_title_text=color,
+                      xaxis_title='x', yaxis_title='y')
+    if x_range is not None:
+        fig.update_xaxes(range=list(x_range))
+    if y_range is not None:
+        fig.update_yaxes(range=list(y_range))
+    return fig
+
+
+def build_spatial_index(table):
+    """Build a KD-tree over the UMAP coordinates of a table, used to resolve clicks on the density raster.
+    :param table: the UMAP table
+    :type table: pd.DataFrame
+    :return: the KD-tree
+    :rtype: cKDTree
+    """
+    return cKDTree(np.column_stack([table['x'].to_numpy(), table['y'].to_numpy()]))
+
+
+@staged('stage/nearest_rows')
+def nearest_rows(spatial_index, row, k):
+    """Get the rows of the k points nearest to a point in the UMAP space, without the point itself.
+    :param spatial_index: KD-tree of the table
+    :type spatial_index: cKDTree
+    :param row: row position of the point
+    :type row: int
+    :param k: number of neighbours
+    :type k: int
+    :return: row positions of the neighbours, nearest first
+    :rtype: list
+    """
+    if spatial_index is None or k <= 0 or spatial_index.n < 2:
+        return []
+    _, rows = spatial_index.query(spatial_index.data[row], k=min(k + 1, spatial_index.n))
+    return [int(r) for r in np.atleast_1d(rows) if r != row][:k]
+
+
+def clicked_row(click_data, spatial_index):
+    """Get the row position of the clicked point, from its customdata or, for clicks on the density raster
+    or on points without customdata, as the point nearest to the click.
+    :param click_data: the clickData of the graph
+    :type click_data: dict
+    :param spatial_index: KD-tree of the plotted table
+    :type spatial_index: cKDTree
+    :return: the row position
+    :rtype: int
+    """
+    point = click_data['points'][0]
+    if 'customdata' in point and point['customdata'] is not None:
+        customdata = point['customdata']
+        return int(customdata[0] if isinstance(customdata, list) else customdata)
+    return int(spatial_index.query([point['x'], point['y']])[1])
+
+
+def relayout_window(relayout_data):
+    """Get the axis window from the relayoutData of a graph.
+    :param relayout_data: the relayoutData of the graph
+    :type relayout_data: dict
+    :return: the [x_range, y_range] window, [None, None] when the axes were reset, or None when the window
+             did not change
+    :rtype: list
+    """
+    if not relayout_data:
+        return None
+    if relayout_data.get('xaxis.autorange') or relayout_data.get('autosize'):
+        return [None, None]
+    window = []
+    for axis in ('xaxis', 'yaxis'):
+        if f'{axis}.range[0]' in relayout_data:
+            window.append([relayout_data[f'{axis}.range[0]'], relayout_data[f'{axis}.range[1]']])
+        elif f'{axis}.range' in relayout_data:
+            window.append(list(relayout_data[f'{axis}.range']))
+        else:
+            window.append(None)
+    return None if window == [None, None] else window
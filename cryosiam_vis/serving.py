@@ -0,0 +1,42 @@
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:
+    BaseApplication = None
+
+
+def serve(create_app, host='127.0.0.1', port=8050, workers=None, threads=None):
+    """Serve a Dash app. Without workers and threads the app runs in the Dash development server (one
+    process). Otherwise it is served by gunicorn with the given number of worker processes, each with
+    the given number of threads, and every worker creates its own app with create_app(). The session states
+    are shared by the workers through the session folder, while the opened files and their loading progress
+    are kept per worker (a worker that did not start opening a file opens it when it is first used).
+    :param create_app: function without arguments that creates the Dash app
+    :type create_app: callable
+    :param host: the host to listen on
+    :type host: str
+    :param port: the port to listen on
+    :type port: int
+    :param workers: number of worker processes
+    :type workers: int
+    :param threads: number of threads per worker process
+    :type threads: int
+    """
+    if workers is None and threads is None:
+        create_app().run(host=host, port=port, debug=False, dev_tools_props_check=False)
+        return
+    if BaseApplication is None:
+        raise ImportError('gunicorn is required for serving the app with workers, '
+                          'install it with: pip install gunicorn')
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f'{host}:{port}')
+            self.cfg.set('workers', workers or 1)
+            self.cfg.set('threads', threads or 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('timeout', 300)
+
+        def load(self):
+            return create_app().server
+
+    Application().run()
@@ -0,0 +1,117 @@
+import os
+import json
+import starfile
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+from cryosiam_vis.io_utils import cache_path, source_signature
+from cryosiam_vis.umap_data import write_column_cache, read_column_cache
+
+MICROGRAPH_COLUMN = 'rlnMicrographName'
+COORDINATE_COLUMNS = ['rlnCoordinateZ', 'rlnCoordinateY', 'rlnCoordinateX']
+
+
+def read_star_particles(star_file):
+    """Read the particles table of a STAR file.
+    :param star_file: path to the STAR file
+    :type star_file: str
+    :return: the particles table
+    :rtype: pd.DataFrame
+    """
+    particles = starfile.read(star_file)
+    if type(particles) is dict:
+        particles = particles['particles']
+    return particles
+
+
+def build_star_index(star_file, cache_dir, signature):
+    """Write the coordinates of a STAR file as a column cache sorted by micrograph name, together with the
+    range of rows of every micrograph (partitions.json), so that the coordinates of one tomogram are read
+    without parsing the STAR file.
+    :param star_file: path to the STAR file
+    :type star_file: str
+    :param cache_dir: path to the cache folder
+    :type cache_dir: str
+    :param signature: signature of the STAR file
+    :type signature: np.array
+    :return: the sorted coordinates table and the partitions
+    :rtype: tuple
+    """
+    particles = read_star_particles(star_file)
+    if particles.shape[0] == 0:
+        table = pd.DataFrame({c: np.zeros(0, dtype=np.float64) for c in COORDINATE_COLUMNS})
+        names = np.zeros(0, dtype=str)
+    else:
+        names = particles[MICROGRAPH_COLUMN].astype(str).to_numpy()
+        order = np.argsort(names, kind='stable')
+        names = names[order]
+        table = pd.DataFrame({c: particles[c].to_numpy(dtype=np.float64)[order] for c in COORDINATE_COLUMNS})
+    micrographs, starts = np.unique(names, return_index=True)
+    stops = np.append(starts[1:], len(names))
+    partitions = {str(m): [int(a), int(b)] for m, a, b in zip(micrographs, starts, stops)}
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(os.path.join(cache_dir, 'partitions.json'), 'w') as f:
+            json.dump({'signature': signature.tolist(), 'rows': len(names), 'partitions': partitions}, f)
+        write_column_cache(table, cache_dir, signature)
+    except OSError:
+        pass
+    return table, partitions
+
+
+def load_star_index(star_file):
+    """Load the coordinate index of a STAR file from the cache folder next to the file, building it when
+    it is missing or when the STAR file changed.
+    :param star_file: path to the STAR file
+    :type star_file: str
+    :return: the coordinates table (memory-mapped columns when read from the cache), the partitions
+             mapping every micrograph name to its [start, stop) rows, and the number of particles
+    :rtype: tuple
+    """
+    cache_dir = cache_path(star_file, '.coordinates')
+    signature = source_signature(star_file)
+    partitions_file = os.path.join(cache_dir, 'partitions.json')
+    if os.path.exists(partitions_file):
+        with open(partitions_file, 'r') as f:
+            meta = json.load(f)
+        if meta['signature'] == signature.tolist():
+            table = read_column_cache(cache_dir, signature, COORDINATE_COLUMNS)
+            if table is not None:
+                return table, meta['partitions'], meta['rows']
+    table, partitions = build_star_index(star_file, cache_dir, signature)
+    return table, partitions, len(table)
+
+
+def load_star_coordinates(star_file, micrograph_name):
+    """Get the (z, y, x) coordinates of the particles of one micrograph (tomogram) from a STAR file, reading
+    only its rows from the coordinate index.
+    :param star_file: path to the STAR file
+    :type star_file: str
+    :param micrograph_name: the rlnMicrographName of the tomogram
+    :type micrograph_name: str
+    :return: array of shape (n, 3) with the coordinates, or None if the STAR file has no particles
+    :rtype: np.array
+    """
+    table, partitions, rows = load_star_index(star_file)
+    if rows == 0:
+        return None
+    start, stop = partitions.get(micrograph_name, (0, 0))
+    return np.stack([np.asarray(table[c].to_numpy()[start:stop]) for c in COORDINATE_COLUMNS], axis=1)
+
+
+def load_coordinates(star_files, micrograph_name, workers=8):
+    """Get the coordinates of the particles of one micrograph from several STAR files, read in parallel.
+    :param star_files: paths to the STAR files
+    :type star_files: list
+    :param micrograph_name: the rlnMicrographName of the tomogram
+    :type micrograph_name: str
+    :param workers: number of threads
+    :type workers: int
+    :return: list with the coordinates from every STAR file (None for files without particles)
+    :rtype: list
+    """
+    if not star_files:
+        return []
+    with ThreadPoolExecutor(max_workers=min(workers, len(star_files))) as executor:
+        return list(executor.map(lambda star_file: load_star_coordinates(star_file, micrograph_name), star_files))
@@ -0,0 +1,259 @@
+import os
+import json
+import math
+import yaml
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from dash import dcc, html, Input, Output, State
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset, cache_path, source_signature
+from cryosiam_vis.instance_index import load_instance_index
+from cryosiam_vis.particle_gallery import scale_image, write_png
+from cryosiam_vis.pyramid import downsample
+from cryosiam_vis.save_instance_file import generate_particle_subtomogram, select_instances
+
+ATLAS_THUMBNAIL_FACTOR = 2
+
+ATLAS_TOOLTIP_JS = """
+function(hoverData, atlas) {
+    var no_update = window.dash_clientside.no_update;
+    if (!hoverData || !atlas || !hoverData.points.length) {
+        return [false, no_update, no_update];
+    }
+    var point = hoverData.points[0];
+    if (!point.customdata) {
+        return [false, no_update, no_update];
+    }
+    var label = String(point.customdata[1]);
+    if (atlas.prefix && label.indexOf(atlas.prefix) === 0) {
+        label = label.slice(atlas.prefix.length);
+    }
+    var offset = atlas.offsets[label];
+    if (!offset) {
+        return [false, no_update, no_update];
+    }
+    return [true, point.bbox, {
+        type: 'Div', namespace: 'dash_html_components',
+        props: {style: {width: atlas.size + 'px', height: atlas.size + 'px',
+                        backgroundImage: 'url(' + atlas.url + ')',
+                        backgroundPosition: '-' + offset[0] + 'px -' + offset[1] + 'px'}}
+    }];
+}
+"""
+
+
+def parser_helper(description=None):
+    description = "Build the thumbnail atlases shown on hover in the UMAP plots" if description is None \
+        else description
+    parser = argparse.ArgumentParser(description, add_help=True,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--config', type=str, required=True,
+                        help='path to the config file used for running CryoSiam')
+    parser.add_argument('--tomo', type=str, required=True, nargs='+',
+                        help='Tomogram filenames (including the file extension)')
+    parser.add_argument('--mask', action='store_true',
+                        help='Mask out the voxels outside the instances')
+    parser.add_argument('--workers', type=int, required=False, default=4,
+                        help='Number of worker threads')
+    return parser
+
+
+def atlas_paths(instances_file):
+    """Get the paths of the atlas image and its offset index, stored in the cache folder next to the
+    instances file.
+    :param instances_file: path to the *_instance_preds.h5 file
+    :type instances_file: str
+    :return: paths to the .atlas.png and .atlas.json files
+    :rtype: tuple
+    """
+    return cache_path(instances_file, '.atlas.png'), cache_path(instances_file, '.atlas.json')
+
+
+def atlas_signature(tomo_file, instances_file):
+    return np.concatenate([source_signature(tomo_file), source_signature(instances_file)]).tolist()
+
+
+def particle_thumbnail(patch, factor=ATLAS_THUMBNAIL_FACTOR):
+    """Render the central slab of factor z slices of a particle, downsampled by the factor (a power of 2), as
+    uint8 thumbnail.
+    :param patch: the subtomogram of the particle
+    :type patch: np.array
+    :param factor: the downsampling factor
+    :type factor: int
+    :return: the thumbnail
+    :rtype: np.array
+    """
+    start = max(0, patch.shape[0] // 2 - factor // 2)
+    image = patch[start:start + factor].astype(np.float32)
+    for _ in range(int(math.log2(factor))):
+        image = downsample(image, False)
+    image = image.mean(axis=0)
+    return scale_image(image, *np.percentile(image, [1, 99]))
+
+
+def build_atlas(tomo_file, instances_file, instance_ids=None, masked=False, factor=ATLAS_THUMBNAIL_FACTOR,
+                workers=4):
+    """Pack the thumbnails of the instances of a tomogram into one sprite atlas image, with an index of the
+    (x, y) pixel offset of every instance in the atlas.
+    :param tomo_file: path to the tomogram
+    :type tomo_file: str
+    :param instances_file: path to the *_instance_preds.h5 file
+    :type instances_file: str
+    :param instance_ids: the instance ids (all instances if None)
+    :type instance_ids: list
+    :param masked: whether to mask out the voxels outside the instance
+    :type masked: bool
+    :param factor: the downsampling factor of the thumbnails
+    :type factor: int
+    :param workers: number of worker threads
+    :type workers: int
+    :return: the atlas index
+    :rtype: dict
+    """
+    tomo = load_tomogram(tomo_file)
+    instances = open_h5_dataset(instances_file, 'instances')
+    index = load_instance_index(instances_file, instances)
+    ids = select_instances(index) if instance_ids is None else np.asarray(instance_ids)
+    columns = max(1, math.ceil(math.sqrt(len(ids))))
+    rows = max(1, math.ceil(len(ids) / columns))
+    size = None
+    atlas = None
+
+    def render(instance_id):
+        return particle_thumbnail(generate_particle_subtomogram(tomo, instances, int(instance_id), masked, index),
+                                  factor)
+
+    offsets = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, thumbnail in enumerate(executor.map(render, ids)):
+            if atlas is None:
+                size = thumbnail.shape[0]
+                atlas = np.zeros((rows * size, columns * size), dtype=np.uint8)
+            y, x = (i // columns) * size, (i % columns) * size
+            atlas[y:y + size, x:x + size] = thumbnail
+            offsets[str(int(ids[i]))] = [x, y]
+    instances.file.close()
+    if atlas is None:
+        size = 64 // factor
+        atlas = np.zeros((size, size), dtype=np.uint8)
+    atlas_file, index_file = atlas_paths(instances_file)
+    os.makedirs(os.path.dirname(atlas_file), exist_ok=True)
+    write_png(atlas_file, atlas)
+    atlas_index = {'signature': atlas_signature(tomo_file, instances_file), 'size': size, 'offsets': offsets}
+    with open(index_file, 'w') as f:
+        json.dump(atlas_index, f)
+    return atlas_index
+
+
+def load_atlas_index(tomo_file, instances_file):
+    """Load the offset index of the atlas of a tomogram.
+    :param tomo_file: path to the tomogram
+    :type tomo_file: str
+    :param instances_file: path to the *_instance_preds.h5 file
+    :type instances_file: str
+    :return: the atlas index, or None if the atlas was not built or is outdated
+    :rtype: dict
+    """
+    atlas_file, index_file = atlas_paths(instances_file)
+    if not os.path.exists(atlas_file) or not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, 'r') as f:
+            atlas_index = json.load(f)
+        if atlas_index['signature'] != atlas_signature(tomo_file, instances_file):
+            return None
+    except (OSError, ValueError, KeyError):
+        return None
+    return atlas_index
+
+
+def atlas_store_data(tomo_file, instances_file, url, prefix=''):
+    """Get the data of the atlas store of a tomogram used by the hover tooltips.
+    :param tomo_file: path to the tomogram
+    :type tomo_file: str
+    :param instances_file: path to the *_instance_preds.h5 file
+    :type instances_file: str
+    :param url: the url the atlas image is served on (the version of the atlas is added to it, so the
+                browser fetches rebuilt atlases)
+    :type url: str
+    :param prefix: prefix of the instance ids in the hover labels of the points, for ex. the tomogram
+                   filename and '_' for the labels of the clusters UMAP
+    :type prefix: str
+    :return: the store data, or None if there is no atlas
+    :rtype: dict
+    """
+    atlas_index = load_atlas_index(tomo_file, instances_file)
+    if atlas_index is None:
+        return None
+    version = '-'.join(str(v) for v in atlas_index['signature'])
+    return {'url': f'{url}?v={version}', 'size': atlas_index['size'], 'prefix': prefix,
+            'offsets': atlas_index['offsets']}
+
+
+def add_atlas_route(server, atlas_file_of):
+    """Serve the atlas images on /atlas/<tomogram filename>. The images are cached by the browser, so
+    hovering over the points only moves the visible part of the atlas.
+    :param server: the Flask server of the app
+    :type server: flask.Flask
+    :param atlas_file_of: function returning the path of the atlas image of a tomogram filename (None for
+                          unknown tomograms)
+    :type atlas_file_of: callable
+    """
+    import flask
+
+    def send_atlas(filename):
+        atlas_file = atlas_file_of(filename)
+        if atlas_file is None or not os.path.exists(atlas_file):
+            flask.abort(404)
+        return flask.send_file(atlas_file, mimetype='image/png', max_age=3600, conditional=True)
+
+    server.add_url_rule('/atlas/<path:filename>', 'cryosiam_vis_atlas', send_atlas)
+
+
+def with_atlas_tooltip(component, graph_id):
+    """Add the thumbnail tooltip of a graph next to the component holding the graph.
+    :param component: the graph, or the component wrapping it (for ex. dcc.Loading)
+    :type component: dash component
+    :param graph_id: id of the graph
+    :type graph_id: str
+    :return: the component with the tooltip
+    :rtype: html.Div
+    """
+    return html.Div([component, dcc.Tooltip(id=f'{graph_id}-tooltip', direction='right')],
+                    style={'position': 'relative'})
+
+
+def register_atlas_tooltip(app, graph_id, store_id='atlas-index'):
+    """Show the thumbnail of the hovered point of a graph in its tooltip. The callback runs in the browser,
+    it only looks up the offset of the instance in the atlas store.
+    :param app: the Dash app
+    :type app: Dash
+    :param graph_id: id of the graph, its points carry the instance id as second customdata value
+    :type graph_id: str
+    :param store_id: id of the store with the atlas data
+    :type store_id: str
+    """
+    app.clientside_callback(ATLAS_TOOLTIP_JS,
+                            [Output(f'{graph_id}-tooltip', 'show'), Output(f'{graph_id}-tooltip', 'bbox'),
+                             Output(f'{graph_id}-tooltip', 'children')],
+                            Input(graph_id, 'hoverData'),
+                            State(store_id, 'data'))
+
+
+def main(args):
+    with open(args.config, "r") as ymlfile:
+        config = yaml.safe_load(ymlfile)
+    for tomo_name in args.tomo:
+        tomo_root_name = tomo_name.split(config['file_extension'])[0]
+        instances_file = os.path.join(config['instances_mask_folder'], tomo_root_name + '_instance_preds.h5')
+        atlas_index = build_atlas(os.path.join(config['data_folder'], tomo_name), instances_file,
+                                  masked=args.mask, workers=args.workers)
+        print(f'{tomo_name}: atlas with {len(atlas_index["offsets"])} thumbnails written to '
+              f'{atlas_paths(instances_file)[0]}')
+
+
+if __name__ == '__main__':
+    parser = parser_helper()
+    args = parser.parse_args()
+    main(args)
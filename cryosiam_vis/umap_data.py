@@ -0,0 +1,194 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+
+from cryosiam_vis.io_utils import cache_path, source_signature
+from cryosiam_vis.instrumentation import staged
+
+INDEX_COLUMNS = ['tomogram', 'instance_id']
+
+
+def write_column_cache(table, cache_dir, signature):
+    """Write a table as one .npy file per column, with the dtypes and the source signature in meta.json.
+    Categorical columns are stored as integer codes and their categories, other non-numeric columns as
+    strings with a mask of the missing values. The cache is written to a temporary folder that replaces
+    the cache folder when complete, so that other processes never read a partially written cache.
+    :param table: the table
+    :type table: pd.DataFrame
+    :param cache_dir: path to the cache folder
+    :type cache_dir: str
+    :param signature: signature of the source file
+    :type signature: np.array
+    """
+    parent = os.path.dirname(cache_dir)
+    os.makedirs(parent, exist_ok=True)
+    tmp_dir = tempfile.mkdtemp(prefix=os.path.basename(cache_dir) + '.', suffix='.tmp', dir=parent)
+    try:
+        columns = []
+        for i, name in enumerate(table.columns):
+            values = table[name]
+            column = {'name': str(name), 'file': f'{i}.npy'}
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                column['categories'] = [str(c) for c in values.cat.categories]
+                values = values.cat.codes.to_numpy()
+            elif values.dtype.kind in 'biuf':
+                values = values.to_numpy()
+            else:
+                missing = values.isna().to_numpy()
+                if missing.any():
+                    column['missing'] = f'{i}.missing.npy'
+                    np.save(os.path.join(tmp_dir, column['missing']), missing)
+                values = values.astype(str).to_numpy().astype(str)
+            np.save(os.path.join(tmp_dir, column['file']), values)
+            columns.append(column)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'signature': signature.tolist(), 'columns': columns}, f)
+        if os.path.exists(cache_dir):
+            old_dir = f'{tmp_dir}.old'
+            os.replace(cache_dir, old_dir)
+            shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(tmp_dir, cache_dir)
+    finally:
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def read_column_cache(cache_dir, signature, columns=None):
+    """Read a table from a column cache, memory-mapping only the requested columns.
+    :param cache_dir: path to the cache folder
+    :type cache_dir: str
+    :param signature: signature of the source file, the cache is ignored if it does not match
+    :type signature: np.array
+    :param columns: names of the columns to read (all columns if None)
+    :type columns: list
+    :return: the table or None if the cache is missing, outdated or being replaced
+    :rtype: pd.DataFrame
+    """
+    meta_file = os.path.join(cache_dir, 'meta.json')
+    try:
+        with open(meta_file, 'r') as f:
+            meta = json.load(f)
+        if meta['signature'] != signature.tolist():
+            return None
+        data = {}
+        for column in meta['columns']:
+            if columns is not None and column['name'] not in columns:
+                continue
+            values = np.load(os.path.join(cache_dir, column['file']), mmap_mode='r')
+            if 'categories' in column:
+                values = pd.Categorical.from_codes(values, column['categories'])
+            elif 'missing' in column:
+                values = values.astype(object)
+                values[np.load(os.path.join(cache_dir, column['missing']))] = np.nan
+            data[column['name']] = values
+    except (OSError, ValueError, KeyError):
+        return None
+    return pd.DataFrame(data, copy=False)
+
+
+def read_csv_cached(file_path, columns=None, prepare=None):
+    """Read a csv table through a columnar binary cache stored in the cache folder next to the file.
+    The first read parses the csv, normalises it with prepare and writes the cache. Later reads only
+    memory-map the requested columns. The cache is invalidated when the csv file changes.
+    :param file_path: path to the csv file
+    :type file_path: str
+    :param columns: names of the columns to read (all columns if None)
+    :type columns: list
+    :param prepare: function normalising the parsed table before it is cached
+    :type prepare: callable
+    :return: the table
+    :rtype: pd.DataFrame
+    """
+    cache_dir = cache_path(file_path, '.columns')
+    signature = source_signature(file_path)
+    table = read_column_cache(cache_dir, signature, columns)
+    if table is not None:
+        return table
+    table = pd.read_csv(file_path)
+    if prepare is not None:
+        table = prepare(table)
+    try:
+        write_column_cache(table, cache_dir, signature)
+    except OSError:
+        pass
+    return table if columns is None else table[[c for c in table.columns if c in columns]]
+
+
+def parse_cluster_labels(umap):
+    """Split the 'labels' column of a clusters UMAP table ('{tomogram}_{instance id}') into the
+    'tomogram' and 'instance_id' columns, with vectorised string operations.
+    :param umap: the clusters UMAP table
+    :type umap: pd.DataFrame
+    :return: the table with the added columns
+    :rtype: pd.DataFrame
+    """
+    parts = umap['labels'].astype(str).str.rsplit('_', n=1, expand=True)
+    umap['tomogram'] = parts[0].astype('category')
+    umap['instance_id'] = parts[1].astype(np.int64)
+    return umap
+
+
+def prepare_cluster_umap(umap):
+    umap['class'] = umap['class'].astype(str).astype('category')
+    return parse_cluster_labels(umap)
+
+
+@staged('stage/load_cluster_umap')
+def load_cluster_umap(file_path, columns=None):
+    """Load a {clustering}_clusters_umap_data.csv table with normalised dtypes and parsed labels.
+    :param file_path: path to the csv file
+    :type file_path: str
+    :param columns: names of the columns to read (all columns if None)
+    :type columns: list
+    :return: the clusters UMAP table
+    :rtype: pd.DataFrame
+    """
+    return read_csv_cached(file_path, columns, prepare_cluster_umap)
+
+
+def prepare_embeddings_umap(umap):
+    if 'semantic_class' in umap.columns:
+        umap['semantic_class'] = umap['semantic_class'].astype(str).astype('category')
+    if 'semantic_class2' in umap.columns:
+        umap['semantic_class2'] = umap['semantic_class']
+    return umap
+
+
+@staged('stage/load_embeddings_umap')
+def load_embeddings_umap(file_path, columns=None):
+    """Load a *_embeds_umap_data.csv table with normalised dtypes (semantic classes as categories).
+    :param file_path: path to the csv file
+    :type file_path: str
+    :param columns: names of the columns to read (all columns if None)
+    :type columns: list
+    :return: the embeddings UMAP table
+    :rtype: pd.DataFrame
+    """
+    return read_csv_cached(file_path, columns, prepare_embeddings_umap)
+
+
+def build_tomogram_index(umap):
+    """Index the rows of a clusters UMAP table by tomogram and by (tomogram, instance id), so that the rows
+    of a tomogram and the row of a clicked instance are found without scanning the table.
+    :param umap: the clusters UMAP table with parsed labels
+    :type umap: pd.DataFrame
+    :return: dictionary with 'rows', mapping every tomogram to the positions of its rows, and 'positions',
+             mapping every (tomogram, instance id) pair to its row position
+    :rtype: dict
+    """
+    rows = umap.groupby('tomogram', sort=False, observed=True).indices
+    positions = dict(zip(zip(umap['tomogram'].tolist(), umap['instance_id'].tolist()), range(len(umap))))
+    return {'rows': rows, 'positions': positions}
+
+
+def hover_columns(umap):
+    """Get the columns shown on hover, i.e. all columns except the ones added for indexing.
+    :param umap: the UMAP table
+    :type umap: pd.DataFrame
+    :return: list of column names
+    :rtype: list
+    """
+    return [c for c in umap.columns if c not in INDEX_COLUMNS]
@@ -1,17 +1,34 @@
-import io
 import os
-import math
 import yaml
-import h5py
-import base64
-import mrcfile
+import argparse
+from functools import partial
 import numpy as np
-import pandas as pd
-import plotly.express as px
-from scipy import ndimage as ndi
 import plotly.graph_objects as go
 import dash_bootstrap_components as dbc
-from dash import Dash, dcc, html, Input, Output, State, callback, clientside_callback
+from dash import Dash, dcc, html, Input, Output, State, no_update
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_memmap, advise_willneed
+from cryosiam_vis.app_state import (SessionStore, HandlePool, BackgroundLoader, SessionTaskQueue, session_id_store,
+                                    default_session_folder, next_files)
+from cryosiam_vis.cache import cache_from_config
+from cryosiam_vis.instrumentation import metrics_from_config, staged
+from cryosiam_vis.instance_index import load_instance_index, extract_particle
+from cryosiam_vis.particle_rendering import RENDER_MODES, particle_figure, figure_payload
+from cryosiam_vis.serving import serve
+from cryosiam_vis.scatter import (DEFAULT_MAX_POINTS, scatter_figure, build_spatial_index, clicked_row,
+                                  nearest_rows, relayout_window)
+from cryosiam_vis.thumbnail_atlas import (atlas_paths, atlas_store_data, add_atlas_route, with_atlas_tooltip,
+                                          register_atlas_tooltip)
+from cryosiam_vis.umap_data import load_cluster_umap, build_tomogram_index
+
+SESSION_DEFAULTS = {
+    'selected_file': '',
+    'umap_window': [None, None],
+    'selected_cluster': None,
+    'render_mode': RENDER_MODES[0],
+    'selected_instance': None,
+    'subcluster_instance': None
+}
 
 
 def parser_helper(description=None):
@@ -22,181 +39,257 @@ def parser_helper(description=None):
                         help='path to the config file used for running CryoSiam cluster embeddings')
     parser.add_argument('--clustering', type=str, required=True,
                         help='clustering type, one of ["kmeans", "spectral"]')
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1',
+                        help='host the app listens on')
+    parser.add_argument('--port', type=int, required=False, default=8052,
+                        help='port the app listens on')
+    parser.add_argument('--workers', type=int, required=False, default=None,
+                        help='number of worker processes, serves the app with gunicorn instead of the '
+                             'development server')
+    parser.add_argument('--threads', type=int, required=False, default=None,
+                        help='number of threads per worker process, serves the app with gunicorn instead of the '
+                             'development server')
     return parser
 
-def main(config, clustering):
+def create_app(config, clustering, session_folder=None):
+    """Create the clusters Dash app. The state of every browser session (selected file, cluster,
+    instances, ...) is kept in a SessionStore, and the tomograms, instance volumes and UMAP tables are
+    opened once per process and shared read-only by all sessions.
+    :param config: path to the config file
+    :type config: str
+    :param clustering: clustering type, one of ["kmeans", "spectral"]
+    :type clustering: str
+    :param session_folder: folder for sharing the session states between worker processes, the states
+                           are kept in memory if None
+    :type session_folder: str
+    :return: the app
+    :rtype: Dash
+    """
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    umap = pd.read_csv(os.path.join(config['prediction_folder'], f'{clustering}_clusters_umap_data.csv'))
-    umap['class'] = umap['class'].apply(str)
-    files = list({'_'.join(x.split('_')[:-1]) for x in umap['labels'].values.tolist()})
-    selected_file = ''
-    print(files)
-    subcluster_umap = pd.DataFrame(columns=['class', 'x', 'y', 'labels', 'current_class'])
-    tomo = None
-    instances = None
-    selected_particle = None
+    metrics = metrics_from_config(config, 'clusters')
+    umap = load_cluster_umap(os.path.join(config['prediction_folder'], f'{clustering}_clusters_umap_data.csv'))
+    umap_index = build_tomogram_index(umap)
+    files = list(umap_index['rows'])
+    max_points = int(config.get('scatter_max_points', DEFAULT_MAX_POINTS))
+    sessions = SessionStore(SESSION_DEFAULTS, session_folder)
+    handles = HandlePool()
+    loader = BackgroundLoader(handles, int(config.get('loader_workers', 2)))
+    prefetcher = SessionTaskQueue()
+    neighbours_count = int(config.get('nearest_neighbours', 8))
+    prefetch_count = int(config.get('prefetch_files', 0))
+    prefetch_budget = int(config.get('prefetch_memory_mb', 2048) * 1024 ** 2)
+    particle_cache = cache_from_config(config)
 
     app = Dash(__name__, external_stylesheets=[dbc.themes.SANDSTONE, dbc.icons.FONT_AWESOME])
     server = app.server
+    if metrics is not None:
+        metrics.instrument(app)
 
-    app.layout = dbc.Container(
-        [
-            html.Div(["SimSiam embedding clusters visualization"], className="bg-primary text-white h3 p-2"),
-            html.Hr(),
-            dbc.Row(dbc.Col(dbc.Card(dbc.CardBody([
-                html.Div([
-                    html.H6('Select a file for visualization:'),
-                    dcc.Loading(dcc.Dropdown(files, '', id='file-dropdown'), type="circle")])
-            ])), width=6)),
-            html.Hr(),
-            dbc.Row(
-                [
-                    dbc.Col(dbc.Card(
-                        [
-                            dbc.CardHeader("Clusters UMAP"),
-                            dbc.CardBody(
-                                [
-                                    html.Div(["Select a file to visualize"], id='umap-plot-info'),
-                                    dbc.Col(dcc.Loading(dcc.Graph(id='umap-plot'), type="circle"),
-                                            width='auto')
-                                ])
-                        ]), width=6),
-                    dbc.Col(dbc.Card(
-                        [
-                            dbc.CardHeader("Structure view"),
+    def layout():
+        return dbc.Container(
+            [
+                session_id_store(),
+                dcc.Store(id='atlas-index'),
+                html.Div(["SimSiam embedding clusters visualization"], className="bg-primary text-white h3 p-2"),
+                html.Hr(),
+                dbc.Row(dbc.Col(dbc.Card(dbc.CardBody([
+                    html.Div([
+                        html.H6('Select a file for visualization:'),
+                        dcc.Loading(dcc.Dropdown(files, '', id='file-dropdown'), type="circle"),
+                        html.Div(id='loading-status'),
+                        dcc.Interval(id='loading-interval', interval=500, disabled=True)])
+                ])), width=6)),
+                html.Hr(),
+                dbc.Row(
+                    [
+                        dbc.Col(dbc.Card(
+                            [
+                                dbc.CardHeader("Clusters UMAP"),
+                                dbc.CardBody(
+                                    [
+                                        html.Div(["Select a file to visualize"], id='umap-plot-info'),
+                                        dbc.Col(with_atlas_tooltip(
+                                            dcc.Loading(dcc.Graph(id='umap-plot', clear_on_unhover=True),
+                                                        type="circle"), 'umap-plot'),
+                                                width='auto')
+                                    ])
+                            ]), width=6),
+                        dbc.Col(dbc.Card(
+                            [
+                                dbc.CardHeader("Structure view"),
+                                dcc.Loading(dbc.CardBody([
+                                    html.Div(["Select a point the the UMAP plot"], id='selected-structure-info'),
+                                    html.Div(["Render mode:"]),
+                                    dcc.Dropdown(RENDER_MODES, SESSION_DEFAULTS['render_mode'], id='render-mode'),
+                                    dbc.Col(dcc.Graph(id='selected-structure'), width='auto')
+                                ]), type="circle"),
+                            ]), width=6)
+                    ]),
+                html.Hr(),
+                dbc.Row(
+                    [
+                        dbc.Col(dbc.Card([
+                            dbc.CardHeader("Subcluster UMAP"),
                             dcc.Loading(dbc.CardBody([
-                                html.Div(["Select a point the the UMAP plot"], id='selected-structure-info'),
-                                dbc.Col(dcc.Graph(id='selected-structure'), width='auto')
-                            ]), type="circle"),
+                                html.Div(["Select a point the the UMAP plot"], id='subcluster-umap-plot-info'),
+                                dbc.Col(with_atlas_tooltip(dcc.Graph(id='subcluster-umap-plot', clear_on_unhover=True),
+                                                           'subcluster-umap-plot'), width='auto')
+                            ]),
+                                type="circle")
+                        ]), width=6),
+                        dbc.Col(dbc.Card([
+                            dbc.CardHeader("Subcluster structure view"),
+                            dcc.Loading(
+                                dbc.CardBody([
+                                    html.Div(["Select a point the the UMAP plot"], id='subcluster-selected-structure-info'),
+                                    dbc.Col(
+                                        dcc.Graph(id='subcluster-selected-structure'),
+                                        width='auto')
+                                ]), type="circle")
                         ]), width=6)
-                ]),
-            html.Hr(),
-            dbc.Row(
-                [
-                    dbc.Col(dbc.Card([
-                        dbc.CardHeader("Subcluster UMAP"),
-                        dcc.Loading(dbc.CardBody([
-                            html.Div(["Select a point the the UMAP plot"], id='subcluster-umap-plot-info'),
-                            dbc.Col(dcc.Graph(id='subcluster-umap-plot'), width='auto')
-                        ]),
-                            type="circle")
-                    ]), width=6),
-                    dbc.Col(dbc.Card([
-                        dbc.CardHeader("Subcluster structure view"),
-                        dcc.Loading(
-                            dbc.CardBody([
-                                html.Div(["Select a point the the UMAP plot"], id='subcluster-selected-structure-info'),
-                                dbc.Col(
-                                    dcc.Graph(id='subcluster-selected-structure'),
-                                    width='auto')
-                            ]), type="circle")
-                    ]), width=6)
-                ])
-        ],
-        fluid=True,
-    )
-
-    def generate_scatter_plot():
-        nonlocal umap
-        nonlocal selected_file
-        umap['current_class'] = [row['class'] if selected_file in row['labels'] else '0' for i, row in
-                                 umap.iterrows()]
-        selected_samples = umap[umap['current_class'] != '0']
-        fig = px.scatter(selected_samples.sort_values('current_class'),
-                         x='x', y='y', color='current_class',
-                         hover_data=selected_samples.columns, opacity=0.5,
-                         color_discrete_sequence=px.colors.qualitative.Light24, width=600, height=600)
+                    ])
+            ],
+            fluid=True,
+        )
+
+    app.layout = layout
+
+    def load_selected_umap(selected_file):
+        def load():
+            selected_umap = umap.iloc[umap_index['rows'].get(selected_file, [])].copy()
+            selected_umap['current_class'] = selected_umap['class']
+            return selected_umap, build_spatial_index(selected_umap)
+
+        return handles.get(('selected', selected_file), load)
+
+    def load_subcluster_umap(selected_file, cluster_id):
+        def load():
+            selected_umap, _ = load_selected_umap(selected_file)
+            subcluster_umap = selected_umap[selected_umap['class'] == str(cluster_id)]
+            return subcluster_umap, build_spatial_index(subcluster_umap)
+
+        return handles.get(('subcluster', selected_file, cluster_id), load)
+
+    def volume_paths(selected_file):
+        return (os.path.join(config['data_folder'], selected_file),
+                os.path.join(config['instances_mask_folder'],
+                             selected_file.split(config['file_extension'])[0] + '_instance_preds.h5'))
+
+    @staged('stage/open_volumes')
+    def open_volumes(selected_file, report=lambda fraction, message: None):
+        tomo_file, instances_file = volume_paths(selected_file)
+        report(0., 'Opening the tomogram')
+        tomo = load_tomogram(tomo_file)
+        report(1 / 3, 'Opening the instance segmentation')
+        instances = open_h5_memmap(instances_file, 'instances')
+        report(2 / 3, 'Indexing the instances')
+        return tomo, instances, load_instance_index(instances_file, instances)
+
+    def load_volumes(selected_file):
+        return handles.get(('volumes', selected_file), lambda: open_volumes(selected_file))
+
+    def prefetch(selected_file):
+        budget = prefetch_budget
+        for file in next_files(files, selected_file, prefetch_count):
+            paths = [p for p in volume_paths(file) if os.path.exists(p)]
+            size = sum(os.path.getsize(p) for p in paths)
+            if size > budget:
+                break
+            budget -= size
+            for path in paths:
+                advise_willneed(path)
+            loader.submit(('volumes', file), lambda report, file=file: open_volumes(file, report))
+
+    def loading_status(selected_file):
+        if not selected_file:
+            return True, None
+        status = loader.status(('volumes', selected_file))
+        if status['error'] is not None:
+            return True, html.Div([f"Loading {selected_file} failed: {status['error']}"], className='text-danger')
+        if not status['started']:
+            # the loading was started by another worker process, this one opens the files on first use
+            return True, html.Div([f"{selected_file} is opened on first use"])
+        if status['done']:
+            return True, html.Div([f"{selected_file} loaded"])
+        return False, html.Div([html.Div([status['message']]),
+                                dbc.Progress(value=int(100 * status['fraction']), striped=True, animated=True)])
+
+    def generate_scatter_plot(state):
+        selected_umap, _ = load_selected_umap(state['selected_file'])
+        fig = scatter_figure(selected_umap, color='current_class', hover=['labels', 'class'],
+                             max_points=max_points, x_range=state['umap_window'][0], y_range=state['umap_window'][1])
         return fig
 
-    def generate_subcluster_scatter_plot():
-        nonlocal subcluster_umap
-        nonlocal selected_file
-        subcluster_umap['current_class'] = [row['class'] if selected_file in row['labels'] else '0' for i, row in
-                                            subcluster_umap.iterrows()]
-        selected_samples = subcluster_umap[subcluster_umap['current_class'] != '0']
-        fig = px.scatter(selected_samples.sort_values('current_class'),
-                         x='x', y='y', color='current_class',
-                         hover_data=selected_samples.columns, opacity=0.5,
-                         color_discrete_sequence=px.colors.qualitative.Light24, width=600, height=600)
+    def generate_subcluster_scatter_plot(state):
+        subcluster_umap, _ = load_subcluster_umap(state['selected_file'], state['selected_cluster'])
+        fig = scatter_figure(subcluster_umap, color='current_class', hover=['labels', 'class'],
+                             max_points=max_points)
         return fig
 
-    def load_data_files():
-        nonlocal tomo
-        nonlocal instances
-        nonlocal selected_file
-        nonlocal config
-        tomo = mrcfile.open(os.path.join(config['data_folder'], selected_file)).data
-        instances_file = os.path.join(config['instances_mask_folder'],
-                                      selected_file.split(config['file_extension'])[0] + '_instance_preds.h5')
-        with h5py.File(instances_file, 'r') as f:
-            instances = f['instances'][()]
-
-    def generate_particle_plot(instance_id):
-        nonlocal tomo
-        nonlocal instances
-        nonlocal selected_particle
-        mask = (instances == instance_id).astype(np.uint8)
-        slices = ndi.find_objects(mask)[0]
-        sub_mask = mask[slices]
-        patch = tomo[slices].copy()
-        patch[sub_mask != 1] = 0
-        patch_size = [64, 64, 64]
-        pad_size = tuple([(max(math.ceil((p - b) / 2), 0), max(math.floor((p - b) / 2), 0)) for p, b in
-                          zip(patch_size, patch.shape)])
-        patch = np.pad(patch, pad_size, 'constant')[:patch_size[0], :patch_size[1], :patch_size[2]]
-        selected_particle = patch
-        z, y, x = np.mgrid[:patch.shape[0], :patch.shape[1], :patch.shape[2]]
-        fig = go.Figure(data=go.Volume(
-            x=x.flatten(), y=y.flatten(), z=z.flatten(),
-            value=patch.flatten(),
-            isomin=0.01,
-            isomax=0.99,
-            opacity=0.3,
-            colorscale='gray'
-        ))
+    def generate_particle_plot(state, instance_id):
+        selected_file, render_mode = state['selected_file'], state['render_mode']
+        patch, sub_mask = particle_cache.get_or_compute(
+            ('patch', selected_file, instance_id),
+            lambda: extract_particle(*load_volumes(selected_file), instance_id))
+        fig = particle_cache.get_or_compute(('figure', selected_file, instance_id, render_mode),
+                                            lambda: figure_payload(particle_figure(np.where(sub_mask == 1, patch, 0),
+                                                                                   sub_mask, render_mode,
+                                                                                   opacity=0.3)))
         return fig
 
-    def parse_contents(contents, filename):
-        content_type, content_string = contents.split(',')
-
-        decoded = base64.b64decode(content_string)
-        try:
-            nonlocal config
-            nonlocal selected_file
-            nonlocal umap
-            config = yaml.safe_load(io.StringIO(decoded.decode('utf-8')))
-            umap = pd.read_csv(os.path.join(config['prediction_folder'], f'{clustering}_clusters_umap_data.csv'))
-            umap['class'] = umap['class'].apply(str)
-            files = list({'_'.join(x.split('_')[:-1]) for x in umap['labels'].values.tolist()})
-            selected_file = files[0]
-        except Exception as e:
-            print(e)
-            return html.Div(['There was an error processing this file.'])
-
-        return filename, files, selected_file
-
-    @callback([
-        Output('selected_file', 'children'),
-        Output('file-dropdown', 'options'),
-        Output('file-dropdown', 'value')
-    ],
-        Input('upload-data', 'contents'),
-        State('upload-data', 'filename'),
-        prevent_initial_call=True)
-    def update_upload_output(content, name):
-        if content is not None:
-            res = parse_contents(content, name)
-            return res
-
-    @callback(Output('umap-plot', 'figure', allow_duplicate=True),
-              Input('file-dropdown', 'value'),
-              prevent_initial_call=True)
-    def update_output(value):
-        nonlocal selected_file
-        selected_file = value
-        fig = generate_scatter_plot()
-        load_data_files()
+    def prefetch_neighbours(session_id, state, table, spatial_index, row):
+        instance_ids = table['instance_id'].to_numpy()[nearest_rows(spatial_index, row, neighbours_count)]
+        prefetcher.submit(session_id, [partial(generate_particle_plot, state, int(instance_id))
+                                       for instance_id in instance_ids])
+
+    @app.callback([Output('umap-plot', 'figure', allow_duplicate=True),
+                   Output('loading-interval', 'disabled'),
+                   Output('loading-status', 'children')],
+                  Input('file-dropdown', 'value'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_output(value, session_id):
+        state = sessions.update(session_id, selected_file=value, umap_window=[None, None])
+        if value:
+            loader.submit(('volumes', value), lambda report: open_volumes(value, report), retry=True)
+        fig = generate_scatter_plot(state)
+        prefetch(value)
+        disabled, status = loading_status(value)
+        return fig, disabled, status
+
+    @app.callback([Output('loading-interval', 'disabled', allow_duplicate=True),
+                   Output('loading-status', 'children', allow_duplicate=True)],
+                  Input('loading-interval', 'n_intervals'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_loading_status(n_intervals, session_id):
+        return loading_status(sessions.get(session_id)['selected_file'])
+
+    @app.callback(Output('atlas-index', 'data'),
+                  Input('file-dropdown', 'value'),
+                  prevent_initial_call=True)
+    def update_atlas_index(value):
+        if not value:
+            return None
+        return atlas_store_data(*volume_paths(value), app.get_relative_path(f'/atlas/{value}'), prefix=f'{value}_')
+
+    register_atlas_tooltip(app, 'umap-plot')
+    register_atlas_tooltip(app, 'subcluster-umap-plot')
+    add_atlas_route(server, lambda filename: atlas_paths(volume_paths(filename)[1])[0] if filename in files else None)
+
+    @app.callback(Output('umap-plot', 'figure', allow_duplicate=True),
+                  Input('umap-plot', 'relayoutData'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_umap_window(relayout_data, session_id):
+        state = sessions.get(session_id)
+        window = relayout_window(relayout_data)
+        selected_umap, _ = load_selected_umap(state['selected_file'])
+        if window is None or window == state['umap_window'] or len(selected_umap) <= max_points:
+            return no_update
+        state = sessions.update(session_id, umap_window=window)
+        fig = generate_scatter_plot(state)
         return fig
 
     @app.callback([Output('selected-structure', 'figure'),
@@ -206,35 +299,77 @@ def main(config, clustering):
                    Output('subcluster-umap-plot-info', 'children'),
                    Output('subcluster-selected-structure-info', 'children', allow_duplicate=True)],
                   Input('umap-plot', 'clickData'),
+                  State('session-id', 'data'),
                   prevent_initial_call=True)
-    def display_click_image(click_data):
-        nonlocal subcluster_umap
-        nonlocal umap
-        instance_id = int(click_data["points"][0]['customdata'][1].split('_')[-1])
-        cluster_id = int(click_data["points"][0]['customdata'][0])
-        subcluster_umap = umap[umap['current_class'] == str(cluster_id)]
-        fig = generate_subcluster_scatter_plot()
-        vol = generate_particle_plot(instance_id)
+    def display_click_image(click_data, session_id):
+        state = sessions.get(session_id)
+        selected_umap, selected_tree = load_selected_umap(state['selected_file'])
+        row = clicked_row(click_data, selected_tree)
+        instance_id = int(selected_umap['instance_id'].iat[row])
+        cluster_id = int(selected_umap['class'].iat[row])
+        state = sessions.update(session_id, selected_cluster=cluster_id, selected_instance=instance_id,
+                                subcluster_instance=instance_id)
+        fig = generate_subcluster_scatter_plot(state)
+        vol = generate_particle_plot(state, instance_id)
         message = f'Cluster: {cluster_id}'
         message2 = f'Instance: {instance_id}'
-        class_id = subcluster_umap.loc[subcluster_umap['labels'].str.endswith(f'_{instance_id}'), 'class'].values[0]
+        class_id = umap['class'].iat[umap_index['positions'][(state['selected_file'], instance_id)]]
         message3 = f'Class: {class_id}'
+        prefetch_neighbours(session_id, state, selected_umap, selected_tree, row)
         return vol, vol, fig, ', '.join([message, message2]), message, ', '.join([message3, message2])
 
     @app.callback([Output('subcluster-selected-structure', 'figure'),
                    Output('subcluster-selected-structure-info', 'children', allow_duplicate=True)],
                   Input('subcluster-umap-plot', 'clickData'),
+                  State('session-id', 'data'),
                   prevent_initial_call=True)
-    def display_click_image_second_plot(click_data):
-        instance_id = int(click_data["points"][0]['customdata'][1].split('_')[-1])
-        vol = generate_particle_plot(instance_id)
-        class_id = subcluster_umap.loc[subcluster_umap['labels'].str.endswith(f'_{instance_id}'), 'class'].values[0]
+    def display_click_image_second_plot(click_data, session_id):
+        state = sessions.get(session_id)
+        subcluster_umap, subcluster_tree = load_subcluster_umap(state['selected_file'], state['selected_cluster'])
+        row = clicked_row(click_data, subcluster_tree)
+        instance_id = int(subcluster_umap['instance_id'].iat[row])
+        state = sessions.update(session_id, subcluster_instance=instance_id)
+        vol = generate_particle_plot(state, instance_id)
+        class_id = umap['class'].iat[umap_index['positions'][(state['selected_file'], instance_id)]]
         message = f'Class: {class_id}, Instance: {instance_id}'
+        prefetch_neighbours(session_id, state, subcluster_umap, subcluster_tree, row)
         return vol, message
 
-    app.run_server(debug=False, dev_tools_props_check=False, port=8052)
+    @app.callback([Output('selected-structure', 'figure', allow_duplicate=True),
+                   Output('subcluster-selected-structure', 'figure', allow_duplicate=True)],
+                  Input('render-mode', 'value'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_render_mode(value, session_id):
+        state = sessions.update(session_id, render_mode=value)
+        if state['selected_instance'] is None:
+            return go.Figure(), go.Figure()
+        return generate_particle_plot(state, state['selected_instance']), \
+            generate_particle_plot(state, state['subcluster_instance'])
+
+    return app
+
+
+def create_server(config, clustering, session_folder=None):
+    """Create the WSGI server of the clusters app, for ex. for
+    gunicorn -w 4 --threads 4 "cryosiam_vis.visualize_clusters:create_server('config.yaml', 'kmeans')"
+    :param config: path to the config file
+    :type config: str
+    :param clustering: clustering type, one of ["kmeans", "spectral"]
+    :type clustering: str
+    :param session_folder: folder for sharing the session states between worker processes
+    :type session_folder: str
+    :return: the Flask server of the app
+    :rtype: flask.Flask
+    """
+    return create_app(config, clustering, session_folder or default_session_folder('clusters')).server
+
+
+def main(config, clustering, host='127.0.0.1', port=8052, workers=None, threads=None):
+    session_folder = default_session_folder('clusters') if workers is not None and workers > 1 else None
+    serve(lambda: create_app(config, clustering, session_folder), host, port, workers, threads)
 
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config, args.clustering)
+    main(args.config, args.clustering, args.host, args.port, args.workers, args.threads)
@@ -1,10 +1,11 @@
 import os
 import yaml
 import napari
-import mrcfile
 import argparse
-import starfile
-import numpy as np
+
+from cryosiam_vis.io_utils import load_tomogram
+from cryosiam_vis.pyramid import load_multiscale, multiscale_layer_args
+from cryosiam_vis.star_index import load_coordinates
 
 
 def parser_helper(description=None):
@@ -17,26 +18,29 @@ def parser_helper(description=None):
                         help='Tomogram filename (including the file extension')
     parser.add_argument('--point_size', type=str, required=False, default=15,
                         help='Size of the points to be plotted in napari')
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='Read the volumes chunk by chunk while browsing instead of loading them into memory '
+                             '(requires dask)')
     return parser
 
 
-def main(config, filename, point_size):
+def main(config, filename, point_size, out_of_core=False):
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    tomo = mrcfile.open(os.path.join(config['data_folder'], filename)).data
+    out_of_core = out_of_core or bool(config.get('out_of_core', False))
+    tomo_file = os.path.join(config['data_folder'], filename)
+    tomo = load_multiscale(tomo_file, load_tomogram(tomo_file))
     labels_files = [x for x in os.listdir(config['prediction_folder']) if x.endswith('_particles.star')]
 
     v = napari.Viewer()
-    v.add_image(tomo * -1, name='tomo')
+    v.add_image(**multiscale_layer_args(tomo, out_of_core), name='tomo', colormap='gray_r')
 
-    for label_file in labels_files:
-        points = starfile.read(os.path.join(config['prediction_folder'], label_file))
-        if type(points) is dict:
-            points = points['particles']
-        if points.shape[0] == 0:
+    coordinates = load_coordinates([os.path.join(config['prediction_folder'], x) for x in labels_files],
+                                   filename.split('.')[0])
+    for label_file, points in zip(labels_files, coordinates):
+        if points is None:
             continue
-        points = points[points['rlnMicrographName'] == filename.split('.')[0]]
-        v.add_points(points[['rlnCoordinateZ', 'rlnCoordinateY', 'rlnCoordinateX']],
+        v.add_points(points,
                      name=label_file.split('.star')[0],
                      n_dimensional=True, size=point_size)
     napari.run()
@@ -45,4 +49,4 @@ def main(config, filename, point_size):
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config_file, args.filename, args.point_size)
+    main(args.config_file, args.filename, args.point_size, args.out_of_core)
@@ -1,9 +1,11 @@
 import os
 import yaml
 import napari
-import mrcfile
 import argparse
 
+from cryosiam_vis.io_utils import load_tomogram
+from cryosiam_vis.pyramid import load_multiscale, multiscale_layer_args
+
 
 def parser_helper(description=None):
     description = "Show semantic segmentation with napari" if description is None else description
@@ -13,22 +15,28 @@ def parser_helper(description=None):
                         help='path to the config file used for running CryoSiam denoising')
     parser.add_argument('--filename', type=str, required=True,
                         help='Tomogram filename (including the file extension')
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='Read the volumes chunk by chunk while browsing instead of loading them into memory '
+                             '(requires dask)')
     return parser
 
 
-def main(config, filename):
+def main(config, filename, out_of_core=False):
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    tomo = mrcfile.open(os.path.join(config['data_folder'], filename)).data
-    denoised_tomo = mrcfile.open(os.path.join(config['prediction_folder'], filename)).data
+    out_of_core = out_of_core or bool(config.get('out_of_core', False))
+    tomo_file = os.path.join(config['data_folder'], filename)
+    denoised_file = os.path.join(config['prediction_folder'], filename)
+    tomo = load_multiscale(tomo_file, load_tomogram(tomo_file))
+    denoised_tomo = load_multiscale(denoised_file, load_tomogram(denoised_file))
 
     v = napari.Viewer()
-    v.add_image(tomo * -1, name='tomo')
-    v.add_image(denoised_tomo * -1, name='denoised_tomo')
+    v.add_image(**multiscale_layer_args(tomo, out_of_core), name='tomo', colormap='gray_r')
+    v.add_image(**multiscale_layer_args(denoised_tomo, out_of_core), name='denoised_tomo', colormap='gray_r')
     napari.run()
 
 
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config, args.filename)
+    main(args.config, args.filename, args.out_of_core)
@@ -1,18 +1,43 @@
-import io
 import os
-import math
 import yaml
-import h5py
-import base64
-import mrcfile
 import argparse
+from functools import partial
 import numpy as np
 import pandas as pd
-import plotly.express as px
-from scipy import ndimage as ndi
 import plotly.graph_objects as go
 import dash_bootstrap_components as dbc
-from dash import Dash, dcc, html, Input, Output, State, callback, clientside_callback
+from dash import Dash, dcc, html, Input, Output, State, no_update
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_memmap, advise_willneed
+from cryosiam_vis.app_state import (SessionStore, HandlePool, BackgroundLoader, SessionTaskQueue, session_id_store,
+                                    default_session_folder, next_files)
+from cryosiam_vis.cache import cache_from_config
+from cryosiam_vis.instrumentation import metrics_from_config, staged
+from cryosiam_vis.instance_index import load_instance_index, extract_particle
+from cryosiam_vis.particle_rendering import RENDER_MODES, SLICE_AXES, particle_figure, slice_figure, gallery_figure, \
+    figure_payload
+from cryosiam_vis.serving import serve
+from cryosiam_vis.scatter import (DEFAULT_MAX_POINTS, scatter_figure, build_spatial_index, clicked_row,
+                                  nearest_rows, relayout_window)
+from cryosiam_vis.thumbnail_atlas import (atlas_paths, atlas_store_data, add_atlas_route, with_atlas_tooltip,
+                                          register_atlas_tooltip)
+from cryosiam_vis.umap_data import load_embeddings_umap
+
+DATASET_OPTION = '__dataset__'
+DATASET_COLUMNS = ['x', 'y', 'label', 'semantic_class', 'log_area']
+DEFAULT_HANDLE_POOL_MB = 8192
+
+SESSION_DEFAULTS = {
+    'selected_file': '',
+    'selected_tomogram': '',
+    'umap_window': [None, None],
+    'sliding_axis': 'z',
+    'view_type': 'image',
+    'slice_index': 32,
+    'render_mode': RENDER_MODES[0],
+    'selected_instance': 0,
+    'neighbours': []
+}
 
 
 def parser_helper(description=None):
@@ -21,190 +46,344 @@ def parser_helper(description=None):
                                      formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument('--config', type=str, required=True,
                         help='path to the config file used for running SimSiam')
+    parser.add_argument('--host', type=str, required=False, default='127.0.0.1',
+                        help='host the app listens on')
+    parser.add_argument('--port', type=int, required=False, default=8050,
+                        help='port the app listens on')
+    parser.add_argument('--workers', type=int, required=False, default=None,
+                        help='number of worker processes, serves the app with gunicorn instead of the '
+                             'development server')
+    parser.add_argument('--threads', type=int, required=False, default=None,
+                        help='number of threads per worker process, serves the app with gunicorn instead of the '
+                             'development server')
     return parser
 
 
-def main(config):
+def create_app(config, session_folder=None):
+    """Create the embeddings Dash app. The state of every browser session (selected file, instance, axis,
+    ...) is kept in a SessionStore, and the tomograms, instance volumes and UMAP tables are opened once per
+    process and shared read-only by all sessions.
+    :param config: path to the config file
+    :type config: str
+    :param session_folder: folder for sharing the session states between worker processes, the states
+                           are kept in memory if None
+    :type session_folder: str
+    :return: the app
+    :rtype: Dash
+    """
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
+    metrics = metrics_from_config(config, 'embeddings')
     files = [x.split('_embeds_umap_data.csv')[0] + config['file_extension'] for x in
              os.listdir(config['visualization']['prediction_folder']) if x.endswith('_embeds_umap_data.csv')]
-    selected_file = ''
-    umap = pd.DataFrame(columns=['class', 'x', 'y', 'label'])
-    tomo = None
-    instances = None
-    position = 0
-    mask = None
-    current_subtomo = None
-    current_submask = None
-    sliding_axis = 'z'
-    view_type = 'image'
+    max_points = int(config.get('scatter_max_points', DEFAULT_MAX_POINTS))
+    sessions = SessionStore(SESSION_DEFAULTS, session_folder)
+    handles = HandlePool(int(config.get('handle_pool_memory_mb', DEFAULT_HANDLE_POOL_MB) * 1024 ** 2))
+    loader = BackgroundLoader(handles, int(config.get('loader_workers', 2)))
+    prefetcher = SessionTaskQueue()
+    neighbours_count = int(config.get('nearest_neighbours', 8))
+    prefetch_count = int(config.get('prefetch_files', 0))
+    prefetch_budget = int(config.get('prefetch_memory_mb', 2048) * 1024 ** 2)
+    particle_cache = cache_from_config(config)
     app = Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.FONT_AWESOME])
     server = app.server
+    if metrics is not None:
+        metrics.instrument(app)
 
-    app.layout = dbc.Container(
-        [
-            html.Div(["SimSiam embeddings visualization"], className="bg-primary text-white h3 p-2"),
-            html.Hr(),
-            dbc.Row(dbc.Col(dbc.Card(dbc.CardBody([
-                html.Div([
-                    html.H6('Select a file for visualization:'),
-                    dcc.Loading(dcc.Dropdown(files, '', id='file-dropdown'), type="circle")])
-            ])), width=6)),
-            html.Hr(),
-            dbc.Row(
-                [
-                    dbc.Col(dbc.Card(
-                        [
-                            dbc.CardHeader("Embeddings UMAP"),
-                            dbc.CardBody(
-                                [
-                                    html.Div(dcc.Input(id="selected-instance-id", type="number", debounce=True,
-                                                       placeholder="Select a specific instance"), id='umap-plot-info'),
-                                    dbc.Col(dcc.Loading(dcc.Graph(id='umap-plot'),
-                                                        type="circle"),
-                                            width='auto')
+    def layout():
+        return dbc.Container(
+            [
+                session_id_store(),
+                dcc.Store(id='atlas-index'),
+                html.Div(["SimSiam embeddings visualization"], className="bg-primary text-white h3 p-2"),
+                html.Hr(),
+                dbc.Row(dbc.Col(dbc.Card(dbc.CardBody([
+                    html.Div([
+                        html.H6('Select a file for visualization:'),
+                        dcc.Loading(dcc.Dropdown([{'label': 'All files', 'value': DATASET_OPTION}] + files, '',
+                                                 id='file-dropdown'), type="circle"),
+                        html.Div(id='loading-status'),
+                        dcc.Interval(id='loading-interval', interval=500, disabled=True)])
+                ])), width=6)),
+                html.Hr(),
+                dbc.Row(
+                    [
+                        dbc.Col(dbc.Card(
+                            [
+                                dbc.CardHeader("Embeddings UMAP"),
+                                dbc.CardBody(
+                                    [
+                                        html.Div(dcc.Input(id="selected-instance-id", type="number", debounce=True,
+                                                           placeholder="Select a specific instance"), id='umap-plot-info'),
+                                        dbc.Col(with_atlas_tooltip(
+                                            dcc.Loading(dcc.Graph(id='umap-plot', clear_on_unhover=True),
+                                                        type="circle"), 'umap-plot'),
+                                                width='auto')
+                                    ])
+                            ]), width=6),
+                        dbc.Col(dbc.Card(
+                            [
+                                dbc.CardHeader("Selected particle"),
+                                dbc.CardBody([
+                                    html.Div(["Select a point the the UMAP plot"], id='selected-structure-info'),
+                                    html.Div(["Render mode:"]),
+                                    dcc.Dropdown(RENDER_MODES, SESSION_DEFAULTS['render_mode'], id='render-mode'),
+                                    dbc.Col(
+                                        dcc.Loading(dcc.Graph(id='selected-structure'), type="circle"),
+                                        width='auto')
                                 ])
+                            ]), width=6)
+                    ]),
+                html.Hr(),
+                dbc.Row(
+                    [
+                        dbc.Col(dbc.Card([
+                            dbc.CardHeader("Selected instance embedding UMAP"),
+                            dbc.CardBody([
+                                html.Div(["Select a point the the UMAP plot"], id='selected-umap-plot-info'),
+                                dbc.Col(with_atlas_tooltip(
+                                    dcc.Loading(dcc.Graph(id='selected-umap-plot', clear_on_unhover=True),
+                                                type="circle"), 'selected-umap-plot'),
+                                        width='auto')
+                            ])
                         ]), width=6),
-                    dbc.Col(dbc.Card(
-                        [
-                            dbc.CardHeader("Selected particle"),
+                        dbc.Col(dbc.Card([
+                            dbc.CardHeader("Selected particle view"),
                             dbc.CardBody([
-                                html.Div(["Select a point the the UMAP plot"], id='selected-structure-info'),
-                                dbc.Col(
-                                    dcc.Loading(dcc.Graph(id='selected-structure'), type="circle"),
-                                    width='auto')
+                                html.Div(["Axis:"]),
+                                dcc.Dropdown(SLICE_AXES, SESSION_DEFAULTS['sliding_axis'], id='sliding-axis'),
+                                html.Div(["View type:"]),
+                                dcc.Dropdown(['image', 'mask'], SESSION_DEFAULTS['view_type'], id='view-type'),
+                                html.Div(["Slice:"]),
+                                dcc.Slider(0, 63, 1, value=SESSION_DEFAULTS['slice_index'], id='slice-index', marks=None,
+                                           updatemode='drag', tooltip={'placement': 'bottom'}),
+                                dbc.Col([dcc.Loading(dcc.Graph(id='tomo-slice', style={'width': '500', 'height': '500'}),
+                                                     type="circle")], width='auto')
                             ])
                         ]), width=6)
-                ]),
-            html.Hr(),
-            dbc.Row(
-                [
-                    dbc.Col(dbc.Card([
-                        dbc.CardHeader("Selected instance embedding UMAP"),
-                        dbc.CardBody([
-                            html.Div(["Select a point the the UMAP plot"], id='selected-umap-plot-info'),
-                            dbc.Col(dcc.Loading(dcc.Graph(id='selected-umap-plot'), type="circle"),
-                                    width='auto')
-                        ])
-                    ]), width=6),
-                    dbc.Col(dbc.Card([
-                        dbc.CardHeader("Selected particle view"),
-                        dbc.CardBody([
-                            html.Div(["Axis:"]),
-                            dcc.Dropdown(['z', 'y', 'x'], sliding_axis, id='sliding-axis'),
-                            html.Div(["View type:"]),
-                            dcc.Dropdown(['image', 'mask'], view_type, id='view-type'),
-                            dbc.Col([dcc.Loading(dcc.Graph(id='tomo-slice', style={'width': '500', 'height': '500'}),
-                                                 type="circle")], width='auto')
-                        ])
-                    ]), width=6)
-
-                ])
-        ],
-        fluid=True,
-    )
 
-    def generate_scatter_plot():
-        nonlocal config
-        nonlocal umap
-        nonlocal selected_file
-        fig = px.scatter(umap, x='x', y='y',
-                         color='semantic_class2' if 'semantic_class2' in umap.columns else 'semantic_class' if 'semantic_class' in umap.columns else 'log_area',
-                         hover_data=umap.columns,
-                         opacity=0.5,
-                         color_discrete_sequence=px.colors.qualitative.Light24, width=600, height=600)
+                    ]),
+                html.Hr(),
+                dbc.Row(
+                    [
+                        dbc.Col(dbc.Card([
+                            dbc.CardHeader("Nearest particles in the UMAP"),
+                            dbc.CardBody([
+                                html.Div(["Select a point the the UMAP plot"], id='neighbours-gallery-info'),
+                                dbc.Col(dcc.Loading(dcc.Graph(id='neighbours-gallery'), type="circle"),
+                                        width='auto')
+                            ])
+                        ]), width=12)
+                    ])
+            ],
+            fluid=True,
+        )
+
+    app.layout = layout
+
+    def volume_paths(selected_file):
+        return (os.path.join(config['data_folder'], selected_file),
+                os.path.join(config['instances_mask_folder'],
+                             selected_file.split(config['file_extension'])[0] + '_instance_preds.h5'))
+
+    def umap_path(selected_file):
+        return os.path.join(config['visualization']['prediction_folder'],
+                            f'{selected_file.split(config["file_extension"])[0]}_embeds_umap_data.csv')
+
+    def open_umap(selected_file):
+        if selected_file == DATASET_OPTION:
+            return open_dataset_umap()
+        umap = load_embeddings_umap(umap_path(selected_file))
+        return umap, build_spatial_index(umap)
+
+    def open_dataset_umap():
+        tables = [load_embeddings_umap(umap_path(file), DATASET_COLUMNS) for file in files]
+        umap = pd.concat(tables, ignore_index=True)
+        umap['tomogram'] = pd.Categorical.from_codes(np.repeat(np.arange(len(files)), [len(t) for t in tables]),
+                                                     categories=files)
+        if 'semantic_class' in umap.columns:
+            umap['semantic_class'] = umap['semantic_class'].astype(str).astype('category')
+        return umap, build_spatial_index(umap)
+
+    def umap_rows(state, umap):
+        rows = umap['label'].to_numpy() == state['selected_instance']
+        if state['selected_file'] == DATASET_OPTION:
+            rows &= umap['tomogram'].to_numpy() == state['selected_tomogram']
+        return np.flatnonzero(rows)
+
+    @staged('stage/open_volumes')
+    def open_volumes(selected_file, report=lambda fraction, message: None):
+        tomo_file, instances_file = volume_paths(selected_file)
+        report(0., 'Opening the tomogram')
+        tomo = load_tomogram(tomo_file)
+        report(1 / 3, 'Opening the instance segmentation')
+        instances = open_h5_memmap(instances_file, 'instances')
+        report(2 / 3, 'Indexing the instances')
+        return tomo, instances, load_instance_index(instances_file, instances)
+
+    def load_umap(selected_file):
+        if not selected_file:
+            return pd.DataFrame(columns=['class', 'x', 'y', 'label']), None
+        return handles.get(('umap', selected_file), lambda: open_umap(selected_file))
+
+    def load_volumes(selected_file):
+        return handles.get(('volumes', selected_file), lambda: open_volumes(selected_file))
+
+    def prefetch(selected_file):
+        if selected_file not in files:
+            return
+        budget = prefetch_budget
+        for file in next_files(files, selected_file, prefetch_count):
+            paths = [p for p in volume_paths(file) if os.path.exists(p)]
+            size = sum(os.path.getsize(p) for p in paths)
+            if size > budget:
+                break
+            budget -= size
+            for path in paths:
+                advise_willneed(path)
+            loader.submit(('umap', file), lambda report, file=file: open_umap(file))
+            loader.submit(('volumes', file), lambda report, file=file: open_volumes(file, report))
+
+    def loading_status(selected_file):
+        if not selected_file:
+            return True, None
+        if selected_file == DATASET_OPTION:
+            return True, html.Div([f"{len(files)} files, the tomogram of a clicked point is opened on demand"])
+        status = loader.status(('volumes', selected_file))
+        if status['error'] is not None:
+            return True, html.Div([f"Loading {selected_file} failed: {status['error']}"], className='text-danger')
+        if not status['started']:
+            # the loading was started by another worker process, this one opens the files on first use
+            return True, html.Div([f"{selected_file} is opened on first use"])
+        if status['done']:
+            return True, html.Div([f"{selected_file} loaded"])
+        return False, html.Div([html.Div([status['message']]),
+                                dbc.Progress(value=int(100 * status['fraction']), striped=True, animated=True)])
+
+    def generate_scatter_plot(state):
+        umap, _ = load_umap(state['selected_file'])
+        color = 'semantic_class2' if 'semantic_class2' in umap.columns else 'semantic_class' if 'semantic_class' in umap.columns else 'log_area'
+        hover = ['label', 'tomogram', color] if state['selected_file'] == DATASET_OPTION else ['label', color]
+        fig = scatter_figure(umap, color=color, hover=hover, max_points=max_points,
+                             x_range=state['umap_window'][0], y_range=state['umap_window'][1])
         return fig
 
-    def generate_selected_scatter_plot(selected_instance_id):
-        nonlocal config
-        nonlocal umap
-        nonlocal selected_file
-        fig = px.scatter(umap, x='x', y='y',
-                         hover_data=umap.columns, opacity=0.5, width=600, height=600)
-        selected_point = umap.loc[umap['label'] == selected_instance_id]
+    def generate_selected_scatter_plot(state, selected_instance_id):
+        umap, _ = load_umap(state['selected_file'])
+        hover = ['label', 'tomogram'] if state['selected_file'] == DATASET_OPTION else ['label']
+        fig = scatter_figure(umap, hover=hover, max_points=max_points)
+        selected_point = umap.iloc[umap_rows(dict(state, selected_instance=selected_instance_id), umap)]
         fig.add_trace(go.Scatter(x=selected_point['x'], y=selected_point['y'],
                                  mode='markers', marker_line_width=2, marker_size=20,
                                  marker_symbol='circle-open-dot'))
         return fig
 
-    def load_data_files():
-        nonlocal tomo
-        nonlocal instances
-        nonlocal selected_file
-        nonlocal config
-        nonlocal umap
-        file_path = os.path.join(config['visualization']['prediction_folder'],
-                                 f'{selected_file.split(config["file_extension"])[0]}_embeds_umap_data.csv')
-        umap = pd.read_csv(file_path)
-        if 'semantic_class' in umap.columns:
-            umap['semantic_class'] = umap['semantic_class'].apply(str)
-        if 'semantic_class2' in umap.columns:
-            umap['semantic_class2'] = umap['semantic_class'].apply(str)
-        tomo = mrcfile.open(os.path.join(config['data_folder'], selected_file)).data
-        instances_file = os.path.join(config['instances_mask_folder'],
-                                      selected_file.split(config['file_extension'])[0] + '_instance_preds.h5')
-        with h5py.File(instances_file, 'r') as f:
-            instances = f['instances'][()]
-
-    def generate_particle_plot(instance_id):
-        nonlocal tomo
-        nonlocal current_subtomo
-        nonlocal current_submask
-        nonlocal instances
-        if instance_id != 0:
-            mask = (instances == instance_id).astype(np.uint8)
-            slices = ndi.find_objects(mask)[0]
-            sub_mask = mask[slices]
-            patch = tomo[slices].copy()
-            current_subtomo = tomo[slices].copy()
-            patch[sub_mask != 1] = 0
-            patch_size = [64, 64, 64]
-            pad_size = tuple([(max(math.ceil((p - b) / 2), 0), max(math.floor((p - b) / 2), 0)) for p, b in
-                              zip(patch_size, patch.shape)])
-            patch = np.pad(patch, pad_size, 'constant')[:patch_size[0], :patch_size[1], :patch_size[2]]
-            current_subtomo = np.pad(current_subtomo, pad_size, 'constant')[:patch_size[0], :patch_size[1],
-                              :patch_size[2]]
-            current_submask = np.pad(sub_mask, pad_size, 'constant')[:patch_size[0], :patch_size[1], :patch_size[2]]
-        else:
-            patch = np.zeros((64, 64, 64))
-            current_subtomo = np.zeros((64, 64, 64))
-            current_submask = np.zeros((64, 64, 64))
-        z, y, x = np.mgrid[:patch.shape[0], :patch.shape[1], :patch.shape[2]]
-        fig = go.Figure(data=go.Volume(
-            x=x.flatten(), y=y.flatten(), z=z.flatten(),
-            value=patch.flatten(),
-            isomin=0.01,
-            isomax=0.99,
-            opacity=0.1,
-            colorscale='gray'
-        ))
+    def get_particle(selected_file, instance_id):
+        return particle_cache.get_or_compute(
+            ('patch', selected_file, instance_id),
+            lambda: extract_particle(*load_volumes(selected_file), instance_id))
+
+    def render_particle(subtomo, submask, render_mode):
+        patch = subtomo.copy()
+        patch[submask != 1] = 0
+        return figure_payload(particle_figure(patch, submask, render_mode, opacity=0.1))
+
+    def generate_particle_plot(state):
+        selected_file, instance_id, render_mode = state['selected_tomogram'], state['selected_instance'], \
+            state['render_mode']
+        fig = particle_cache.get_or_compute(('figure', selected_file, instance_id, render_mode),
+                                            lambda: render_particle(*get_particle(selected_file, instance_id),
+                                                                    render_mode))
         return fig
 
-    def plot_image():
-        nonlocal current_subtomo
-        nonlocal current_submask
-        nonlocal sliding_axis
-        nonlocal view_type
-
-        if view_type == 'image':
-            fig = px.imshow(current_subtomo,
-                            animation_frame=0 if sliding_axis == 'z' else 1 if sliding_axis == 'y' else 2,
-                            color_continuous_scale='gray')
-        else:
-            fig = px.imshow(current_submask,
-                            animation_frame=0 if sliding_axis == 'z' else 1 if sliding_axis == 'y' else 2,
-                            color_continuous_scale='gray')
+    def plot_image(state):
+        selected_file, selected_instance, view_type = state['selected_tomogram'], state['selected_instance'], \
+            state['view_type']
+        volume_index = 0 if view_type == 'image' else 1
+        fig = particle_cache.get_or_compute(
+            ('slice', selected_file, selected_instance, view_type, state['sliding_axis'], state['slice_index']),
+            lambda: figure_payload(slice_figure(get_particle(selected_file, selected_instance)[volume_index],
+                                                state['sliding_axis'], state['slice_index'])))
         return fig
 
-    @callback(Output('umap-plot', 'figure', allow_duplicate=True),
-              Input('file-dropdown', 'value'),
-              prevent_initial_call=True)
-    def update_output(value):
-        nonlocal selected_file
-        selected_file = value
-        load_data_files()
-        fig = generate_scatter_plot()
+    def row_instance(state, umap, row):
+        tomogram = str(umap['tomogram'].iat[row]) if state['selected_file'] == DATASET_OPTION \
+            else state['selected_file']
+        return tomogram, int(umap['label'].iat[row])
+
+    def clicked_instance(state, click_data):
+        umap, umap_tree = load_umap(state['selected_file'])
+        return row_instance(state, umap, clicked_row(click_data, umap_tree))
+
+    def neighbour_instances(state):
+        umap, umap_tree = load_umap(state['selected_file'])
+        rows = umap_rows(state, umap)
+        if len(rows) == 0:
+            return []
+        return [list(row_instance(state, umap, row)) for row in nearest_rows(umap_tree, rows[0], neighbours_count)]
+
+    def prefetch_particle(state, tomogram, instance_id):
+        state = dict(state, selected_tomogram=tomogram, selected_instance=instance_id)
+        generate_particle_plot(state)
+        plot_image(state)
+
+    def prefetch_neighbours(session_id, state):
+        prefetcher.submit(session_id, [partial(prefetch_particle, state, tomogram, instance_id)
+                                       for tomogram, instance_id in neighbour_instances(state)])
+
+    def instance_message(state):
+        if state['selected_file'] == DATASET_OPTION:
+            return f"Instance id: {state['selected_instance']} ({state['selected_tomogram']})"
+        return f"Instance id: {state['selected_instance']}"
+
+    @app.callback([Output('umap-plot', 'figure', allow_duplicate=True),
+                   Output('loading-interval', 'disabled'),
+                   Output('loading-status', 'children')],
+                  Input('file-dropdown', 'value'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_output(value, session_id):
+        state = sessions.update(session_id, selected_file=value, umap_window=[None, None],
+                                selected_tomogram=value if value != DATASET_OPTION else '')
+        if value and value != DATASET_OPTION:
+            loader.submit(('volumes', value), lambda report: open_volumes(value, report), retry=True)
+        fig = generate_scatter_plot(state)
+        prefetch(value)
+        disabled, status = loading_status(value)
+        return fig, disabled, status
+
+    @app.callback([Output('loading-interval', 'disabled', allow_duplicate=True),
+                   Output('loading-status', 'children', allow_duplicate=True)],
+                  Input('loading-interval', 'n_intervals'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_loading_status(n_intervals, session_id):
+        return loading_status(sessions.get(session_id)['selected_file'])
+
+    @app.callback(Output('atlas-index', 'data'),
+                  Input('file-dropdown', 'value'),
+                  prevent_initial_call=True)
+    def update_atlas_index(value):
+        if not value or value == DATASET_OPTION:
+            return None
+        return atlas_store_data(*volume_paths(value), app.get_relative_path(f'/atlas/{value}'))
+
+    register_atlas_tooltip(app, 'umap-plot')
+    register_atlas_tooltip(app, 'selected-umap-plot')
+    add_atlas_route(server, lambda filename: atlas_paths(volume_paths(filename)[1])[0] if filename in files else None)
+
+    @app.callback(Output('umap-plot', 'figure', allow_duplicate=True),
+                  Input('umap-plot', 'relayoutData'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_umap_window(relayout_data, session_id):
+        state = sessions.get(session_id)
+        window = relayout_window(relayout_data)
+        umap, _ = load_umap(state['selected_file'])
+        if window is None or window == state['umap_window'] or len(umap) <= max_points:
+            return no_update
+        state = sessions.update(session_id, umap_window=window)
+        fig = generate_scatter_plot(state)
         return fig
 
     @app.callback([Output('selected-structure', 'figure'),
@@ -213,70 +392,158 @@ def main(config):
                    Output('selected-umap-plot', 'figure'),
                    Output('selected-umap-plot-info', 'children')],
                   Input('umap-plot', 'clickData'),
+                  State('session-id', 'data'),
                   prevent_initial_call=True)
-    def display_click_image(click_data):
-        instance_id = int(click_data["points"][0]['customdata'][1])
-        vol = generate_particle_plot(instance_id)
-        message = f"Instance id: {instance_id}"
-        fig = plot_image()
-        selected_fig = generate_selected_scatter_plot(instance_id)
+    def display_click_image(click_data, session_id):
+        tomogram, instance_id = clicked_instance(sessions.get(session_id), click_data)
+        state = sessions.update(session_id, selected_tomogram=tomogram, selected_instance=instance_id)
+        vol = generate_particle_plot(state)
+        message = instance_message(state)
+        fig = plot_image(state)
+        selected_fig = generate_selected_scatter_plot(state, instance_id)
+        prefetch_neighbours(session_id, state)
         return vol, message, fig, selected_fig, message
 
     @app.callback([Output('selected-structure', 'figure', allow_duplicate=True),
                    Output('selected-structure-info', 'children', allow_duplicate=True),
                    Output('tomo-slice', 'figure', allow_duplicate=True)],
                   Input('selected-umap-plot', 'clickData'),
+                  State('session-id', 'data'),
                   prevent_initial_call=True)
-    def display_click_second_image(click_data):
-        instance_id = int(click_data["points"][0]['customdata'][1])
-        vol = generate_particle_plot(instance_id)
-        message = f"Instance id: {instance_id}"
-        fig = plot_image()
+    def display_click_second_image(click_data, session_id):
+        tomogram, instance_id = clicked_instance(sessions.get(session_id), click_data)
+        state = sessions.update(session_id, selected_tomogram=tomogram, selected_instance=instance_id)
+        vol = generate_particle_plot(state)
+        message = instance_message(state)
+        fig = plot_image(state)
+        prefetch_neighbours(session_id, state)
         return vol, message, fig
 
-    @callback(
+    @app.callback(
         [Output('selected-structure', 'figure', allow_duplicate=True),
          Output('selected-structure-info', 'children', allow_duplicate=True),
          Output('tomo-slice', 'figure', allow_duplicate=True),
          Output('selected-umap-plot', 'figure', allow_duplicate=True),
          Output('selected-umap-plot-info', 'children', allow_duplicate=True)],
         Input("selected-instance-id", "value"),
+        State('session-id', 'data'),
         prevent_initial_call=True
     )
-    def number_render(val):
-        nonlocal umap
-        vol = generate_particle_plot(val)
-        message = f"Instance id: {val}"
-        fig = plot_image()
-        selected_fig = generate_selected_scatter_plot(val)
+    def number_render(val, session_id):
+        state = sessions.update(session_id, selected_instance=val)
+        if not state['selected_tomogram']:
+            # in the dataset view the tomogram is only known once a point has been clicked
+            return no_update, no_update, no_update, no_update, no_update
+        vol = generate_particle_plot(state)
+        message = instance_message(state)
+        fig = plot_image(state)
+        selected_fig = generate_selected_scatter_plot(state, val)
+        prefetch_neighbours(session_id, state)
         return vol, message, fig, selected_fig, message
 
-    @callback(
+    @app.callback([Output('neighbours-gallery', 'figure'),
+                   Output('neighbours-gallery-info', 'children')],
+                  Input('selected-structure-info', 'children'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def update_neighbours_gallery(info, session_id):
+        state = sessions.get(session_id)
+        neighbours = neighbour_instances(state)
+        sessions.update(session_id, neighbours=neighbours)
+        titles = [f'Instance {i} ({t})' if state['selected_file'] == DATASET_OPTION else f'Instance {i}'
+                  for t, i in neighbours]
+        fig = gallery_figure([get_particle(t, i)[0] for t, i in neighbours], titles)
+        return fig, f"Nearest particles to instance {state['selected_instance']}"
+
+    @app.callback([Output('selected-structure', 'figure', allow_duplicate=True),
+                   Output('selected-structure-info', 'children', allow_duplicate=True),
+                   Output('tomo-slice', 'figure', allow_duplicate=True)],
+                  Input('neighbours-gallery', 'clickData'),
+                  State('session-id', 'data'),
+                  prevent_initial_call=True)
+    def display_click_gallery(click_data, session_id):
+        tomogram, instance_id = sessions.get(session_id)['neighbours'][click_data['points'][0]['curveNumber']]
+        state = sessions.update(session_id, selected_tomogram=tomogram, selected_instance=instance_id)
+        vol = generate_particle_plot(state)
+        message = instance_message(state)
+        fig = plot_image(state)
+        prefetch_neighbours(session_id, state)
+        return vol, message, fig
+
+    @app.callback(
         Output('tomo-slice', 'figure', allow_duplicate=True),
         Input('sliding-axis', 'value'),
+        State('session-id', 'data'),
         prevent_initial_call=True
     )
-    def update_axis(value):
-        nonlocal sliding_axis
-        sliding_axis = value
-        fig = plot_image()
+    def update_axis(value, session_id):
+        state = sessions.update(session_id, sliding_axis=value)
+        if not state['selected_tomogram']:
+            return no_update
+        fig = plot_image(state)
         return fig
 
-    @callback(
+    @app.callback(
         Output('tomo-slice', 'figure', allow_duplicate=True),
         Input('view-type', 'value'),
+        State('session-id', 'data'),
+        prevent_initial_call=True
+    )
+    def update_view_type(value, session_id):
+        state = sessions.update(session_id, view_type=value)
+        if not state['selected_tomogram']:
+            return no_update
+        fig = plot_image(state)
+        return fig
+
+    @app.callback(
+        Output('tomo-slice', 'figure', allow_duplicate=True),
+        Input('slice-index', 'value'),
+        State('session-id', 'data'),
+        prevent_initial_call=True
+    )
+    def update_slice(value, session_id):
+        state = sessions.update(session_id, slice_index=value)
+        if not state['selected_tomogram']:
+            return no_update
+        fig = plot_image(state)
+        return fig
+
+    @app.callback(
+        Output('selected-structure', 'figure', allow_duplicate=True),
+        Input('render-mode', 'value'),
+        State('session-id', 'data'),
         prevent_initial_call=True
     )
-    def update_axis(value):
-        nonlocal view_type
-        view_type = value
-        fig = plot_image()
+    def update_render_mode(value, session_id):
+        state = sessions.update(session_id, render_mode=value)
+        if not state['selected_tomogram']:
+            return no_update
+        fig = generate_particle_plot(state)
         return fig
 
-    app.run(debug=False, dev_tools_props_check=False)
+    return app
+
+
+def create_server(config, session_folder=None):
+    """Create the WSGI server of the embeddings app, for ex. for
+    gunicorn -w 4 --threads 4 "cryosiam_vis.visualize_embeddings:create_server('config.yaml')"
+    :param config: path to the config file
+    :type config: str
+    :param session_folder: folder for sharing the session states between worker processes
+    :type session_folder: str
+    :return: the Flask server of the app
+    :rtype: flask.Flask
+    """
+    return create_app(config, session_folder or default_session_folder('embeddings')).server
+
+
+def main(config, host='127.0.0.1', port=8050, workers=None, threads=None):
+    session_folder = default_session_folder('embeddings') if workers is not None and workers > 1 else None
+    serve(lambda: create_app(config, session_folder), host, port, workers, threads)
 
 
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config)
+    main(args.config, args.host, args.port, args.workers, args.threads)
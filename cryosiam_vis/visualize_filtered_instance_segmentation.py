@@ -1,10 +1,12 @@
 import os
-import h5py
 import yaml
 import napari
-import mrcfile
 import argparse
-import numpy as np
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset
+from cryosiam_vis.label_utils import load_labels, label_range, label_lookup_table, apply_lookup_table
+from cryosiam_vis.lazy_volumes import lazy_lookup_table
+from cryosiam_vis.pyramid import load_multiscale, multiscale_layer_args
 
 
 def parser_helper(description=None):
@@ -15,32 +17,50 @@ def parser_helper(description=None):
                         help='path to the config file used for running CryoSiam')
     parser.add_argument('--filename', type=str, required=True,
                         help='Tomogram filename (including the file extension')
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='Read the volumes chunk by chunk while browsing instead of loading them into memory '
+                             '(requires dask)')
     return parser
 
 
-def main(config, filename):
+def main(config, filename, out_of_core=False):
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    tomo = mrcfile.open(os.path.join(config['data_folder'], filename)).data
+    out_of_core = out_of_core or bool(config.get('out_of_core', False))
+    tomo_file = os.path.join(config['data_folder'], filename)
+    tomo = load_multiscale(tomo_file, load_tomogram(tomo_file))
     instances_file = os.path.join(config['prediction_folder'] + '_filtered',
                                   filename.split(config['file_extension'])[0] + '_instance_preds.h5')
-    with h5py.File(instances_file, 'r') as f:
-        instances = f['instances'][()]
+    if out_of_core:
+        instances = open_h5_dataset(instances_file, 'instances')
+        instances_lut = label_lookup_table(label_range(instances)[1], value=2)
+    else:
+        instances = load_labels(instances_file, 'instances')
+        instances_lut = label_lookup_table(instances.max(initial=0), value=2)
+    instances = load_multiscale(instances_file, instances, 'instances', is_label=True)
     v = napari.Viewer()
-    v.add_image(tomo * -1, name='tomo')
-    v.add_labels(instances, name='instances')
+    v.add_image(**multiscale_layer_args(tomo, out_of_core), name='tomo', colormap='gray_r')
+    v.add_labels(**multiscale_layer_args(instances, out_of_core), name='instances')
 
     prediction_file = os.path.join(config['filtering_mask_folder'],
                                    filename.split(config['file_extension'])[0] + '_preds.h5')
-    with h5py.File(prediction_file, 'r') as f:
-        labels = f['labels'][()]
+    if out_of_core:
+        labels = open_h5_dataset(prediction_file, 'labels')
+        labels_lut = label_lookup_table(label_range(labels)[1], config['filtering_mask_labels'])
+    else:
+        labels = load_labels(prediction_file, 'labels')
+        labels_lut = label_lookup_table(labels.max(initial=0), config['filtering_mask_labels'])
+    labels = load_multiscale(prediction_file, labels, 'labels', is_label=True)
 
-    v.add_labels(np.isin(labels, config['filtering_mask_labels']), name='mask')
-    v.add_labels((instances > 0) * 2, name='filtered_particles')
+    # in the out-of-core mode the masks are computed chunk by chunk when they are displayed
+    lookup = lazy_lookup_table if out_of_core else apply_lookup_table
+    v.add_labels(**multiscale_layer_args([lookup(level, labels_lut) for level in labels]), name='mask')
+    v.add_labels(**multiscale_layer_args([lookup(level, instances_lut) for level in instances]),
+                 name='filtered_particles')
     napari.run()
 
 
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config, args.filename)
+    main(args.config, args.filename, args.out_of_core)
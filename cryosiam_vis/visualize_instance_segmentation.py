@@ -1,10 +1,12 @@
 import os
-import h5py
 import yaml
 import napari
-import mrcfile
 import argparse
 
+from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset
+from cryosiam_vis.label_utils import load_labels
+from cryosiam_vis.pyramid import load_multiscale, multiscale_layer_args
+
 
 def parser_helper(description=None):
     description = "Plot instance segmentation with napari" if description is None else description
@@ -14,24 +16,32 @@ def parser_helper(description=None):
                         help='path to the config file used for running CryoSiam')
     parser.add_argument('--filename', type=str, required=True,
                         help='Tomogram filename (including the file extension')
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='Read the volumes chunk by chunk while browsing instead of loading them into memory '
+                             '(requires dask)')
     return parser
 
 
-def main(config, filename):
+def main(config, filename, out_of_core=False):
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    tomo = mrcfile.open(os.path.join(config['data_folder'], filename)).data
+    out_of_core = out_of_core or bool(config.get('out_of_core', False))
+    tomo_file = os.path.join(config['data_folder'], filename)
+    tomo = load_multiscale(tomo_file, load_tomogram(tomo_file))
     instances_file = os.path.join(config['prediction_folder'],
                                   filename.split(config['file_extension'])[0] + '_instance_preds.h5')
-    with h5py.File(instances_file, 'r') as f:
-        instances = f['instances'][()]
+    if out_of_core:
+        instances = open_h5_dataset(instances_file, 'instances')
+    else:
+        instances = load_labels(instances_file, 'instances')
+    instances = load_multiscale(instances_file, instances, 'instances', is_label=True)
     v = napari.Viewer()
-    v.add_image(tomo * -1, name='tomo')
-    v.add_labels(instances, name='instances')
+    v.add_image(**multiscale_layer_args(tomo, out_of_core), name='tomo', colormap='gray_r')
+    v.add_labels(**multiscale_layer_args(instances, out_of_core), name='instances')
     napari.run()
 
 
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config, args.filename)
+    main(args.config, args.filename, args.out_of_core)
@@ -2,9 +2,12 @@ import os
 import h5py
 import yaml
 import napari
-import mrcfile
 import argparse
-import numpy as np
+
+from cryosiam_vis.io_utils import load_tomogram, open_h5_dataset
+from cryosiam_vis.label_utils import load_labels, slab_size
+from cryosiam_vis.instance_index import label_histogram
+from cryosiam_vis.pyramid import load_multiscale, multiscale_layer_args
 
 
 def parser_helper(description=None):
@@ -15,35 +18,48 @@ def parser_helper(description=None):
                         help='path to the config file used for running CryoSiam semantic segmentation')
     parser.add_argument('--filename', type=str, required=True,
                         help='Tomogram filename (including the file extension')
+    parser.add_argument('--out_of_core', action='store_true',
+                        help='Read the volumes chunk by chunk while browsing instead of loading them into memory '
+                             '(requires dask)')
     return parser
 
 
-def main(config, filename):
+def main(config, filename, out_of_core=False):
     with open(config, "r") as ymlfile:
         config = yaml.safe_load(ymlfile)
-    tomo = mrcfile.open(os.path.join(config['data_folder'], filename)).data
+    out_of_core = out_of_core or bool(config.get('out_of_core', False))
+    tomo_file = os.path.join(config['data_folder'], filename)
+    tomo = load_multiscale(tomo_file, load_tomogram(tomo_file))
     prediction_file = os.path.join(config['prediction_folder'],
                                    filename.split(config['file_extension'])[0] + '_preds.h5')
-    with h5py.File(prediction_file, 'r') as f:
-        labels = f['labels'][()]
-        if 'probs' in f:
-            probs = f['probs'][()]
-        else:
-            probs = None
+    if out_of_core:
+        labels = open_h5_dataset(prediction_file, 'labels')
+        probs = labels.file['probs'] if 'probs' in labels.file else None
+    else:
+        labels = load_labels(prediction_file, 'labels')
+        with h5py.File(prediction_file, 'r') as f:
+            if 'probs' in f:
+                probs = f['probs'][()]
+            else:
+                probs = None
     v = napari.Viewer()
-    v.add_image(tomo * -1, name='tomo')
+    v.add_image(**multiscale_layer_args(tomo, out_of_core), name='tomo', colormap='gray_r')
     if probs is not None:
-        v.add_image(probs, name='probs', colormap='magma')
-    v.add_labels(labels, name='predictions')
-    if np.max(labels) > 1:
-        for label in np.unique(labels):
-            if label == 0:
-                continue
-            v.add_labels((labels == label) * label, name=f'label_{label}')
+        v.add_image(**multiscale_layer_args(load_multiscale(prediction_file, probs, 'probs'), out_of_core),
+                    name='probs', colormap='magma')
+    label_levels = load_multiscale(prediction_file, labels, 'labels', is_label=True)
+    v.add_labels(**multiscale_layer_args(label_levels, out_of_core), name='predictions')
+    classes, _ = label_histogram(labels, slab_size(labels.shape, labels.dtype.itemsize))
+    classes = classes[classes != 0]
+    if len(classes) and classes[-1] > 1:
+        for label in classes:
+            layer = v.add_labels(**multiscale_layer_args(label_levels, out_of_core), name=f'label_{label}')
+            layer.selected_label = label
+            layer.show_selected_label = True
     napari.run()
 
 
 if __name__ == '__main__':
     parser = parser_helper()
     args = parser.parse_args()
-    main(args.config, args.filename)
+    main(args.config, args.filename, args.out_of_core)
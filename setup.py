@@ -23,8 +23,13 @@ setup(
         "h5py==3.11.0",
         "dash-slicer==0.3.1",
         "napari[pyqt5]==0.6.4",
-        "starfile==0.5.2"
+        "starfile==0.5.2",
+        "scipy==1.13.1"
     ],
+    extras_require={
+        "out_of_core": ["dask==2024.8.0"],
+        "serve": ["gunicorn==23.0.0"]
+    },
     python_requires=">=3.8",
     classifiers=[
         "Programming Language :: Python :: 3",